@@ -47,6 +47,12 @@ fi
 export PATH=${PATH}:/group/mwasci/$USER/bin/:/group/mwasci/$USER/GLEAM-X-pipeline/bin
 export PYTHONPATH=$PYTHONPATH:/group/mwasci/$USER/lib/python2.7/site-packages/:~/lib/:/group/mwasci/$USER/bin/
 
+# Jobs record their start/finish/fail here instead of writing to the database;
+# track_task.py merges them in when the next job is queued, or run
+# track_task.py collect on the login node
+export GXTRACKSPOOL=/group/mwasci/${USER}/GLEAM-X-pipeline/queue/track
+mkdir -p ${GXTRACKSPOOL}
+
 # Add your MWA_ASVO_API_KEY here
 export MWA_ASVO_API_KEY=
 
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""Time loading the cross-matched snapshot catalogues that polyfit_snapshots.py fits to.
+
+Compares growing the columns with np.append for every catalogue (the old
+approach) against CatalogueAccumulator, which preallocates the columns from
+the FITS row counts and fills them in place.
+
+usage: catalogue_load.py [--ncat 500] [--nrows 20000] [--threads 1]
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+from catalogue_accumulator import CatalogueAccumulator
+
+COLUMNS = ["RAJ2000", "DEJ2000", "int_flux", "S_200", "alpha", "local_rms"]
+
+
+def make_catalogues(directory, ncat, nrows):
+    """Write ncat synthetic matched catalogues with nrows rows each."""
+    rng = np.random.RandomState(42)
+    filenames = []
+    for k in range(ncat):
+        t = Table()
+        t["RAJ2000"] = rng.uniform(0, 360, nrows)
+        t["DEJ2000"] = rng.uniform(-90, 30, nrows)
+        t["S_200"] = 10**rng.uniform(-1, 1, nrows)
+        t["alpha"] = rng.normal(-0.8, 0.2, nrows)
+        t["ra"] = t["RAJ2000"]
+        t["dec"] = t["DEJ2000"]
+        t["int_flux"] = t["S_200"]*rng.lognormal(0, 0.05, nrows)
+        t["peak_flux"] = t["int_flux"]
+        t["local_rms"] = np.full(nrows, 0.01)
+        t["Separation"] = rng.uniform(0, 45, nrows)
+        filename = os.path.join(directory, "{0}_comp_matched.fits".format(k))
+        t.write(filename, overwrite=True)
+        filenames.append(filename)
+    return filenames
+
+
+def load_append(filenames, ra_cent=0., centfreq=154.):
+    """The old loading loop from polyfit_snapshots.py."""
+    logratios = np.empty(0)
+    int_fluxes = np.empty(0)
+    local_rmses = np.empty(0)
+    S200s = np.empty(0)
+    alphas = np.empty(0)
+    ras = np.empty(0)
+    ra_offs = np.empty(0)
+    decs = np.empty(0)
+    for sfm in filenames:
+        hdu = fits.open(sfm)
+        cat = hdu[1].data
+        ras = np.append(ras, cat["RAJ2000"])
+        ra_offs = np.append(ra_offs, cat["RAJ2000"] - ra_cent*np.ones(len(cat["RAJ2000"])))
+        decs = np.append(decs, cat["DEJ2000"])
+        int_fluxes = np.append(int_fluxes, cat["int_flux"])
+        S200s = np.append(S200s, cat["S_200"])
+        alphas = np.append(alphas, cat["alpha"])
+        logratios = np.append(logratios, np.log10(cat["S_200"]*(centfreq/200.)**cat["alpha"]/cat["int_flux"]))
+        local_rmses = np.append(local_rmses, cat["local_rms"])
+        hdu.close()
+    return logratios
+
+
+def load_accumulator(filenames, threads=1, ra_cent=0., centfreq=154.):
+    """The CatalogueAccumulator loading used by polyfit_snapshots.py."""
+    def derive(k, cat):
+        values = dict((col, cat[col]) for col in COLUMNS)
+        values["RA_offset"] = cat["RAJ2000"] - ra_cent*np.ones(len(cat["RAJ2000"]))
+        values["log10ratio"] = np.log10(cat["S_200"]*(centfreq/200.)**cat["alpha"]/cat["int_flux"])
+        return values
+    snapshots = CatalogueAccumulator(filenames, COLUMNS + ["RA_offset", "log10ratio"])
+    snapshots.read_all(derive=derive, threads=threads)
+    return snapshots["log10ratio"]
+
+
+def main():
+    """
+    """
+
+    ps = ArgumentParser(description="Benchmark loading of snapshot catalogues.")
+    ps.add_argument("--ncat", type=int, default=500, help="Number of catalogues (default = 500)")
+    ps.add_argument("--nrows", type=int, default=20000, help="Rows per catalogue (default = 20000)")
+    ps.add_argument("--threads", type=int, default=1,
+                    help="Threads for the accumulator to read with (default = 1)")
+    args = ps.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        print("Writing {0} catalogues of {1} rows".format(args.ncat, args.nrows))
+        filenames = make_catalogues(directory, args.ncat, args.nrows)
+
+        start = time.time()
+        before = load_append(filenames)
+        t_append = time.time() - start
+        print("np.append:            {0:8.2f} s".format(t_append))
+
+        start = time.time()
+        after = load_accumulator(filenames, threads=args.threads)
+        t_acc = time.time() - start
+        print("CatalogueAccumulator: {0:8.2f} s ({1:.1f}x faster)".format(t_acc, t_append/t_acc))
+
+        if not np.array_equal(before, after):
+            print("Loaded columns differ!")
+            sys.exit(1)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
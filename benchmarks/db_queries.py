@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""Time the common lookups in db/queries.py on a database the size of a full survey.
+
+Builds a database with the tables from make_db.py, fills it with fake
+observations, jobs and apparent fluxes, and times each query before and
+after the indexes of migration 3, with the query plan sqlite chose.
+
+usage: db_queries.py [--nprocessing 1000000] [--nobs 50000] [--db FILE]
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import time
+import json
+import sqlite3
+import tempfile
+import contextlib
+
+import numpy as np
+
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "db"))
+import make_db
+import queries
+
+SOURCES = ["CasA", "CygA", "Crab", "VirA", "PicA", "HerA", "HydA"]
+
+
+def fill(conn, nprocessing, nobs, now):
+    """Fake a survey's worth of observations, jobs and calibrator fluxes."""
+    rng = np.random.RandomState(42)
+    obsids = 1200000000 + 8*np.arange(nobs)
+    # A few recent observations haven't been through the ionospheric triage yet
+    iono = rng.uniform(0, 1, nobs) > 0.01
+    conn.executemany("INSERT INTO observation (obs_id, ra_pointing, dec_pointing, cenchan, starttime, delays, ion_phs_med, status) "
+                     "VALUES (?,?,?,?,?,?,?,?)",
+                     ((int(o), float(rng.uniform(0, 360)), -27., 121, str(o), json.dumps([0]*16),
+                       float(rng.uniform(0, 100)) if i else None, "processed") for o, i in zip(obsids, iono)))
+    conn.executemany("INSERT INTO sources (source, ra, dec, flux, alpha, beta) VALUES (?,?,?,?,?,?)",
+                     ((s, 0., 0., 1000., -0.8, 0.) for s in SOURCES))
+    conn.executemany("INSERT INTO calapparent (obs_id, source, appflux, infov) VALUES (?,?,?,?)",
+                     ((int(o), s, float(rng.uniform(0, 1000)), bool(rng.uniform() < 0.2)) for o in obsids for s in SOURCES))
+    # Jobs over the last year; most finished, a few failed or still running
+    tasks = ["cotter", "calibrate", "apply_cal", "uvflag", "image", "postimage"]
+    end = now - rng.uniform(0, 365*86400, nprocessing).astype(int)
+    status = rng.choice(["finished", "failed", "started", "queued"], nprocessing, p=[0.93, 0.05, 0.01, 0.01])
+    conn.executemany("INSERT INTO processing (job_id, task_id, submission_time, task, user, start_time, end_time, obs_id, status) "
+                     "VALUES (?,?,?,?,?,?,?,?,?)",
+                     ((1000000 + k//20, k % 20 + 1, int(e) - 3600, tasks[k % len(tasks)], "gleamx", int(e) - 1800, int(e),
+                       int(obsids[rng.randint(nobs)]), str(s)) for k, (e, s) in enumerate(zip(end, status))))
+    conn.commit()
+
+
+def timeit(func, *args):
+    """Best time of a few repeats, in milliseconds, and the number of rows returned."""
+    best = np.inf
+    for i in range(20):
+        start = time.time()
+        result = func(*args)
+        best = min(best, time.time() - start)
+    return best*1e3, len(result) if isinstance(result, list) else int(result is not None)
+
+
+def plan(conn, sql, params):
+    return "; ".join(row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params))
+
+
+def run(conn, now):
+    midobs = 1200000000 + 8*1000
+    lookups = [("failed in the last day", queries.failed_jobs, (now - 86400,), queries.FAILED_SINCE, (now - 86400,)),
+               ("queued jobs", queries.jobs_with_status, ("queued",), queries.JOBS_WITH_STATUS, ("queued",)),
+               ("one job", queries.job, (1000100, 3), queries.JOB, (1000100, 3)),
+               ("jobs on an obsid", queries.obs_jobs, (midobs,), queries.OBS_JOBS, (midobs,)),
+               ("missing ionosphere stats", queries.missing_ionosphere, (), queries.MISSING_IONO, ()),
+               ("calibrators in FOV", queries.calibrators_in_fov, (midobs,), queries.CALIBRATORS_IN_FOV, (midobs,))]
+    for name, func, args, sql, params in lookups:
+        ms, nrows = timeit(func, conn, *args)
+        print("  {0:26s} {1:9.3f} ms {2:7d} rows  {3}".format(name, ms, nrows, plan(conn, sql, params)))
+
+
+def main():
+    """
+    """
+
+    ps = ArgumentParser(description="Benchmark the GLEAM-X database queries.")
+    ps.add_argument("--nprocessing", type=int, default=1000000, help="Number of processing rows (default = 1000000)")
+    ps.add_argument("--nobs", type=int, default=50000, help="Number of observations (default = 50000)")
+    ps.add_argument("--db", type=str, default=None, help="Database file to make (default = a temporary file)")
+    args = ps.parse_args()
+
+    if args.db is None:
+        fd, dbfile = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        os.remove(dbfile)
+    else:
+        dbfile = args.db
+    now = int(time.time())
+
+    conn = sqlite3.connect(dbfile)
+    with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+        for number, description, migration in make_db.migrations[:2]:
+            migration(conn.cursor())
+        conn.execute("PRAGMA user_version = 2")
+    # The pipeline's connections don't enforce foreign keys, and without the
+    # unique index on sources(source) they can't be
+    conn.execute("PRAGMA foreign_keys=OFF")
+    start = time.time()
+    fill(conn, args.nprocessing, args.nobs, now)
+    print("Filled {0} in {1:.0f} s".format(dbfile, time.time() - start))
+
+    print("Without indexes:")
+    run(conn, now)
+    with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+        make_db.migrate(conn)
+    print("With indexes (schema version {0}):".format(make_db.schema_version(conn)))
+    run(conn, now)
+    conn.close()
+    if args.db is None:
+        os.remove(dbfile)
+
+
+if __name__ == "__main__":
+    main()
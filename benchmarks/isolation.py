@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""Time the isolation test used by psf_select.py on a GLEAM-X-sized catalogue.
+
+Compares sky_match.isolated, which lists every pair within the radius with
+a single dual-tree query_pairs, against asking the KD-tree for the nearest
+other source of every row. Both are checked against a brute-force
+calculation for sources near RA 0/360 and near the south pole.
+
+usage: isolation.py [--nrows 2000000] [--radius 600]
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import time
+
+import numpy as np
+
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+from sky_match import isolated, radec_to_xyz, arcsec_to_chord, SkyIndex
+
+
+def make_positions(nrows):
+    """Random positions over the GLEAM-X sky (Dec < +30), clustered a little so there are crowded areas."""
+    rng = np.random.RandomState(42)
+    ra = rng.uniform(0, 360, nrows)
+    dec = np.degrees(np.arcsin(rng.uniform(-1, 0.5, nrows)))
+    # Put a tenth of the sources in tight groups and a few exactly on the poles and RA 0
+    groups = rng.randint(0, nrows, nrows//10)
+    ra[groups[1:]] = (ra[groups[:-1]] + rng.normal(0, 0.05, len(groups)-1)) % 360
+    dec[groups[1:]] = np.clip(dec[groups[:-1]] + rng.normal(0, 0.05, len(groups)-1), -90, 90)
+    ra[:10] = 0.
+    dec[10:20] = -90.
+    return ra, dec
+
+
+def isolated_nearest(ra, dec, radius):
+    """Isolation from the distance to each source's nearest neighbour."""
+    index = SkyIndex(ra, dec)
+    bound = np.nextafter(arcsec_to_chord(radius), np.inf)
+    dist, idx = index.tree.query(index.xyz, k=2, distance_upper_bound=bound)
+    mask = np.ones(len(ra), dtype=bool)
+    mask[index.rows] = ~np.isfinite(dist[:, 1])
+    return mask
+
+
+def isolated_brute(ra, dec, radius, rows):
+    """Brute-force isolation of the given rows against every source."""
+    xyz = radec_to_xyz(ra, dec)
+    chord = arcsec_to_chord(radius)
+    mask = np.ones(len(rows), dtype=bool)
+    for k, row in enumerate(rows):
+        d = np.sqrt(((xyz - xyz[row])**2).sum(axis=1))
+        d[row] = np.inf
+        mask[k] = not np.any(d <= chord)
+    return mask
+
+
+def main():
+    """
+    """
+
+    ps = ArgumentParser(description="Benchmark catalogue isolation.")
+    ps.add_argument("--nrows", type=int, default=2000000, help="Number of sources (default = 2000000)")
+    ps.add_argument("--radius", type=float, default=600., help="Isolation radius in arcsec (default = 600)")
+    args = ps.parse_args()
+
+    ra, dec = make_positions(args.nrows)
+
+    start = time.time()
+    after = isolated(ra, dec, args.radius)
+    t_iso = time.time() - start
+    print("isolated (query_pairs): {0:8.2f} s, {1} of {2} isolated".format(t_iso, after.sum(), args.nrows))
+
+    start = time.time()
+    before = isolated_nearest(ra, dec, args.radius)
+    t_nearest = time.time() - start
+    print("nearest neighbour:      {0:8.2f} s".format(t_nearest))
+
+    edges = np.where((ra < 0.5) | (ra > 359.5) | (dec < -89.))[0][:200]
+    brute = isolated_brute(ra, dec, args.radius, edges)
+
+    if not np.array_equal(before, after) or not np.array_equal(after[edges], brute):
+        print("Isolation masks differ!")
+        sys.exit(1)
+    print("Masks agree, including {0} sources at the RA wrap and the pole".format(len(edges)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+from __future__ import print_function, division
+
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+from astropy.io import fits
+
+
+class CatalogueAccumulator(object):
+    """Concatenate columns from many FITS tables into preallocated arrays.
+
+    The row count of every table is read from its header up front, so each
+    column is allocated once at its final size and every table is copied
+    straight into its own slice of the buffers. Only the requested columns
+    are read from each table.
+    """
+    def __init__(self, filenames, columns, hdu=1, dtype=np.float64):
+        self.filenames = list(filenames)
+        self.columns = list(columns)
+        self.hdu = hdu
+        self.counts = np.array([fits.getheader(f, hdu)["NAXIS2"] for f in self.filenames], dtype=int)
+        self.offsets = np.concatenate(([0], np.cumsum(self.counts))).astype(int)
+        self.data = dict((col, np.empty(self.offsets[-1], dtype=dtype)) for col in self.columns)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, col):
+        return self.data[col]
+
+    def rows(self, k):
+        """The slice of the buffers that holds the rows of table k."""
+        return slice(self.offsets[k], self.offsets[k+1])
+
+    def read(self, k, derive=None):
+        """Read table k into its slice of the buffers.
+
+        By default the columns are copied across by name. Alternatively derive
+        is a function of (k, data) which returns a dictionary of the columns,
+        e.g. to calculate new columns from the table.
+        """
+        with fits.open(self.filenames[k], memmap=True) as hdulist:
+            data = hdulist[self.hdu].data
+            if derive is None:
+                values = dict((col, data[col]) for col in self.columns)
+            else:
+                values = derive(k, data)
+            rows = self.rows(k)
+            for col in self.columns:
+                self.data[col][rows] = values[col]
+
+    def read_all(self, derive=None, threads=1):
+        """Read every table, optionally using a pool of threads."""
+        def read_one(k):
+            self.read(k, derive)
+        if threads > 1:
+            pool = ThreadPool(threads)
+            pool.map(read_one, range(len(self.filenames)))
+            pool.close()
+            pool.join()
+        else:
+            for k in range(len(self.filenames)):
+                read_one(k)
+        return self
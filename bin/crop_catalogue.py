@@ -98,6 +98,8 @@ if __name__ == "__main__":
         help="Select the brightest set of sources whose cumulative flux represent PERCENT of the total flux of potential sources in the sky-model (0 to 100)",
     )
 
+    parser.add_option('--isolate', type="float", dest="isolate", default=None,
+                        help="Only keep sources with no other catalogue source within this many arcmin (default = None)")
     parser.add_option('--nobeamselect', action="store_false", dest="beamselect", default=True,
                         help="Use the primary beam to (crudely) attenuate the catalogue fluxes when calculating the minimum flux (default=True)")
     parser.add_option('--attenuate', action="store_true", dest="attenuate", default=False,
@@ -140,6 +142,13 @@ if __name__ == "__main__":
         fluxcut = np.where(data[options.fluxcol] > options.minflux)
         indices = np.intersect1d(fluxcut, indices)
 
+    # Select only sources without close neighbours, including neighbours just outside the crop
+    if options.isolate is not None:
+        from sky_match import isolated
+        nearby = np.where(separations < options.radius + options.isolate/60.)[0]
+        alone = nearby[isolated(data[options.racol][nearby], data[options.decol][nearby], options.isolate*60.)]
+        indices = np.intersect1d(alone, indices)
+
     # Select only sources with non-zero spectral indices
     alphacut = np.where(np.logical_not(np.isnan(data[options.alphacol])))
     indices = np.intersect1d(alphacut,indices)
@@ -192,7 +201,7 @@ if __name__ == "__main__":
     nselected=indices.shape[0]
     noriginal=data.shape[0]
 
-    if indices.shape > 0:
+    if len(indices) > 0:
         # Write out the sources
         temp[1].data = data[indices]
         temp.writeto(options.output,overwrite=True)
@@ -8,59 +8,140 @@
 # and reduced peak flux densities from ionospheric blurring
 # should be boosted back to where they should have been.
 
+from __future__ import print_function, division
+
+import os
+import shutil
+import resource
+
 import numpy as np
 
 from astropy.io import fits
 from astropy import wcs
 from optparse import OptionParser
 
-usage="Usage: %prog [options] <file>\n"
-parser = OptionParser(usage=usage)
-parser.add_option('--mosaic',type="string", dest="mosaic",
-                    help="The filename of the mosaic you want to read in.")
-parser.add_option('--psf',type="string", dest="psf",
-                    help="The filename of the psf image you want to read in. \
-                    The fourth slice should contain the blur factor to apply.")
-parser.add_option('--output',type="string", dest="output",
-                    help="The filename of the output rescaled image.")
-(options, args) = parser.parse_args()
-
-input_mosaic = options.mosaic
-input_root=input_mosaic.replace(".fits","")
-
-# Read in the mosaic to be modified
-mosaic = fits.open(input_mosaic)
-w = wcs.WCS(mosaic[0].header)
-
-#create an array but don't set the values (they are random)
-indexes = np.empty( (mosaic[0].data.shape[0]*mosaic[0].data.shape[1],2),dtype=int)
-#since I know exactly what the index array needs to look like I can construct
-# it faster than list comprehension would allow
-#we do this only once and then recycle it
-idx = np.array([ (j,0) for j in xrange(mosaic[0].data.shape[1])])
-j=mosaic[0].data.shape[1]
-for i in xrange(mosaic[0].data.shape[0]):
-    idx[:,1]=i
-    indexes[i*j:(i+1)*j] = idx
-
-#put ALL the pixels into our vectorized functions and minimise our overheads
-ra,dec = w.wcs_pix2world(indexes,1).transpose()
-
-# Read in the PSF
-psf = fits.open(options.psf)
-# Specifically, the blur factor
-blur = psf[0].data[3]
-
-w_psf = wcs.WCS(psf[0].header,naxis=2)
-
-# Apply the blur correction
-k, l = w_psf.wcs_world2pix(ra,dec,1)
-k_int = [int(np.floor(x)) for x in k]
-k_int = [x if (x>=0) and (x<=360) else 0 for x in k_int]
-l_int = [int(np.floor(x)) for x in l]
-l_int = [x if (x>=0) and (x<=180) else 0 for x in l_int]
-blur_tmp = blur[l_int,k_int]
-blur_corr = blur_tmp.reshape(mosaic[0].data.shape[0],mosaic[0].data.shape[1])
-mosaic[0].data *= blur_corr
-
-mosaic.writeto(options.output,clobber=True)
+# Number of mosaic pixels to work on at once; each needs 100-500 bytes of workspace,
+# depending on how the blur factor is looked up
+BLOCK_PIXELS = 1000000
+
+
+def blur_nearest(blur, w_psf, ra, dec):
+    """Blur factor of the CAR pixel that each position falls in.
+
+    Positions off the map take the value of pixel 0, as they always have.
+    """
+    k, l = w_psf.wcs_world2pix(ra, dec, 1)
+    with np.errstate(invalid='ignore'):
+        k_int = np.floor(k)
+        l_int = np.floor(l)
+        k_int = np.where((k_int >= 0) & (k_int < blur.shape[1]), k_int, 0).astype(int)
+        l_int = np.where((l_int >= 0) & (l_int < blur.shape[0]), l_int, 0).astype(int)
+    return blur[l_int, k_int]
+
+
+def blur_bilinear(blur, w_psf, ra, dec):
+    """Blur factor interpolated bilinearly between the four nearest CAR pixels.
+
+    The map wraps around in RA. Pixels without a measurement (NaN) are left
+    out of the interpolation; positions with none of the four measured are NaN.
+    """
+    ny, nx = blur.shape
+    k, l = w_psf.wcs_world2pix(ra, dec, 0)
+    k0 = np.floor(k)
+    l0 = np.floor(l)
+    fk = k - k0
+    fl = l - l0
+    # Positions off the mosaic's projection are NaN and stay that way
+    with np.errstate(invalid='ignore'):
+        k0 = k0.astype(int)
+        l0 = l0.astype(int)
+    total = np.zeros(len(k))
+    weight = np.zeros(len(k))
+    for dl, wl in [(0, 1 - fl), (1, fl)]:
+        ll = np.clip(l0 + dl, 0, ny - 1)
+        for dk, wk in [(0, 1 - fk), (1, fk)]:
+            value = blur[ll, (k0 + dk) % nx]
+            wt = np.where(np.isfinite(value), wl*wk, 0.)
+            total += np.where(wt > 0, value, 0.)*wt
+            weight += wt
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total/weight
+
+
+def blur_healpix(psfmap, ra, dec, interpolate):
+    """Blur factor from a HEALPix PSF map (psf_create.py --healpix)."""
+    return psfmap.psf_at(ra, dec, interpolate=interpolate)[3]
+
+
+def apply_blur(data, w, blur_at, rows=None, origin=0):
+    """Multiply the mosaic by the blur factor, in place, a block of rows at a time.
+
+    blur_at(ra, dec) returns the blur factor at each position. Array index
+    (j, i) is taken as pixel (i, j) of the WCS with the given origin.
+    """
+    ny, nx = data.shape
+    if rows is None:
+        rows = max(1, BLOCK_PIXELS//nx)
+    x = np.arange(nx)
+    for start in range(0, ny, rows):
+        stop = min(start + rows, ny)
+        j, i = np.meshgrid(np.arange(start, stop), x, indexing='ij')
+        ra, dec = w.wcs_pix2world(i.ravel(), j.ravel(), origin)
+        data[start:stop] *= blur_at(ra, dec).reshape(stop - start, nx).astype(data.dtype)
+
+
+def peak_memory():
+    """Peak resident memory of this process, in MB."""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kB, macOS bytes
+    if os.uname()[0] == 'Darwin':
+        maxrss /= 1024
+    return maxrss/1024.
+
+
+if __name__ == "__main__":
+    usage="Usage: %prog [options] <file>\n"
+    parser = OptionParser(usage=usage)
+    parser.add_option('--mosaic',type="string", dest="mosaic",
+                        help="The filename of the mosaic you want to read in.")
+    parser.add_option('--psf',type="string", dest="psf",
+                        help="The filename of the psf image you want to read in. \
+                        The fourth slice should contain the blur factor to apply. \
+                        A HEALPix PSF map from psf_create.py --healpix also works.")
+    parser.add_option('--output',type="string", dest="output",
+                        help="The filename of the output rescaled image. \
+                        If it is the same as the mosaic, the mosaic is modified in place.")
+    parser.add_option('--interpolate',action="store_true", dest="interpolate", default=False,
+                        help="Interpolate the blur factor bilinearly instead of taking \
+                        the value of the PSF map pixel containing each mosaic pixel.")
+    parser.add_option('--rows',type="int", dest="rows", default=None,
+                        help="Number of mosaic rows to process at once \
+                        (default = about {0} pixels' worth).".format(BLOCK_PIXELS))
+    (options, args) = parser.parse_args()
+
+    # Read in the PSF, specifically the blur factor
+    with fits.open(options.psf) as psf:
+        healpix = len(psf) > 1 and psf[1].header.get('PIXTYPE') == 'HEALPIX'
+        if not healpix:
+            blur = np.array(psf[0].data[3])
+            w_psf = wcs.WCS(psf[0].header,naxis=2)
+    if healpix:
+        from psf_map import PSFMap
+        psfmap = PSFMap.read(options.psf)
+        blur_at = lambda ra, dec: blur_healpix(psfmap, ra, dec, options.interpolate)
+    elif options.interpolate:
+        blur_at = lambda ra, dec: blur_bilinear(blur, w_psf, ra, dec)
+    else:
+        blur_at = lambda ra, dec: blur_nearest(blur, w_psf, ra, dec)
+
+    # Work on a copy of the mosaic, memory-mapped, so it is never all in memory at once
+    if os.path.abspath(options.output) != os.path.abspath(options.mosaic):
+        shutil.copyfile(options.mosaic, options.output)
+    with fits.open(options.output, mode='update', memmap=True) as mosaic:
+        w = wcs.WCS(mosaic[0].header)
+        # Nearest-pixel lookup in a CAR map keeps the pixel numbering it has always
+        # used, so that results don't change
+        origin = 1 if not (healpix or options.interpolate) else 0
+        apply_blur(mosaic[0].data, w, blur_at, rows=options.rows, origin=origin)
+
+    print("Wrote {0}; peak memory {1:.0f} MB".format(options.output, peak_memory()))
@@ -2,13 +2,16 @@
 
 usage()
 {
-echo "drift_mosaic.sh [-p project] [-d dep] [-q queue] [-a account] [-t] [-r ra] [-e dec] -o list_of_observations.txt
+echo "drift_mosaic.sh [-p project] [-d dep] [-q queue] [-a account] [-t] [-i] [-r ra] [-e dec] -o list_of_observations.txt
   -p project  : project, (must be specified, no default)
   -d dep     : job number for dependency (afterok)
   -q queue    : job queue, default=workq
   -a account : computing account, default pawsey0272
   -t          : test. Don't submit job, just make the batch file
                 and then return the submission command
+  -i          : incremental. Keep the co-added mosaics between runs and only add the
+                observations that are new or have changed since the last run (and
+                take out those no longer in the list)
   -r RA       : Right Ascension (decimal hours; default = guess from observation list)
   -e dec      : Declination (decimal degrees; default = guess from observation list)
   -o obslist  : the list of obsids to process" 1>&2;
@@ -48,11 +51,12 @@ dep=
 queue="-p $standardq"
 account=
 tst=
+incremental=
 ra=
 dec=
 
 # parse args and set options
-while getopts ':td:p:q:o:r:e:' OPTION
+while getopts ':tid:p:q:o:r:e:' OPTION
 do
     case "$OPTION" in
     d)
@@ -71,6 +75,8 @@ do
         dec=${OPTARG} ;;
     t)
         tst=1 ;;
+    i)
+        incremental=1 ;;
     g)
         gpubox=1 ;;
         ? | : | h)
@@ -109,6 +115,7 @@ cat ${dbdir}/bin/mosaic.tmpl | sed -e "s:OBSLIST:${obslist}:g" \
                                  -e "s:ACCOUNT:${account}:g" \
                                  -e "s:RAPOINT:${ra}:g" \
                                  -e "s:DECPOINT:${dec}:g" \
+                                 -e "s:INCREMENTAL:${incremental}:g" \
                                  -e "s:BASEDIR:${base}:g" \
                                  -e "s:PIPEUSER:${pipeuser}:g" > ${script}
 
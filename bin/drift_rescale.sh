@@ -104,6 +104,7 @@ script="${dbdir}queue/rescale_${listbase}.sh"
 cat ${dbdir}/bin/rescale.tmpl | sed -e "s:OBSLIST:${obslist}:g" \
                                  -e "s:ACCOUNT:${account}:g" \
                                  -e "s:READ:${readfile}:g" \
+                                 -e "s:NCPUS:${ncpus}:g" \
                                  -e "s:BASEDIR:${base}:g"  \
                                  -e "s:PIPEUSER:${pipeuser}:g" > ${script}
 
@@ -7,11 +7,13 @@ import sqlite3
 import numpy as np
 from astropy.io import fits
 from astropy import wcs
+from metadata_cache import MetadataCache
 
 __author__ = "Natasha Hurley-Walker"
 
 # Append the service name to this base URL, eg 'con', 'obs', etc.
 BASEURL = 'http://mwa-metadata01.pawsey.org.au/metadata/'
+cache = MetadataCache(baseurl=BASEURL)
 #dbfile = 'GLEAM-X.sqlite'
 
 def truncate(f, n):
@@ -41,7 +43,7 @@ def getmeta(service='obs', params=None):
     # Get the data
     try:
         print BASEURL + service + '?' + data
-        result = json.load(urllib2.urlopen(BASEURL + service + '?' + data))
+        result = cache.getmeta(service, params)
     except urllib2.HTTPError as error:
         print "HTTP error from server: code=%d, response:\n %s" % (error.code, error.read())
         return
@@ -108,8 +110,7 @@ if __name__ == "__main__":
             os.mkdir(str(obs["chan"]))
         os.chdir(str(obs["chan"]))
 # Get the metafits files
-        os.system("wget http://mwa-metadata01.pawsey.org.au/metadata/fits?obs_id={0}".format(obs["obsid"]))
         metafits = "{0}.metafits".format(obs["obsid"])
-        os.rename("fits?obs_id={0}".format(obs["obsid"]),metafits)
+        cache.metafits(obs["obsid"], metafits)
 # Make a template file
         fake_image(metafits)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+
+from argparse import ArgumentParser
+
+try:
+    from urllib.request import urlopen
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib2 import urlopen
+    from urllib import urlencode
+
+# Responses are kept in a directory of files named by a hash of the service and
+# parameters; set GXMETADATACACHE to put it somewhere else
+default_cache_dir = os.environ.get("GXMETADATACACHE",
+                                   os.path.join(os.path.expanduser("~"), ".metadata_cache"))
+
+# Set GXMETADATAURL to use a different server (e.g. a mirror or a test server)
+default_baseurl = os.environ.get("GXMETADATAURL", "http://ws.mwatelescope.org/metadata/")
+
+# Set GXMETADATAOFFLINE=1 to never go to the network
+default_offline = os.environ.get("GXMETADATAOFFLINE", "0").lower() in ["1", "true", "yes"]
+
+# Responses older than this (seconds) are fetched again; None means they never
+# expire. Observations and their metafits don't change, but searches pick up
+# new observations.
+DEFAULT_TTL = {"find": 86400.}
+
+# Keep the cache below this many bytes, removing the least recently used responses first
+DEFAULT_MAX_SIZE = 2*1024**3
+
+
+class OfflineError(Exception):
+    """Raised in offline mode when a response is not in the cache."""
+    pass
+
+
+def cache_key(service, params=None):
+    """Hash of a service name and its parameters, independent of the parameter order."""
+    query = urlencode(sorted((str(k), str(v)) for k, v in (params or {}).items()))
+    return hashlib.sha1("{0}?{1}".format(service.strip().lower(), query).encode("utf-8")).hexdigest()
+
+
+class MetadataCache(object):
+    """Responses of the MWA metadata web service, stored on disk.
+
+    Anything the pipeline asks the service for (the obs, find and con JSON
+    services, and metafits files from the fits service) is fetched once and
+    then served from cache_dir, until it is older than the TTL for its
+    service. In offline mode only the cache is used.
+    """
+    def __init__(self, cache_dir=default_cache_dir, baseurl=default_baseurl, ttl=None,
+                 max_size=DEFAULT_MAX_SIZE, offline=default_offline, timeout=60):
+        self.cache_dir = cache_dir
+        self.baseurl = baseurl
+        self.ttl = dict(DEFAULT_TTL)
+        if ttl is not None:
+            self.ttl.update(ttl)
+        self.max_size = max_size
+        self.offline = offline
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        # Total size of the cache, found the first time it is needed
+        self._size = None
+
+    def path(self, service, params=None):
+        key = cache_key(service, params)
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def fresh(self, filename, service):
+        """Whether a cached response exists and is within the TTL for its service."""
+        if not os.path.exists(filename):
+            return False
+        ttl = self.ttl.get(service)
+        # Offline, anything is better than nothing
+        return ttl is None or self.offline or time.time() - os.path.getmtime(filename) < ttl
+
+    def fetch(self, service, params=None):
+        """Return the path of the cached response, fetching it first if needed.
+
+        Network errors are raised as they come from urlopen.
+        """
+        service = service.strip().lower()
+        filename = self.path(service, params)
+        if self.fresh(filename, service):
+            self.hits += 1
+            # Mark it as recently used; the modification time is the age for the TTL
+            os.utime(filename, (time.time(), os.path.getmtime(filename)))
+            return filename
+        if self.offline:
+            raise OfflineError("{0} {1} is not in the metadata cache {2}".format(service, params, self.cache_dir))
+        self.misses += 1
+        url = self.baseurl + service + "?" + urlencode(params or {})
+        response = urlopen(url, timeout=self.timeout)
+        directory = os.path.dirname(filename)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another job made it first
+                pass
+        # Write under a unique name and move it into place, in case several jobs get here at once
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(response, f)
+            os.rename(tmp, filename)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.evict(os.path.getsize(filename))
+        return filename
+
+    def getmeta(self, service="obs", params=None):
+        """The decoded JSON response of one of the obs, find or con services."""
+        with open(self.fetch(service, params)) as f:
+            return json.load(f)
+
+    def metafits(self, params, output):
+        """Copy the metafits file described by params (e.g. {'obs_id': obsid}) to output."""
+        if not isinstance(params, dict):
+            params = {"obs_id": params}
+        shutil.copyfile(self.fetch("fits", params), output)
+        return output
+
+    def entries(self):
+        """List (last used, size, path) of every cached response."""
+        entries = []
+        if not os.path.exists(self.cache_dir):
+            return entries
+        for root, dirs, files in os.walk(self.cache_dir):
+            for fl in files:
+                p = os.path.join(root, fl)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                entries.append((st.st_atime, st.st_size, p))
+        return entries
+
+    def evict(self, added=0):
+        """Remove the least recently used responses until the cache is below max_size.
+
+        added is the size of a response just written, so that the directory
+        only has to be scanned once per process until the cache is full.
+        """
+        if self.max_size is None:
+            return
+        if self._size is not None:
+            self._size += added
+            if self._size <= self.max_size:
+                return
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        self._size = total
+        if total <= self.max_size:
+            return
+        for atime, size, p in sorted(entries):
+            try:
+                os.remove(p)
+            except OSError:
+                continue
+            total -= size
+            if total <= self.max_size:
+                break
+        self._size = total
+
+
+_cache = None
+
+def shared_cache():
+    """A cache with the default settings, shared by the whole process."""
+    global _cache
+    if _cache is None:
+        _cache = MetadataCache()
+    return _cache
+
+
+def main():
+    """
+    """
+
+    ps = ArgumentParser(description="Fetch a response from the MWA metadata web service "
+                                    "through the local cache, e.g. metadata_cache.py fits obs_id=1200000000 "
+                                    "-o 1200000000.metafits")
+    ps.add_argument("service", type=str, help="Service: obs, find, con or fits.")
+    ps.add_argument("params", type=str, nargs="*", help="Parameters as key=value.")
+    ps.add_argument("-o", "--output", type=str, default=None,
+                    help="Write the response to this file instead of standard output.")
+    ps.add_argument("--cache", type=str, default=default_cache_dir,
+                    help="Cache directory (default = {0})".format(default_cache_dir))
+    ps.add_argument("--baseurl", type=str, default=default_baseurl,
+                    help="Metadata web service (default = {0})".format(default_baseurl))
+    ps.add_argument("--ttl", type=float, default=None,
+                    help="Fetch again if the cached response is older than this many seconds "
+                         "(default = {0} for find, otherwise never)".format(DEFAULT_TTL["find"]))
+    ps.add_argument("--max-size", type=float, default=DEFAULT_MAX_SIZE/1024.**2,
+                    help="Maximum size of the cache in MB (default = {0:.0f})".format(DEFAULT_MAX_SIZE/1024.**2))
+    ps.add_argument("--offline", action="store_true", default=default_offline,
+                    help="Only use the cache; fail if the response isn't there (default = False, "
+                         "or GXMETADATAOFFLINE)")
+    args = ps.parse_args()
+
+    params = dict(p.split("=", 1) for p in args.params)
+    ttl = None
+    if args.ttl is not None:
+        ttl = {args.service.strip().lower(): args.ttl}
+    cache = MetadataCache(args.cache, baseurl=args.baseurl, ttl=ttl,
+                          max_size=int(args.max_size*1024**2), offline=args.offline)
+    try:
+        filename = cache.fetch(args.service, params)
+    except Exception as e:
+        print("Could not get {0} {1}: {2}".format(args.service, params, e), file=sys.stderr)
+        sys.exit(1)
+    if args.output is not None:
+        shutil.copyfile(filename, args.output)
+    else:
+        with open(filename, "rb") as f:
+            shutil.copyfileobj(f, getattr(sys.stdout, "buffer", sys.stdout))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import os
+import sys
+import glob
+import json
+import sqlite3
+
+from argparse import ArgumentParser
+
+# By default each directory of metafits files (i.e. each observation) has its
+# own small sqlite cache, so that jobs on different observations never share
+# one; set GXMETAFITSCACHE to use a single file instead
+default_cache = os.environ.get("GXMETAFITSCACHE", None)
+CACHE_NAME = ".metafits_cache.sqlite"
+
+# A cache isn't worth waiting long for; the metafits can always be read instead
+BUSY_TIMEOUT = 5
+
+schema = """
+CREATE TABLE IF NOT EXISTS metafits
+(
+path TEXT PRIMARY KEY,
+mtime FLOAT,
+size INT,
+record TEXT
+);
+"""
+
+
+def find_metafits(fitsimage):
+    """Return the metafits file that sits alongside an image of an observation."""
+    path, fl = os.path.split(fitsimage)
+    metafits = glob.glob("{0}/{1}*metafits*".format(path, fl[0:10]))
+    return metafits[0]
+
+
+def read_metafits(metafits):
+    """Read the primary header of a metafits file into a dictionary of plain values."""
+    # Only needed when the cache misses, so don't pay for the import otherwise
+    from astropy.io import fits
+    hdr = fits.getheader(metafits)
+    record = {}
+    for key, value in hdr.items():
+        if key in ["", "COMMENT", "HISTORY"]:
+            continue
+        if not isinstance(value, (bool, int, float, str)):
+            value = None
+        record[key.upper()] = value
+    return record
+
+
+class MetafitsCache(object):
+    """Metafits headers, parsed once and stored keyed by file path.
+
+    A stored record is only used while the file's modification time and size
+    are unchanged; otherwise the metafits is read again. If a cache file can't
+    be opened, read or written (locked, read-only, ...), the metafits files
+    are just read directly.
+    """
+    def __init__(self, dbfile=default_cache):
+        self.dbfile = dbfile
+        self.records = {}
+        self.conns = {}
+
+    def cache_file(self, metafits):
+        """The cache file that a metafits file's record is kept in."""
+        if self.dbfile is not None:
+            return self.dbfile
+        return os.path.join(os.path.dirname(metafits), CACHE_NAME)
+
+    def connect(self, dbfile):
+        """The connection to a cache file, or None if it can't be opened."""
+        if dbfile not in self.conns:
+            try:
+                conn = sqlite3.connect(dbfile, timeout=BUSY_TIMEOUT)
+                try:
+                    conn.execute(schema)
+                    conn.commit()
+                except sqlite3.OperationalError:
+                # e.g. a read-only copy of the cache; we can still use what is there
+                    pass
+            except sqlite3.Error as e:
+                print("Could not open metafits cache {0}: {1}".format(dbfile, e), file=sys.stderr)
+                conn = None
+            self.conns[dbfile] = conn
+        return self.conns[dbfile]
+
+    def close(self):
+        for conn in self.conns.values():
+            if conn is not None:
+                conn.close()
+        self.conns = {}
+
+    def stored(self, dbfile, paths):
+        """The (mtime, size, record) kept in a cache file for each of paths it has."""
+        stored = {}
+        conn = self.connect(dbfile)
+        if conn is None:
+            return stored
+        try:
+            for i in range(0, len(paths), 500):
+                chunk = paths[i:i+500]
+                rows = conn.execute("SELECT path, mtime, size, record FROM metafits WHERE path IN ({0})".format(
+                    ",".join("?"*len(chunk))), chunk)
+                for path, mtime, size, record in rows:
+                    stored[path] = (mtime, size, record)
+        except sqlite3.Error as e:
+            print("Could not read metafits cache {0}: {1}".format(dbfile, e), file=sys.stderr)
+        return stored
+
+    def store(self, dbfile, updates):
+        """Keep (path, mtime, size, record) rows in a cache file, if it can be written."""
+        conn = self.connect(dbfile)
+        if conn is None:
+            return
+        try:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO metafits (path, mtime, size, record) VALUES (?,?,?,?)", updates)
+        except sqlite3.Error as e:
+            print("Could not update metafits cache {0}: {1}".format(dbfile, e), file=sys.stderr)
+
+    def lookup(self, metafits_list, keys=None):
+        """Return the records for a list of metafits files, in the same order.
+
+        Records are dictionaries of header keywords; if keys is given then
+        only those keywords are returned (None where they are missing).
+        """
+        paths = [os.path.abspath(m) for m in metafits_list]
+        stats = [os.stat(p) for p in paths]
+        todo = {}
+        for path in set(paths):
+            if path not in self.records:
+                todo.setdefault(self.cache_file(path), []).append(path)
+        stored = {}
+        for dbfile, chunk in todo.items():
+            stored.update(self.stored(dbfile, chunk))
+        updates = {}
+        for path, st in zip(paths, stats):
+            if path in self.records and self.records[path][:2] == (st.st_mtime, st.st_size):
+                continue
+            if path in stored and stored[path][:2] == (st.st_mtime, st.st_size):
+                record = json.loads(stored[path][2])
+            else:
+                record = read_metafits(path)
+                updates.setdefault(self.cache_file(path), []).append(
+                    (path, st.st_mtime, st.st_size, json.dumps(record)))
+            self.records[path] = (st.st_mtime, st.st_size, record)
+        for dbfile, rows in updates.items():
+            self.store(dbfile, rows)
+        results = []
+        for path in paths:
+            record = self.records[path][2]
+            if keys is not None:
+                record = dict((k.upper(), record.get(k.upper())) for k in keys)
+            results.append(record)
+        return results
+
+    def get(self, metafits, key=None):
+        """Return the record for one metafits file, or a single keyword from it."""
+        record = self.lookup([metafits])[0]
+        if key is None:
+            return record
+        return record[key.upper()]
+
+
+_cache = None
+
+def metafits_value(metafits, key):
+    """Look up a single keyword through a cache shared by the whole process."""
+    global _cache
+    if _cache is None:
+        _cache = MetafitsCache()
+    return _cache.get(metafits, key)
+
+
+def main():
+    """
+    """
+
+    ps = ArgumentParser(description="Print metafits header values, reading each metafits only once "
+                                    "and caching the result.")
+    ps.add_argument("metafits", type=str, nargs="+", help="Metafits file(s).")
+    ps.add_argument("-p", "--param", dest="params", type=str, action="append", default=None,
+                    help="Keyword to print; repeat for several keywords, which are printed space-separated "
+                         "on one line per file in the order given.")
+    ps.add_argument("--cache", type=str, default=default_cache,
+                    help="Cache file (default = $GXMETAFITSCACHE, or a {0} next to each metafits file)".format(CACHE_NAME))
+
+    args = ps.parse_args()
+
+    cache = MetafitsCache(args.cache)
+    records = cache.lookup(args.metafits, keys=args.params)
+    cache.close()
+    for record in records:
+        if args.params is None:
+            print(json.dumps(record, sort_keys=True))
+        else:
+            print(" ".join(str(record[k.upper()]) for k in args.params))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,444 @@
+#! /usr/bin/env python
+
+from __future__ import print_function, division
+
+import os
+import json
+import shutil
+import tempfile
+from argparse import ArgumentParser
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS, WCSCOMPARE_ANCILLARY, WCSCOMPARE_TILING
+
+from psf_projected import BLOCK_PIXELS, dOmega_blocks, check_projection, snapshot_beam
+
+import logging
+logging.basicConfig(format="%(levelname)s (%(module)s): %(message)s")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+# Keywords copied from the first snapshot to the mosaic, as COPY_KEYWORDS in coadd.swarp.tmpl
+COPY_KEYWORDS = ["TELESCOP", "MWAVER", "MWADATE", "BTYPE", "BUNIT", "BMAJ", "BMIN", "BPA", "FREQ"]
+
+# The sums kept for each pixel of the mosaic; None for the accumulator's own
+# type. The PSF axes have their own weight, since they are defined where the
+# image is blank but has weight. The counts of snapshots in each pixel say
+# exactly where none is left once snapshots have been taken out again.
+SUMS = [("weight", None), ("image", None), ("count", np.int16),
+        ("psfweight", None), ("bmaj", None), ("bmin", None), ("bpa", None),
+        ("psfcount", np.int16)]
+
+# In an accumulator directory: the grid and the snapshots added so far, and
+# the resampled snapshots themselves, so they can be taken out again
+STATE = "state.json"
+SNAPSHOTS = "snapshots"
+
+
+def read_list(filename):
+    """The non-empty lines of a text file, as written by mosaic.tmpl."""
+    with open(filename) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def preallocate(filename, header, shape):
+    """Write a float32 FITS image of the given shape, all zeros, and return its data as a writable memmap.
+
+    Only the header is actually written; the data are left for the
+    filesystem to fill in as they are used.
+    """
+    hdr = fits.PrimaryHDU(data=np.zeros((1,)*len(shape), dtype=np.float32), header=header).header
+    for i, n in enumerate(reversed(shape)):
+        hdr["NAXIS{0}".format(i+1)] = n
+    hdr.tofile(filename, overwrite=True)
+    offset = len(hdr.tostring())
+    nbytes = int(np.prod(shape))*4
+    # FITS files are whole numbers of 2880 byte blocks
+    with open(filename, "rb+") as f:
+        f.seek(offset + nbytes + (-nbytes) % 2880 - 1)
+        f.write(b"\0")
+    return np.memmap(filename, dtype=">f4", mode="r+", offset=offset, shape=shape)
+
+
+def snapshot_id(filename):
+    """The obsid of a snapshot, from the start of its file name (e.g. 1200000000_deep-MFS-image-pb_warp_rescaled.fits)."""
+    return os.path.basename(filename).split("_")[0]
+
+
+def check_grid(images, ref=None):
+    """Read the headers of the resampled snapshots, checking they are all on the grid with header ref.
+
+    By default the grid is that of the first snapshot.
+    """
+    headers = [fits.getheader(image) for image in images]
+    if ref is None:
+        ref = headers[0]
+    grid = WCS(ref).celestial.wcs
+    for image, hdr in zip(images, headers):
+        check_projection(hdr)
+        # swarp cuts the resampled snapshots out of the one grid, so the only
+        # difference should be a whole number of pixels in CRPIX
+        if not WCS(hdr).celestial.wcs.compare(grid, cmp=WCSCOMPARE_ANCILLARY | WCSCOMPARE_TILING, tolerance=1e-9):
+            raise ValueError("{0} is not on the same grid as the mosaic".format(image))
+    return headers
+
+
+def grid_offset(hdr, ref):
+    """The (y, x) pixel of the grid with header ref that pixel (0, 0) of the image with header hdr lands on.
+
+    swarp cuts each resampled snapshot out of the mosaic grid, so their
+    reference pixels differ by whole numbers of pixels.
+    """
+    offset = []
+    for axis in ["2", "1"]:
+        shift = ref["CRPIX"+axis] - hdr["CRPIX"+axis]
+        if abs(shift - round(shift)) > 1e-6:
+            raise ValueError("CRPIX{0}={1} is not a whole number of pixels from the mosaic grid".format(
+                             axis, hdr["CRPIX"+axis]))
+        offset.append(int(round(shift)))
+    return tuple(offset)
+
+
+def extent(headers, ref):
+    """The (y, x) first and last+1 pixels, on the grid with header ref, covered by the images with the given headers."""
+    starts = np.array([grid_offset(hdr, ref) for hdr in headers])
+    ends = starts + np.array([(hdr["NAXIS2"], hdr["NAXIS1"]) for hdr in headers])
+    return starts.min(axis=0), ends.max(axis=0)
+
+
+class Accumulator(object):
+    """Weighted sums of the snapshots and their PSF axes over the mosaic grid.
+
+    Each sum is a memmap in directory, so that a whole drift scan never has
+    to fit in memory. header is the WCS of the sums. An accumulator made by
+    open() is kept between runs, with a record of the snapshots added to it
+    (by obsid) and a copy of each, so that a mosaic can be brought up to
+    date by adding and taking out only the snapshots that have changed.
+    Its sums are double precision, since taking a snapshot out of float32
+    sums can leave errors of several percent where little weight is left.
+    """
+    def __init__(self, directory, header, shape, snapshots=None, mode="w+", dtype=np.float32):
+        self.directory = directory
+        self.header = header
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        self.snapshots = {} if snapshots is None else snapshots
+        self.sums = self._open(mode)
+
+    def _open(self, mode, shape=None, suffix=".npy"):
+        if mode == "r+":
+            return dict((name, np.lib.format.open_memmap(os.path.join(self.directory, name+suffix), mode=mode))
+                        for name, dtype in SUMS)
+        return dict((name, np.lib.format.open_memmap(os.path.join(self.directory, name+suffix), mode=mode,
+                                                     dtype=dtype or self.dtype, shape=shape or self.shape))
+                    for name, dtype in SUMS)
+
+    @classmethod
+    def covering(cls, directory, images, dtype=np.float32):
+        """An empty accumulator just big enough for the resampled snapshots."""
+        headers = check_grid(images)
+        start, end = extent(headers, headers[0])
+
+        header = WCS(headers[0]).celestial.to_header()
+        for key in COPY_KEYWORDS:
+            if key in headers[0]:
+                header[key] = headers[0][key]
+        header["CRPIX1"] -= start[1]
+        header["CRPIX2"] -= start[0]
+        return cls(directory, header, tuple(int(n) for n in end - start), dtype=dtype)
+
+    @classmethod
+    def open(cls, directory, images=()):
+        """The accumulator kept in directory, grown if need be to cover the resampled snapshots.
+
+        If there isn't one yet, a new one just big enough for them.
+        """
+        state = os.path.join(directory, STATE)
+        if not os.path.exists(state):
+            if not images:
+                raise ValueError("There is no accumulator in {0} yet and no snapshots to start one".format(directory))
+            if not os.path.exists(os.path.join(directory, SNAPSHOTS)):
+                os.makedirs(os.path.join(directory, SNAPSHOTS))
+            return cls.covering(directory, images, dtype=np.float64)
+        with open(state) as f:
+            state = json.load(f)
+        if state["updating"]:
+            raise ValueError("The accumulator in {0} was left part way through an update; "
+                             "remove it and make the mosaic from scratch".format(directory))
+        acc = cls(directory, fits.Header.fromstring(state["header"], sep="\n"), tuple(state["shape"]),
+                  state["snapshots"], mode="r+", dtype=state["dtype"])
+        acc.grow(images)
+        return acc
+
+    def save(self, updating=False):
+        """Record the grid and the snapshots added so far.
+
+        Call with updating before changing the sums, so that a run that dies
+        part way is not mistaken for a consistent accumulator.
+        """
+        state = {"header": self.header.tostring(sep="\n"), "shape": self.shape, "dtype": self.dtype.name,
+                 "snapshots": self.snapshots, "updating": updating}
+        # Written under a temporary name and then renamed, so there is always a whole state file
+        fd, tmp = tempfile.mkstemp(prefix="."+STATE, dir=self.directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f, indent=1)
+        os.rename(tmp, os.path.join(self.directory, STATE))
+
+    def grow(self, images):
+        """Make the sums bigger, if need be, to cover the resampled snapshots."""
+        if not images:
+            return
+        start, end = extent(check_grid(images, self.header), self.header)
+        start = np.minimum(start, 0)
+        end = np.maximum(end, self.shape)
+        shape = tuple(int(n) for n in end - start)
+        if shape == self.shape:
+            return
+        logger.info("Growing the accumulator from {0}x{1} to {2}x{3}".format(self.shape[1], self.shape[0],
+                                                                            shape[1], shape[0]))
+        sums = self._open("w+", shape=shape, suffix=".npy.new")
+        ny, nx = self.shape
+        y0, x0 = -start
+        rows = max(1, BLOCK_PIXELS//nx)
+        for name, old in self.sums.items():
+            for i in range(0, ny, rows):
+                sums[name][y0+i:y0+min(i+rows, ny), x0:x0+nx] = old[i:i+rows]
+            sums[name].flush()
+        del sums, old
+        self.sums = None
+        for name, dtype in SUMS:
+            os.rename(os.path.join(self.directory, name+".npy.new"), os.path.join(self.directory, name+".npy"))
+        self.header["CRPIX1"] -= start[1]
+        self.header["CRPIX2"] -= start[0]
+        self.shape = shape
+        self.sums = self._open("r+")
+
+    def add(self, image, weight, beam, sign=1):
+        """Add a resampled snapshot and its resampled weight map, with the PSF given by the
+        beam (ra0, dec0, bmaj, bmin, bpa) of its original image (see snapshot_beam).
+
+        Each is read once, a block of rows at a time. With sign=-1, take them out again.
+        """
+        ra0, dec0, bmaj, bmin, bpa = beam
+        with fits.open(image, memmap=True) as im, fits.open(weight, memmap=True) as wt:
+            hdr = im[0].header
+            data = np.squeeze(im[0].data)
+            weights = np.squeeze(wt[0].data)
+            y0, x0 = grid_offset(hdr, self.header)
+            nx = data.shape[1]
+            for start, stop, factors in dOmega_blocks(hdr, ra0, dec0):
+                x = data[start:stop]
+                w = weights[start:stop]
+                bmaj_map = bmaj * factors
+                # Pixels swarp would have left out of each co-addition
+                with np.errstate(invalid="ignore"):
+                    good = (w > 0) & np.isfinite(x)
+                    good_psf = (w > 0) & np.isfinite(bmaj_map)
+                block = (slice(y0 + start, y0 + stop), slice(x0, x0 + nx))
+                self.sums["weight"][block] += sign*np.where(good, w, 0.)
+                self.sums["image"][block] += sign*np.where(good, w*x, 0.)
+                self.sums["count"][block] += sign*good
+                w = np.where(good_psf, w, 0.)
+                self.sums["psfweight"][block] += sign*w
+                self.sums["bmaj"][block] += sign*np.where(good_psf, w*bmaj_map, 0.)
+                self.sums["bmin"][block] += sign*w*bmin
+                self.sums["bpa"][block] += sign*w*bpa
+                self.sums["psfcount"][block] += sign*good_psf
+                if sign < 0:
+                    # Leave exactly nothing, rather than rounding errors, where no snapshot is left
+                    for count, names in [("count", ["weight", "image"]),
+                                         ("psfcount", ["psfweight", "bmaj", "bmin", "bpa"])]:
+                        empty = self.sums[count][block] == 0
+                        for name in names:
+                            self.sums[name][block][empty] = 0.
+
+    def kept(self, obsid):
+        """Where the copies of a snapshot's resampled image and weight map are kept."""
+        path = os.path.join(self.directory, SNAPSHOTS, obsid)
+        return path+".fits", path+".weight.fits"
+
+    def fold_in(self, image, weight, original):
+        """Add a resampled snapshot to a kept accumulator, in place of any earlier version of it.
+
+        The resampled image and weight map are moved into the accumulator.
+        """
+        obsid = snapshot_id(original)
+        if obsid in self.snapshots:
+            self.retract(obsid)
+        beam = snapshot_beam(original)
+        kept_image, kept_weight = self.kept(obsid)
+        shutil.move(image, kept_image)
+        shutil.move(weight, kept_weight)
+        self.add(kept_image, kept_weight, beam)
+        self.snapshots[obsid] = {"original": original, "mtime": os.path.getmtime(original), "beam": list(beam)}
+
+    def retract(self, obsid):
+        """Take a snapshot back out of a kept accumulator."""
+        snapshot = self.snapshots.pop(obsid)
+        kept_image, kept_weight = self.kept(obsid)
+        self.add(kept_image, kept_weight, snapshot["beam"], sign=-1)
+        os.remove(kept_image)
+        os.remove(kept_weight)
+
+    def changes(self, originals):
+        """Which of the original snapshots are new or have changed since they were added, and
+        the obsids of the snapshots added that are no longer among them.
+        """
+        listed = set(snapshot_id(original) for original in originals)
+        new = [original for original in originals
+               if snapshot_id(original) not in self.snapshots
+               or os.path.getmtime(original) != self.snapshots[snapshot_id(original)]["mtime"]]
+        gone = sorted(obsid for obsid in self.snapshots if obsid not in listed)
+        return new, gone
+
+    def coverage(self):
+        """The (y slice, x slice) of the sums with any weight, found a block of rows at a time."""
+        ny, nx = self.shape
+        rows = max(1, BLOCK_PIXELS//nx)
+        covered_rows = np.zeros(ny, dtype=bool)
+        covered_cols = np.zeros(nx, dtype=bool)
+        for start in range(0, ny, rows):
+            covered = (self.sums["count"][start:start+rows] > 0) | (self.sums["psfcount"][start:start+rows] > 0)
+            covered_rows[start:start+rows] = covered.any(axis=1)
+            covered_cols |= covered.any(axis=0)
+        if not covered_rows.any():
+            raise ValueError("No pixel of the mosaic has any weight")
+        y = np.where(covered_rows)[0]
+        x = np.where(covered_cols)[0]
+        return slice(y[0], y[-1]+1), slice(x[0], x[-1]+1)
+
+    def write(self, outname, weightout=None, psfout=None):
+        """Write the weighted mean image and PSF cube, trimmed to the pixels with any weight,
+        in one pass over the sums.
+
+        Pixels without weight are 0, as swarp leaves them.
+        """
+        if weightout is None:
+            weightout = outname+".weight.fits"
+        if psfout is None:
+            psfout = outname+"_psfmap.fits"
+        ys, xs = self.coverage()
+        ny, nx = ys.stop - ys.start, xs.stop - xs.start
+        header = self.header.copy()
+        header["CRPIX1"] -= xs.start
+        header["CRPIX2"] -= ys.start
+
+        image = preallocate(outname+".fits", header, (ny, nx))
+        weight = preallocate(weightout, header, (ny, nx))
+        psf = preallocate(psfout, header, (3, ny, nx))
+        rows = max(1, BLOCK_PIXELS//nx)
+        for start in range(0, ny, rows):
+            stop = min(start + rows, ny)
+            block = (slice(ys.start + start, ys.start + stop), xs)
+            covered = self.sums["count"][block] > 0
+            w = np.where(covered, self.sums["weight"][block], 1.)
+            weight[start:stop] = np.where(covered, w, 0.)
+            image[start:stop] = np.where(covered, self.sums["image"][block]/w, 0.)
+            covered = self.sums["psfcount"][block] > 0
+            w = np.where(covered, self.sums["psfweight"][block], 1.)
+            for i, axis in enumerate(["bmaj", "bmin", "bpa"]):
+                psf[i, start:stop] = np.where(covered, self.sums[axis][block]/w, 0.)
+        for out in image, weight, psf:
+            out.flush()
+        del image, weight, psf
+
+
+def main():
+    """
+    """
+
+    ps = ArgumentParser(description="Co-add resampled snapshots, weighted by their weight maps, "
+                                    "into a mosaic and its PSF map in one pass. Replaces swarp "
+                                    "COMBINE_TYPE WEIGHTED for the image and psf_projected.py, the "
+                                    "BMAJ/BMIN/BPA co-additions and psf_combine_axes.py for the PSF map.")
+    ps.add_argument("images", type=str, nargs="?",
+                    help="Text file listing the resampled snapshots (swarp RESAMPLE output).")
+    ps.add_argument("weights", type=str, nargs="?",
+                    help="Text file listing their resampled weight maps, in the same order.")
+    ps.add_argument("originals", type=str, nargs="?",
+                    help="Text file listing the original snapshots in SIN projection, in the same "
+                         "order; used for the restoring beam and the original CRVAL1/CRVAL2.")
+    ps.add_argument("-o", "--outname", type=str, default=None,
+                    help="Writes OUTNAME.fits, OUTNAME_psfmap.fits and OUTNAME.weight.fits.")
+    ps.add_argument("--tmpdir", type=str, default=None,
+                    help="Directory to keep the weighted sums in while co-adding "
+                         "(default = a temporary directory next to the output).")
+    ps.add_argument("--accumulator", type=str, default=None,
+                    help="Keep the weighted sums in this directory between runs, and only add the "
+                         "snapshots listed, replacing any earlier version of the same obsid. "
+                         "The resampled snapshots are moved into it, so they can be taken out again.")
+    ps.add_argument("--retract", type=str, nargs="*", default=[],
+                    help="Obsids to take out of the accumulator.")
+    ps.add_argument("--status", type=str, default=None, metavar="ORIGINALS",
+                    help="Print which of the original snapshots listed in ORIGINALS are new or have "
+                         "changed since they were added to the accumulator ('add IMAGE'), which "
+                         "obsids in the accumulator are not listed any more ('retract OBSID') and "
+                         "the RA and Dec of the centre of its grid ('centre RA DEC'), and exit.")
+
+    args = ps.parse_args()
+
+    if args.status is not None:
+        if args.accumulator is None:
+            ps.error("--status needs --accumulator")
+        originals = read_list(args.status)
+        if os.path.exists(os.path.join(args.accumulator, STATE)):
+            acc = Accumulator.open(args.accumulator)
+            new, gone = acc.changes(originals)
+            # swarp puts CRVAL at the CENTER it is given, so this is the centre to resample
+            # new snapshots onto for them to land on the accumulator's grid
+            print("centre", repr(acc.header["CRVAL1"]), repr(acc.header["CRVAL2"]))
+        else:
+            new, gone = originals, []
+        for original in new:
+            print("add", original)
+        for obsid in gone:
+            print("retract", obsid)
+        return
+
+    if args.outname is None:
+        ps.error("-o/--outname is required")
+    lists = [args.images, args.weights, args.originals]
+    if None in lists:
+        if args.accumulator is None or lists != [None]*3:
+            ps.error("Give the image, weight and original lists")
+        images, weights, originals = [], [], []
+    else:
+        images, weights, originals = [read_list(l) for l in lists]
+    if not len(images) == len(weights) == len(originals):
+        ps.error("The image, weight and original lists are of different lengths ({0}, {1}, {2})".format(
+                 len(images), len(weights), len(originals)))
+
+    if args.accumulator is not None:
+        acc = Accumulator.open(args.accumulator, images)
+        acc.save(updating=True)
+        for obsid in args.retract:
+            if obsid in acc.snapshots:
+                logger.info("Taking out {0}".format(obsid))
+                acc.retract(obsid)
+            else:
+                logger.warning("{0} is not in the accumulator".format(obsid))
+        for image, weight, original in zip(images, weights, originals):
+            logger.info("Adding {0}".format(image))
+            acc.fold_in(image, weight, original)
+        acc.save()
+        logger.info("{0} snapshots in the accumulator".format(len(acc.snapshots)))
+        acc.write(args.outname)
+        return
+
+    tmpdir = tempfile.mkdtemp(prefix=os.path.basename(args.outname)+"_coadd_",
+                              dir=args.tmpdir or os.path.dirname(os.path.abspath(args.outname)))
+    try:
+        acc = Accumulator.covering(tmpdir, images)
+        logger.info("Co-adding {0} snapshots onto a {1}x{2} grid".format(len(images), acc.shape[1], acc.shape[0]))
+        for image, weight, original in zip(images, weights, originals):
+            logger.info("Adding {0}".format(image))
+            acc.add(image, weight, snapshot_beam(original))
+        acc.write(args.outname)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
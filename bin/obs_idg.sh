@@ -140,13 +140,8 @@ error=`echo ${error} | sed "s/%A/${jobid}/"`
 output=`echo ${output} | sed "s/%A/${jobid}/"`
 
 # record submission
-n=1
-for obsnum in $list
-do
-    python ${dbdir}/bin/track_task.py queue --jobid=${jobid} --taskid=${n} --task='idg' --submission_time=`date +%s` --batch_file=${main_script} \
-                     --obs_id=${obsnum} --stderr=${error} --stdout=${output}
-    ((n+=1))
-done
+python ${dbdir}/bin/track_task.py queue --jobid=${jobid} --taskid=1 --task='idg' --submission_time=`date +%s` --batch_file=${main_script} \
+                     --obs_id ${list} --stderr=${error} --stdout=${output}
 
 echo "Submitted ${srun_script} and ${main_script} as ${jobid}. Follow progress here:"
 echo $output
@@ -213,13 +213,8 @@ prep_error=`echo ${prep_error} | sed "s/%A/${jobid}/"`
 prep_output=`echo ${prep_output} | sed "s/%A/${jobid}/"`
 
 # record submission
-n=1
-for obsnum in $list
-do
-    python ${dbdir}/bin/track_task.py queue --jobid=${jobid} --taskid=${n} --task='prep_idg' --submission_time=`date +%s` --batch_file=${main_script} \
-                     --obs_id=${obsnum} --stderr=${prep_error} --stdout=${prep_output}
-    ((n+=1))
-done
+python ${dbdir}/bin/track_task.py queue --jobid=${jobid} --taskid=1 --task='prep_idg' --submission_time=`date +%s` --batch_file=${main_script} \
+                     --obs_id ${list} --stderr=${prep_error} --stdout=${prep_output}
 
 sub_wrap="sbatch -M ${prep_computer} --depend=afterok:${jobid} ${wrap_script}"
 wrapid=($(${sub_wrap}))
@@ -157,13 +157,8 @@ error=`echo ${error} | sed "s/%A/${jobid}/"`
 output=`echo ${output} | sed "s/%A/${jobid}/"`
 
 # record submission
-n=1
-for obsnum in $dllist
-do
-    python ${dbdir}/bin/track_task.py queue --jobid=${jobid} --taskid=${n} --task='download' --submission_time=`date +%s` --batch_file=${script} \
-                     --obs_id=${obsnum} --stderr=${error} --stdout=${output}
-    ((n+=1))
-done
+python ${dbdir}/bin/track_task.py queue --jobid=${jobid} --taskid=1 --task='download' --submission_time=`date +%s` --batch_file=${script} \
+                     --obs_id ${dllist} --stderr=${error} --stdout=${output}
 
 echo "Submitted ${script} as ${jobid}. Follow progress here:"
 echo $output
@@ -8,10 +8,11 @@ from astropy import wcs
 import astropy.units as u
 
 import numpy as np
+from scipy.interpolate import RectBivariateSpline
 
 import os
 import sys
-import glob
+import multiprocessing
 
 import matplotlib
 matplotlib.use('Agg') # Avoid using the display on supercomputers
@@ -20,66 +21,22 @@ import matplotlib.cm as cm
 
 import argparse
 
-parser = argparse.ArgumentParser()
-group1 = parser.add_argument_group("Input files")
-group1.add_argument('--filelist',dest="filelist",default=None,
-                  help="List of files to use (text file, single column) \
-                        Expecting a list of fits files to change, and will \
-                        search for associated _comp_matched files with the \
-                        source-finding results, and also the <obsid>.metafits")
-group1.add_argument('--skymodel',dest="skymodel",default=None,
-                  help="Sky model to cross-match to (no default)")
-group2 = parser.add_argument_group("Control options")
-group2.add_argument('--nsrc',dest="nsrc",default=10000,type=int,
-                  help="Number of sources to use for the polynomial fit (default=10000)")
-group2.add_argument('--threshold',dest="SNR_threshold",default=None,type=int,
-                  help="Alternatively, set a S/N threshold for sources used for \
-                        the polynomial fit (will override --nsrc if set)")
-group2.add_argument('--order',dest="poly_order",default=5,type=int,
-                  help="Set the order of the polynomial fit. (default = 5)")
-group2.add_argument('--ra',action="store_true",dest="correct_ra",default=False,
-                  help="Measure and correct any RA-offset dependence? (default = False)")
-group3 = parser.add_argument_group("Creation of output files")
-group3.add_argument('--plot',action="store_true",dest="make_plots",default=False,
-                  help="Make fit plots? (default = False)")
-group3.add_argument('--rescale',action="store_true",dest="do_rescale",default=False,
-                  help="Generate rescaled fits files? (default = False)")
-group3.add_argument('--correctall',action="store_true",dest="correct_all",default=False,
-                  help="Correct associated background, RMS, and weight maps? (default = False)")
-group3.add_argument('--overwrite',action="store_true",dest="overwrite",default=False,
-                  help="Overwrite existing rescaled fits files? (default = False)")
-group3.add_argument('--read',action="store_true",dest="read_coefficients",default=False,
-                    help="Read coefficients from file? (default = False)")
-group3.add_argument('--write',action="store_true",dest="write_coefficients",default=False,
-                    help="Write coefficients to file? (default = False)")
-results = parser.parse_args()
-
-if os.path.exists(results.filelist):
-    f = open(results.filelist, 'r+')
-    infiles = [line.rstrip() for line in f.readlines()]
-    f.close()
-    concat_table = results.filelist.replace(".txt", "_concat.fits")
-    title = results.filelist.replace(".txt","")
-    dec_plot = results.filelist.replace(".txt", "_fitted_dec_poly.png")
-    dec_corrected_plot = results.filelist.replace(".txt", "_corrected_dec_poly.png")
-    if results.correct_ra is True:
-        ra_plot = results.filelist.replace(".txt", "_fitted_ra_poly.png")
-        ra_corrected_plot = results.filelist.replace(".txt", "_corrected_ra_poly.png")
-# TODO: Replace these with database calls?
-    if results.write_coefficients is True or results.read_coefficients is True:
-        dec_coeff = results.filelist.replace(".txt", "_dec_coefficients.csv")
-        if results.correct_ra is True:
-            ra_coeff = results.filelist.replace(".txt", "_ra_coefficients.csv")
-else:
-    print(results.filelist)
-    print("Must specify a list of files to read!")
-    sys.exit(1)
-
-def sigma_clip(ratios, n=1):
-    median = np.median(ratios)
-    std = np.nanstd(ratios)
-    ind = np.intersect1d(np.where(ratios > median-n*std), np.where(ratios < median + n*std))
-    return ind
+from sky_match import SkyIndex, match_catalogues
+from catalogue_accumulator import CatalogueAccumulator
+from robust_polyfit import robust_polyfit, sigma_clip_mask, top_n_threshold, normal_equations, solve_snapshot_fit
+from metafits_cache import MetafitsCache, find_metafits, metafits_value
+from snapshot_stats import SnapshotStatsStore, snapshot_key
+
+# Rough number of bytes needed per pixel while rescaling an image: pixel
+# coordinates, world coordinates, correction factors and wcslib workspace
+BYTES_PER_PIXEL = 160
+
+# Maximum separation (arcsec) when cross-matching with the sky model
+MATCH_RADIUS = 45.
+
+# Columns accumulated from the cross-matched catalogue of every snapshot
+SNAPSHOT_COLUMNS = ["RAJ2000", "RA_offset", "DEJ2000", "int_flux", "S_200", "alpha", "log10ratio", "local_rms"]
+
 
 def make_plot(x, y, w, model, title, ylabel, outname):
     figsize = (6,6)
@@ -109,23 +66,200 @@ def zmodel(x):
            output_file.write("#obsid,median,peak,std\n")
            output_file.write(outformat.format(*outvars))
 
-if results.read_coefficients is True:
-    P_dec = np.loadtxt(dec_coeff, delimiter=",")
-    decmodel = np.poly1d(P_dec)
-    if results.correct_ra is True:
-        P_ra = np.loadtxt(ra_coeff, delimiter=",")
-        ramodel = np.poly1d(P_ra)
-else:
-    logratios = np.empty(0)
-    int_fluxes = np.empty(0)
-    local_rmses = np.empty(0)
-    S200s = np.empty(0)
-    alphas = np.empty(0)
-    ras = np.empty(0)
-    ra_offs = np.empty(0)
-    decs = np.empty(0)
-
-    for fitsimage in infiles:
+def poly_log_correction(P, x):
+    """Evaluate a polynomial fitted to the log10 ratios."""
+    order = len(P) - 1
+    corr = np.zeros(np.shape(x))
+    for i in range(0, order+1):
+        corr += P[i]*pow(x, order-i)
+    return corr
+
+def poly_correction(P, x):
+    """Evaluate a log10 polynomial correction and return the raw correction factor.
+
+    We generated log10 ratios so use 10^ to get back to raw correction
+    e.g. a 4th order polynomial would look like:
+    corr = 10** ( a*(Dec)^3 + b*(Dec)^2 + c*Dec + d)
+    """
+    return 10**poly_log_correction(P, x)
+
+def tile_rows(nx, memory):
+    """Number of image rows that can be rescaled at once within a memory budget (MB)."""
+    return max(1, int(memory*1024*1024 // (BYTES_PER_PIXEL*nx)))
+
+def correction_tile(w, nx, y0, y1, P_dec, P_ra=None, ra_cent=None):
+    """Calculate the correction factors for image rows y0 to y1."""
+    x = np.tile(np.arange(nx), y1-y0)
+    y = np.repeat(np.arange(y0, y1), nx)
+    ra, dec = w.wcs_pix2world(x, y, 1)
+    corr = poly_correction(P_dec, dec)
+    if P_ra is not None:
+        corr = corr * poly_correction(P_ra, ra-ra_cent)
+    return corr.reshape(y1-y0, nx)
+
+def pixel_log_correction(w, x, y, P_dec, P_ra=None, ra_cent=None):
+    """Calculate the log10 correction at arbitrary (fractional) pixel positions."""
+    ra, dec = w.wcs_pix2world(x, y, 1)
+    logcorr = poly_log_correction(P_dec, dec)
+    if P_ra is not None:
+        logcorr += poly_log_correction(P_ra, ra-ra_cent)
+    return logcorr
+
+def control_points(n, step):
+    """Pixel indices every step pixels along an axis of length n, always including both ends."""
+    points = np.arange(0, n, step)
+    if points[-1] != n-1:
+        points = np.append(points, n-1)
+    return points
+
+def correction_grid(w, ny, nx, P_dec, P_ra=None, ra_cent=None, step=64, tolerance=1.e-4):
+    """Interpolate the log10 correction from a coarse grid of control points.
+
+    The correction is evaluated exactly on a grid of control points every
+    step pixels and a bicubic spline is fitted through them. The spline is
+    checked against the exact correction at the centre of every grid cell and
+    the middle of every cell edge, where it is furthest from the control
+    points, and the grid is refined until the largest error there is below
+    tolerance (in log10 ratio). Errors elsewhere are not checked.
+
+    Returns the spline, or None if no grid meets the tolerance, in which case
+    the exact per-pixel correction should be used instead.
+    """
+    while step >= 2:
+        xs = control_points(nx, step)
+        ys = control_points(ny, step)
+        if len(xs) < 4 or len(ys) < 4:
+            step //= 2
+            continue
+        gx, gy = np.meshgrid(xs, ys)
+        grid = pixel_log_correction(w, gx.ravel(), gy.ravel(), P_dec, P_ra, ra_cent).reshape(gx.shape)
+        if not np.all(np.isfinite(grid)):
+        # e.g. pixels off the edge of the sky; the spline can't be trusted
+            return None
+        spline = RectBivariateSpline(ys, xs, grid, kx=3, ky=3)
+        # The control points and the points half way between them; the spline is exact at the former
+        mx, my = np.meshgrid(np.union1d(xs, (xs[:-1]+xs[1:])/2.), np.union1d(ys, (ys[:-1]+ys[1:])/2.))
+        exact = pixel_log_correction(w, mx.ravel(), my.ravel(), P_dec, P_ra, ra_cent)
+        error = np.max(np.abs(spline.ev(my.ravel(), mx.ravel()) - exact))
+        if error < tolerance:
+            print("Correction grid with {0}-pixel spacing has maximum log10 error {1:.2e}".format(step, error))
+            return spline
+        step //= 2
+    return None
+
+def create_fits(outfits, header):
+    """Create a float32 FITS image on disk without holding its data in memory."""
+    header = header.copy()
+    header["BITPIX"] = -32
+    for key in ["BSCALE", "BZERO"]:
+        if key in header:
+            del header[key]
+    nbytes = 4
+    for i in range(1, header["NAXIS"]+1):
+        nbytes *= header["NAXIS{0}".format(i)]
+    header.tofile(outfits, overwrite=True)
+    with open(outfits, "rb+") as fobj:
+        fobj.seek(len(header.tostring()) + int(np.ceil(nbytes / 2880.))*2880 - 1)
+        fobj.write(b"\0")
+
+def rescale_image(infits, outfits, P_dec, P_ra=None, memory=1024, gridstep=None, tolerance=1.e-4, grids=None):
+    """Apply the Dec (and optionally RA-offset) correction to an image, one tile of rows at a time.
+
+    The output is written through a memory-mapped HDU so the peak memory use
+    is set by the memory budget (MB) rather than the size of the image.
+
+    If gridstep is set, the correction is interpolated from a coarse grid of
+    control points (see correction_grid) instead of being calculated for
+    every pixel. Grids are stored in the grids dictionary, keyed on the WCS,
+    image size and correction, so that maps which share them only compute one grid.
+    """
+    hdu_in = fits.open(infits, memmap=True)
+    # wcs in format [stokes,freq,y,x]; stokes and freq are length 1 if they exist
+    w = wcs.WCS(hdu_in[0].header, naxis=2)
+    data = hdu_in[0].data
+    ny, nx = data.shape[-2:]
+    # going to need the RA in order to calculate the RA offsets
+    if P_ra is not None:
+        ra_cent = metafits_value(find_metafits(infits), "RA")
+    else:
+        ra_cent = None
+    spline = None
+    if gridstep is not None:
+        if grids is None:
+            grids = {}
+        key = (ny, nx, w.to_header_string(), tuple(P_dec),
+               None if P_ra is None else tuple(P_ra), ra_cent)
+        if key not in grids:
+            grids[key] = correction_grid(w, ny, nx, P_dec, P_ra, ra_cent, step=gridstep, tolerance=tolerance)
+        spline = grids[key]
+        if spline is None:
+            print("No correction grid met the tolerance for {0}; calculating every pixel".format(infits))
+    create_fits(outfits, hdu_in[0].header)
+    hdu_out = fits.open(outfits, mode="update", memmap=True)
+    step = tile_rows(nx, memory)
+    for y0 in range(0, ny, step):
+        y1 = min(y0+step, ny)
+        if spline is None:
+            corr = correction_tile(w, nx, y0, y1, P_dec, P_ra, ra_cent)
+        else:
+            corr = 10**spline(np.arange(y0, y1), np.arange(nx))
+        hdu_out[0].data[..., y0:y1, :] = np.array(corr*data[..., y0:y1, :], dtype=np.float32)
+    hdu_out.close()
+    hdu_in.close()
+
+def rescale_catalogue(infits, outfits, P_dec):
+    """Apply the Dec correction to the flux density columns of a source-finding catalogue."""
+    hdu_in = fits.open(infits)
+    cat = hdu_in[1].data
+    dec_corr = poly_correction(P_dec, cat["dec"])
+    # Obviously only modify columns which use the flux density
+    cols = ["background", "local_rms", "peak_flux", "err_peak_flux", "int_flux", "err_int_flux", "residual_mean", "residual_std"]
+    for col in cols:
+        cat[col] *= dec_corr
+    hdu_in.writeto(outfits, overwrite=True)
+    hdu_in.close()
+
+def rescale_file(infits, outfits, P_dec, P_ra, options, grids):
+    """Rescale a single image or source-finding catalogue.
+
+    Returns None on success or a description of the failure.
+    """
+    try:
+        if fits.getheader(infits)["NAXIS"] == 0:
+    # Then it is a source-finding catalogue not an image
+            rescale_catalogue(infits, outfits, P_dec)
+        else:
+            rescale_image(infits, outfits, P_dec, P_ra, grids=grids, **options)
+    except Exception as e:
+        # Don't leave a partial output that a later run would take as done
+        if os.path.exists(outfits):
+            os.remove(outfits)
+        return "{0}: {1}".format(type(e).__name__, e)
+    return None
+
+def rescale_snapshot(task):
+    """Rescale the images and catalogue of one snapshot, which share its correction grid.
+
+    Takes a tuple of (files, P_dec, P_ra, options), where files is a list of
+    (infits, outfits), so that it can be mapped over a process pool, and
+    returns a list of (outfits, error), where error is None on success or a
+    description of the failure.
+    """
+    files, P_dec, P_ra, options = task
+    grids = {}
+    return [(outfits, rescale_file(infits, outfits, P_dec, P_ra, options, grids)) for infits, outfits in files]
+
+class SkyModelMatcher(object):
+    """Find the cross-matched catalogue of each snapshot, making it if necessary.
+
+    The sky model is only read and indexed if there is something to cross-match.
+    """
+    def __init__(self, skymodel_file):
+        self.skymodel_file = skymodel_file
+        self.skymodel = None
+        self.index = None
+
+    def matched_catalogue(self, fitsimage):
         sf = fitsimage.replace(".fits", "_comp.fits")
         sfm = fitsimage.replace(".fits", "_comp_matched.fits")
     # Cross-match with a sky model to get model flux densities
@@ -134,201 +268,356 @@ else:
             if not os.path.exists(sf):
                 print("Source-finding results for {0} not found".format(fitsimage))
                 sys.exit(1)
-            os.system("stilts tmatch2 \
-            values1=\"RAJ2000 DEJ2000\" \
-            values2=\"ra dec\" \
-            in1={0} in2={1} \
-            matcher=sky params=45 \
-            out={2}".format(results.skymodel, sf, sfm))
-        gpstime = Time(int(fitsimage[0:10]), format="gps")
-    # We get this from the FITS image rather than the metafits because I make sub-band images
-        hdr = fits.getheader(fitsimage)
-        centfreq = hdr["CRVAL3"] / 1.e6 #MHz
-    # But the metafits is better for the RA, because of the denormal projection
-        path, _ = os.path.split(fitsimage)
-        metafits = glob.glob("{0}/{1}*metafits*".format(path, fitsimage[0:10]))
-        metafits = metafits[0]
-        meta = fits.getheader(metafits)
-        ra_cent = meta["RA"]
-    # Get the cross-matched catalogue
-        hdu = fits.open(sfm)
-        cat = hdu[1].data
-    # RA offsets and Decs
-        ras = np.append(ras, cat["RAJ2000"])
-        ra_offs = np.append(ra_offs, cat["RAJ2000"] - ra_cent*np.ones(len(cat["RAJ2000"])))
-        decs = np.append(decs, cat["DEJ2000"])
-    # Flux densities
-        int_fluxes = np.append(int_fluxes, cat["int_flux"])
-        S200s = np.append(S200s, cat["S_200"])
-        alphas = np.append(alphas, cat["alpha"])
-        logratios = np.append(logratios, np.log10(cat["S_200"]*(centfreq/200.)**cat["alpha"]/cat["int_flux"]))
-        local_rmses = np.append(local_rmses, cat["local_rms"])
-
-    # sigma-clip to get rid of crazy values
-    ind = sigma_clip(logratios, 3)
-    median = np.median(logratios[ind])
-    std = np.nanstd(logratios[ind])
-    vmin = median - std
-    vmax = median + std
-
-    h = ra_offs[ind]
-    a = ras[ind]
-    d = decs[ind]
-    c = logratios[ind]
-    f = int_fluxes[ind]
-    r = local_rmses[ind]
-    S200 = S200s[ind]
-    alpha = alphas[ind]
-
-    # Get the highest S/N measurements
-    if results.SNR_threshold is None:
-        SNR = sorted(f /r, reverse=True)
-        threshold = SNR[results.nsrc]
+            if self.index is None:
+                if self.skymodel_file is None or not os.path.exists(str(self.skymodel_file)):
+                    print("Must specify a sky model to cross-match {0} to!".format(sf))
+                    sys.exit(1)
+                self.skymodel = Table.read(self.skymodel_file)
+                self.index = SkyIndex(self.skymodel["RAJ2000"], self.skymodel["DEJ2000"])
+            match_catalogues(self.index, self.skymodel, Table.read(sf), MATCH_RADIUS, outfile=sfm)
+        return sfm
+
+def snapshot_normal_equations(sfm, centfreq, ra_cent, threshold, order):
+    """Normal equations of a single snapshot's contribution to the Dec and RA-offset fits.
+
+    Sources are selected snapshot by snapshot, so this only approximates the
+    full fit: outliers are sigma-clipped against the snapshot's own log10
+    ratios, the S/N threshold is fixed, and the fit residuals are not clipped.
+    Returns the matrix and the number of sources in it.
+    """
+    with fits.open(sfm, memmap=True) as hdulist:
+        cat = hdulist[1].data
+        d = np.array(cat["DEJ2000"], dtype=np.float64)
+        h = cat["RAJ2000"] - ra_cent
+        c = np.log10(cat["S_200"]*(centfreq/200.)**cat["alpha"]/cat["int_flux"])
+        snr = cat["int_flux"]/cat["local_rms"]
+    good = sigma_clip_mask(c, 3) & (snr > threshold)
+    return normal_equations([d[good], h[good]], c[good], snr[good], order), int(good.sum())
+
+def incremental_fit(infiles, matcher, store_file, threshold, order, joint=False):
+    """Fit the Dec and RA-offset polynomials from stored per-snapshot normal equations.
+
+    Only snapshots that are missing from the store, or whose cross-matched
+    catalogues have changed, are read; the rest cost nothing. Returns the
+    list of [P_dec, P_ra] coefficients.
+    """
+    store = SnapshotStatsStore(store_file)
+    M = np.zeros((2*(order+1)+1, 2*(order+1)+1))
+    stale = []
+    for fitsimage in infiles:
+        obsid, subband = snapshot_key(fitsimage)
+        sfm = matcher.matched_catalogue(fitsimage)
+        normal = store.get(obsid, subband, sfm, order, threshold)
+        if normal is None:
+            stale.append((fitsimage, sfm, obsid, subband))
+        else:
+            M += normal
+    if len(stale) > 0:
+        meta = MetafitsCache().lookup([find_metafits(s[0]) for s in stale], keys=["RA"])
+        for (fitsimage, sfm, obsid, subband), m in zip(stale, meta):
+            centfreq = fits.getheader(fitsimage)["CRVAL3"] / 1.e6 #MHz
+            normal, nsrc = snapshot_normal_equations(sfm, centfreq, m["RA"], threshold, order)
+            store.put(obsid, subband, sfm, order, threshold, nsrc, normal)
+            M += normal
+    store.close()
+    print("Read {0} of {1} snapshots; the rest were already in {2}".format(len(stale), len(infiles), store_file))
+    return solve_snapshot_fit(M, order, joint)
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    group1 = parser.add_argument_group("Input files")
+    group1.add_argument('--filelist',dest="filelist",default=None,
+                      help="List of files to use (text file, single column) \
+                            Expecting a list of fits files to change, and will \
+                            search for associated _comp_matched files with the \
+                            source-finding results, and also the <obsid>.metafits")
+    group1.add_argument('--skymodel',dest="skymodel",default=None,
+                      help="Sky model to cross-match to (no default)")
+    group2 = parser.add_argument_group("Control options")
+    group2.add_argument('--nsrc',dest="nsrc",default=10000,type=int,
+                      help="Number of sources to use for the polynomial fit (default=10000)")
+    group2.add_argument('--threshold',dest="SNR_threshold",default=None,type=int,
+                      help="Alternatively, set a S/N threshold for sources used for \
+                            the polynomial fit (will override --nsrc if set)")
+    group2.add_argument('--order',dest="poly_order",default=5,type=int,
+                      help="Set the order of the polynomial fit. (default = 5)")
+    group2.add_argument('--ra',action="store_true",dest="correct_ra",default=False,
+                      help="Measure and correct any RA-offset dependence? (default = False)")
+    group2.add_argument('--maxiter',dest="maxiter",default=1,type=int,
+                      help="Maximum number of times to sigma-clip outliers and re-fit (default = 1)")
+    group2.add_argument('--joint',action="store_true",dest="joint",default=False,
+                      help="Fit the Dec and RA-offset polynomials together in one least-squares \
+                            solve? Requires --ra (default = False)")
+    group2.add_argument('--threads',dest="threads",default=1,type=int,
+                      help="Number of threads used to read the cross-matched catalogues (default = 1)")
+    group2.add_argument('--incremental',dest="incremental",default=None,
+                      help="Fit from the normal equations of each snapshot, stored in this file and \
+                            only recalculated for new or changed snapshots. Requires --threshold; \
+                            the sigma-clipping is done per snapshot, so this approximates the full \
+                            fit, and no table or plots are made (default = None)")
+    group2.add_argument('--verify',action="store_true",dest="verify",default=False,
+                      help="With --incremental, also do the full fit, report how much the two differ, \
+                            and use the full fit (default = False)")
+    group3 = parser.add_argument_group("Creation of output files")
+    group3.add_argument('--plot',action="store_true",dest="make_plots",default=False,
+                      help="Make fit plots? (default = False)")
+    group3.add_argument('--rescale',action="store_true",dest="do_rescale",default=False,
+                      help="Generate rescaled fits files? (default = False)")
+    group3.add_argument('--correctall',action="store_true",dest="correct_all",default=False,
+                      help="Correct associated background, RMS, and weight maps? (default = False)")
+    group3.add_argument('--overwrite',action="store_true",dest="overwrite",default=False,
+                      help="Overwrite existing rescaled fits files? (default = False)")
+    group3.add_argument('--read',action="store_true",dest="read_coefficients",default=False,
+                        help="Read coefficients from file? (default = False)")
+    group3.add_argument('--write',action="store_true",dest="write_coefficients",default=False,
+                        help="Write coefficients to file? (default = False)")
+    group3.add_argument('--memory',dest="memory",default=1024,type=float,
+                        help="Memory budget for rescaling each image, in MB (default = 1024)")
+    group3.add_argument('--fast',action="store_true",dest="fast",default=False,
+                        help="Interpolate the correction from a coarse grid of control points \
+                              instead of calculating it for every pixel (default = False)")
+    group3.add_argument('--gridstep',dest="gridstep",default=64,type=int,
+                        help="Starting spacing of the control points in pixels when using --fast (default = 64)")
+    group3.add_argument('--tolerance',dest="tolerance",default=1.e-4,type=float,
+                        help="Maximum error in log10 ratio allowed when using --fast (default = 1e-4)")
+    group3.add_argument('--workers',dest="workers",default=1,type=int,
+                        help="Number of processes used to rescale files in parallel (default = 1)")
+    results = parser.parse_args()
+
+    if os.path.exists(results.filelist):
+        f = open(results.filelist, 'r+')
+        infiles = [line.rstrip() for line in f.readlines()]
+        f.close()
+        concat_table = results.filelist.replace(".txt", "_concat.fits")
+        title = results.filelist.replace(".txt","")
+        dec_plot = results.filelist.replace(".txt", "_fitted_dec_poly.png")
+        dec_corrected_plot = results.filelist.replace(".txt", "_corrected_dec_poly.png")
+        if results.correct_ra is True:
+            ra_plot = results.filelist.replace(".txt", "_fitted_ra_poly.png")
+            ra_corrected_plot = results.filelist.replace(".txt", "_corrected_ra_poly.png")
+    # TODO: Replace these with database calls?
+        if results.write_coefficients is True or results.read_coefficients is True:
+            dec_coeff = results.filelist.replace(".txt", "_dec_coefficients.csv")
+            if results.correct_ra is True:
+                ra_coeff = results.filelist.replace(".txt", "_ra_coefficients.csv")
     else:
-        threshold = results.SNR_threshold
-
-    good = np.where(f / r > threshold)
-
-    P, res, rank, sv, cond = np.polyfit(np.array(d[good]), np.array(c[good]), results.poly_order, full=True, w = f[good]/r[good])
-    decmodel = np.poly1d(P)
+        print(results.filelist)
+        print("Must specify a list of files to read!")
+        sys.exit(1)
 
-    # Remove outliers
-    model_subtracted = c[good] - decmodel(d[good])
-    indices = sigma_clip(model_subtracted, 3)
+    if results.joint is True and results.correct_ra is not True:
+        print("--joint fits the Dec and RA offsets together, so requires --ra")
+        sys.exit(1)
 
-    # Re-fit model
-    P_dec,res,rank,sv,cond = np.polyfit(np.array(d[good][indices]),np.array(c[good][indices]), results.poly_order, full=True, w = f[good][indices]/r[good][indices])
-    decmodel = np.poly1d(P_dec)
+    if results.incremental is not None and results.SNR_threshold is None:
+        print("--incremental selects sources snapshot by snapshot, so requires --threshold")
+        sys.exit(1)
 
-    if results.write_coefficients is True:
-        np.savetxt(dec_coeff, P_dec, delimiter=",", header = "Order-{0} polynomial fit coefficients".format(results.poly_order))
+    matcher = SkyModelMatcher(results.skymodel)
 
-    # Now that we have accumulated Dec, apply the polynomials to the concatenated catalogue, and then fit over RA
-    new_int_fluxes = int_fluxes * 10**(decmodel(decs))
-    new_logratios = np.log10(S200s*(centfreq/200.)**alphas / new_int_fluxes)
-
-    new_f = new_int_fluxes[ind]
-    new_c = new_logratios[ind]
+    if results.read_coefficients is True:
+        P_dec = np.loadtxt(dec_coeff, delimiter=",")
+        decmodel = np.poly1d(P_dec)
+        if results.correct_ra is True:
+            P_ra = np.loadtxt(ra_coeff, delimiter=",")
+            ramodel = np.poly1d(P_ra)
+    elif results.incremental is not None:
+        P_dec, P_ra = incremental_fit(infiles, matcher, results.incremental, float(results.SNR_threshold),
+                                      results.poly_order, results.joint)
+        if results.write_coefficients is True and results.verify is not True:
+            np.savetxt(dec_coeff, P_dec, delimiter=",", header = "Order-{0} polynomial fit coefficients".format(results.poly_order))
+            if results.correct_ra is True:
+                np.savetxt(ra_coeff, P_ra, delimiter=",", header = "Order-{0} polynomial fit coefficients".format(results.poly_order))
+
+    if results.read_coefficients is not True and (results.incremental is None or results.verify is True):
+        if results.incremental is not None:
+            P_incremental = [P_dec, P_ra]
+
+        matched = []
+        centfreqs = []
+        for fitsimage in infiles:
+            matched.append(matcher.matched_catalogue(fitsimage))
+            gpstime = Time(int(fitsimage[0:10]), format="gps")
+        # We get this from the FITS image rather than the metafits because I make sub-band images
+            hdr = fits.getheader(fitsimage)
+            centfreq = hdr["CRVAL3"] / 1.e6 #MHz
+            centfreqs.append(centfreq)
+        # But the metafits is better for the RA, because of the denormal projection
+        meta = MetafitsCache().lookup([find_metafits(fitsimage) for fitsimage in infiles], keys=["RA"])
+        ra_cents = [m["RA"] for m in meta]
+
+        def snapshot_columns(k, cat):
+            return {"RAJ2000": cat["RAJ2000"],
+                    "RA_offset": cat["RAJ2000"] - ra_cents[k]*np.ones(len(cat["RAJ2000"])),
+                    "DEJ2000": cat["DEJ2000"],
+                    "int_flux": cat["int_flux"],
+                    "S_200": cat["S_200"],
+                    "alpha": cat["alpha"],
+                    "log10ratio": np.log10(cat["S_200"]*(centfreqs[k]/200.)**cat["alpha"]/cat["int_flux"]),
+                    "local_rms": cat["local_rms"]}
+
+        # Get the cross-matched catalogues
+        snapshots = CatalogueAccumulator(matched, SNAPSHOT_COLUMNS)
+        snapshots.read_all(derive=snapshot_columns, threads=results.threads)
+        # RA offsets and Decs
+        ras = snapshots["RAJ2000"]
+        ra_offs = snapshots["RA_offset"]
+        decs = snapshots["DEJ2000"]
+        # Flux densities
+        int_fluxes = snapshots["int_flux"]
+        S200s = snapshots["S_200"]
+        alphas = snapshots["alpha"]
+        logratios = snapshots["log10ratio"]
+        local_rmses = snapshots["local_rms"]
+
+        # sigma-clip to get rid of crazy values
+        ind = sigma_clip_mask(logratios, 3)
+        median = np.median(logratios[ind])
+        std = np.nanstd(logratios[ind])
+        vmin = median - std
+        vmax = median + std
+
+        h = ra_offs[ind]
+        a = ras[ind]
+        d = decs[ind]
+        c = logratios[ind]
+        f = int_fluxes[ind]
+        r = local_rmses[ind]
+        S200 = S200s[ind]
+        alpha = alphas[ind]
+
+        # Get the highest S/N measurements
+        if results.SNR_threshold is None:
+            threshold = top_n_threshold(f / r, results.nsrc)
+        else:
+            threshold = results.SNR_threshold
 
-    if results.correct_ra is True:
-        P_ra, res, rank, sv,cond = np.polyfit(np.array(h[good]),np.array(new_c[good]), results.poly_order, full=True, w = f[good]/r[good])
-        ramodel = np.poly1d(P_ra)
+        good = f / r > threshold
 
-        model_subtracted = new_c[good] - ramodel(h[good])
-        indices = sigma_clip(model_subtracted, 3)
+        if results.joint is True:
+        # Fit Dec and RA offset together, then correct in the same two steps as below
+            (P_dec, P_ra), indices = robust_polyfit([d[good], h[good]], c[good], f[good]/r[good],
+                                                    results.poly_order, 3, results.maxiter)
+        else:
+            (P_dec,), indices = robust_polyfit([d[good]], c[good], f[good]/r[good],
+                                               results.poly_order, 3, results.maxiter)
+        decmodel = np.poly1d(P_dec)
 
-        # Re-fit model
-        P_ra, res, rank, sv,cond = np.polyfit(np.array(h[good][indices]),np.array(new_c[good][indices]), results.poly_order, full=True, w = f[good][indices]/r[good][indices])
-        ramodel = np.poly1d(P_ra)
         if results.write_coefficients is True:
-            np.savetxt(ra_coeff, P_ra, delimiter=",", header = "Order-{0} polynomial fit coefficients".format(results.poly_order))
-
-        final_int_fluxes = new_int_fluxes * 10**(ramodel(ra_offs))
-        final_logratios = np.log10(S200s*(centfreq/200.)**alphas / final_int_fluxes)
-
-        final_f = final_int_fluxes[ind]
-        final_c = final_logratios[ind]
-    else:
-        final_c = new_c
-        final_f = new_f
+            np.savetxt(dec_coeff, P_dec, delimiter=",", header = "Order-{0} polynomial fit coefficients".format(results.poly_order))
 
-    # Save the results as a FITS table
-    t = Table([h, a, d, f, new_f, final_f, r, S200, alpha, c, new_c, final_c], names = ("RA_offset", "RA", "Dec", "flux", "flux_after_dec_corr", "flux_after_full_corr", "local_rms", "S_200", "alpha", "log10ratio", "log10ratio_after_dec_corr", "log10ratio_after_full_cor"))
-    t.write(concat_table, overwrite=True)
+        # Now that we have accumulated Dec, apply the polynomials to the concatenated catalogue, and then fit over RA
+        new_int_fluxes = int_fluxes * 10**(decmodel(decs))
+        new_logratios = np.log10(S200s*(centfreq/200.)**alphas / new_int_fluxes)
 
-    # TODO Fix the plotting so it can be run even if the coefficients and sources are read in from a table
-    # Likely to do this I will need to add a new column to the table that says whether a source was used for fitting
-    if results.make_plots is True:
-        # Weights for plotting
-        w = f[good][indices]/r[good][indices]
-
-        # Dec plot
-        x = d[good][indices]
-        y = c[good][indices]
-        make_plot(x, y, w, decmodel, title, "Declination (deg)", dec_plot)
-
-        # Dec plot after Dec correction
-        y = new_c[good][indices]
-        make_plot(x, y, w, zmodel, title, "Declination (deg)", dec_corrected_plot)
+        new_f = new_int_fluxes[ind]
+        new_c = new_logratios[ind]
 
         if results.correct_ra is True:
-        # RA plot after Dec correction
-            x = h[good][indices]
+            if results.joint is not True:
+                (P_ra,), indices = robust_polyfit([h[good]], new_c[good], f[good]/r[good],
+                                                  results.poly_order, 3, results.maxiter)
+            ramodel = np.poly1d(P_ra)
+            if results.write_coefficients is True:
+                np.savetxt(ra_coeff, P_ra, delimiter=",", header = "Order-{0} polynomial fit coefficients".format(results.poly_order))
+
+            final_int_fluxes = new_int_fluxes * 10**(ramodel(ra_offs))
+            final_logratios = np.log10(S200s*(centfreq/200.)**alphas / final_int_fluxes)
+
+            final_f = final_int_fluxes[ind]
+            final_c = final_logratios[ind]
+        else:
+            final_c = new_c
+            final_f = new_f
+
+        if results.incremental is not None:
+            # Compare the corrections over the sources that were fitted
+            diff_dec = np.abs(np.polyval(P_incremental[0], d[good]) - decmodel(d[good]))
+            print("Incremental fit differs from the full fit by up to {0:.2e} (median {1:.2e}) in log10 Dec correction".format(
+                  np.max(diff_dec), np.median(diff_dec)))
+            if results.correct_ra is True:
+                diff_ra = np.abs(np.polyval(P_incremental[1], h[good]) - ramodel(h[good]))
+                print("Incremental fit differs from the full fit by up to {0:.2e} (median {1:.2e}) in log10 RA correction".format(
+                      np.max(diff_ra), np.median(diff_ra)))
+
+        # Save the results as a FITS table
+        t = Table([h, a, d, f, new_f, final_f, r, S200, alpha, c, new_c, final_c], names = ("RA_offset", "RA", "Dec", "flux", "flux_after_dec_corr", "flux_after_full_corr", "local_rms", "S_200", "alpha", "log10ratio", "log10ratio_after_dec_corr", "log10ratio_after_full_cor"))
+        t.write(concat_table, overwrite=True)
+
+        # TODO Fix the plotting so it can be run even if the coefficients and sources are read in from a table
+        # Likely to do this I will need to add a new column to the table that says whether a source was used for fitting
+        if results.make_plots is True:
+            # Weights for plotting
+            w = f[good][indices]/r[good][indices]
+
+            # Dec plot
+            x = d[good][indices]
+            y = c[good][indices]
+            make_plot(x, y, w, decmodel, title, "Declination (deg)", dec_plot)
+
+            # Dec plot after Dec correction
             y = new_c[good][indices]
-            make_plot(x, y, w, ramodel, title, "RA offset (deg)", ra_plot)
-            
-        # RA plot after RA (and Dec) correction
-            y = final_c[good][indices]
-            make_plot(x, y, w, zmodel, title, "RA offset (deg)", ra_corrected_plot)
+            make_plot(x, y, w, zmodel, title, "Declination (deg)", dec_corrected_plot)
 
-if results.do_rescale is True:
-    for fitsimage in infiles:
+            if results.correct_ra is True:
+            # RA plot after Dec correction
+                x = h[good][indices]
+                y = new_c[good][indices]
+                make_plot(x, y, w, ramodel, title, "RA offset (deg)", ra_plot)
+            
+            # RA plot after RA (and Dec) correction
+                y = final_c[good][indices]
+                make_plot(x, y, w, zmodel, title, "RA offset (deg)", ra_corrected_plot)
+
+    if results.do_rescale is True:
+        if results.correct_ra is not True:
+            P_ra = None
+        options = {"memory": results.memory,
+                   "gridstep": results.gridstep if results.fast is True else None,
+                   "tolerance": results.tolerance}
         if results.correct_all is True:
             extlist = ["", "_bkg", "_rms", "_weight", "_comp"]
         else:
             extlist = [""]
-        for ext in extlist:
-            infits = fitsimage.replace(".fits", ext+".fits")
-            outfits = infits.replace(ext+".fits", "_rescaled"+ext+".fits")
-            if (not os.path.exists(outfits)) or results.overwrite is True:
-                print("Creating {0} from {1}".format(outfits, infits))
-        # Modify each fits file to produce a new version
-                hdu_in = fits.open(infits)
-                if hdu_in[0].data is None:
-            # Then it is a source-finding catalogue not an image
-                    cat = hdu_in[1].data
-                    dec = cat["dec"]
-                    dec_corr = np.zeros(dec.shape)
-            # We generated log10 ratios so use 10^ to get back to raw correction 
-            # e.g. a 4th order polynomial would look like:
-            # corr = 10** ( a*(Dec)^3 + b*(Dec)^2 + c*Dec + d)
-                    for i in range(0,results.poly_order+1):
-                        dec_corr += P_dec[i]*pow(dec, results.poly_order-i)
-                    dec_corr = 10**dec_corr
-            # Obviously only modify columns which use the flux density    
-                    cols = ["background", "local_rms", "peak_flux", "err_peak_flux", "int_flux", "err_int_flux", "residual_mean", "residual_std"]
-                    for col in cols:
-                        cat[col] *= dec_corr
-                    hdu_in.writeto(outfits, overwrite=True)
-                    hdu_in.close()
-                else:
-            # This is an image not a source-finding catalogue
-                # wcs in format [stokes,freq,y,x]; stokes and freq are length 1 if they exist
-                    w = wcs.WCS(hdu_in[0].header, naxis=2)
-                    naxes = hdu_in[0].header["NAXIS"]
-            # going to need the RA in order to calculate the RA offsets
-                    path, fl = os.path.split(infits)
-                    metafits = glob.glob("{0}/{1}*metafits*".format(path, fl[0:10]))
-                    metafits = metafits[0]
-                    meta = fits.getheader(metafits)
-                    ra_cent = meta["RA"]
-                    if naxes == 4:
-                        m, n = 2, 3
-                    elif naxes == 2:
-                        m, n = 0, 1
-                    #create an array but don't set the values (they are random)
-                    indexes = np.empty((hdu_in[0].data.shape[m]*hdu_in[0].data.shape[n],2), dtype=int)
-                    idx = np.array([(j,0) for j in range(hdu_in[0].data.shape[n])])
-                    j=hdu_in[0].data.shape[n]
-                    for i in range(hdu_in[0].data.shape[m]):
-                        idx[:,1]=i
-                        indexes[i*j:(i+1)*j] = idx
-                     
-                #put ALL the pixels into our vectorized functions and minimise our overheads
-                    ra, dec = w.wcs_pix2world(indexes,1).transpose()
-                    dec_corr = np.zeros(dec.shape)
-                    ra_corr = np.zeros(ra.shape)
-                    for i in range(0,results.poly_order+1):
-                        dec_corr += P_dec[i]*pow(dec, results.poly_order-i)
-                    dec_corr = 10**dec_corr
-                    if results.correct_ra is True:
-                        for i in range(0,results.poly_order+1):
-                            ra_corr += P_ra[i]*pow(ra-ra_cent, results.poly_order-i)
-                        ra_corr = 10**ra_corr
-                        corr = dec_corr * ra_corr
-                    else:
-                        corr = dec_corr
-                    corr = corr.reshape(hdu_in[0].data.shape[m],hdu_in[0].data.shape[n])
-                    hdu_in[0].data = np.array(corr*hdu_in[0].data, dtype=np.float32)
-                    hdu_in.writeto(outfits, overwrite=True)
-                    hdu_in.close()
+        # One task for each snapshot, so that its maps share a correction grid
+        tasks = []
+        expected = []
+        for fitsimage in infiles:
+            files = []
+            for ext in extlist:
+                infits = fitsimage.replace(".fits", ext+".fits")
+                outfits = infits.replace(ext+".fits", "_rescaled"+ext+".fits")
+                expected.append(outfits)
+                if (not os.path.exists(outfits)) or results.overwrite is True:
+                    print("Creating {0} from {1}".format(outfits, infits))
+                    files.append((infits, outfits))
+            if len(files) > 0:
+                tasks.append((files, P_dec, P_ra, options))
+        # imap returns results in the order of the tasks, however they are scheduled
+        if results.workers > 1:
+            pool = multiprocessing.Pool(results.workers)
+            outputs = pool.imap(rescale_snapshot, tasks)
+        else:
+            pool = None
+            outputs = map(rescale_snapshot, tasks)
+        failed = []
+        for snapshot in outputs:
+            for outfits, error in snapshot:
+                if error is not None:
+                    print("Failed to create {0}: {1}".format(outfits, error))
+                    failed.append(outfits)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        # Check that all files were created so we can use the right exit code
+        missing = [outfits for outfits in expected if not os.path.exists(outfits) or outfits in failed]
+        for outfits in missing:
+            if outfits not in failed:
+                print("Failed to create {0}".format(outfits))
+        if len(missing) > 0:
+            print("{0} of {1} rescaled files were not created".format(len(missing), len(expected)))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -6,22 +6,63 @@ from astropy.io import fits
 
 from argparse import ArgumentParser
 
+from psf_projected import BLOCK_PIXELS, is_constant_image, constant_image_header
+from mosaic_coadd import preallocate
 
 
-def make_psf(bmaj_image, bmin_image, bpa_image, outname):
-    """Make the PSF map from the individual BMAJ, BMIN, BPA maps."""
+def read_axis(axis):
+    """Read the header of one axis of the PSF map: a FITS image, a header-only
+    constant image (psf_projected.py --compact) or a number.
 
-    bmaj = fits.open(bmaj_image)
-    bmin = fits.getdata(bmin_image)
-    bpa = fits.getdata(bpa_image)
-
-    shape = bmaj[0].data.shape
-    psf_map = np.full((3, shape[0], shape[1]), np.nan)
-    psf_map[0, ...] = bmaj[0].data
-    psf_map[1, ...] = bmin
-    psf_map[2, ...] = bpa
+    Returns (constant, header, shape); constant is None for an image, and
+    header and shape are None for a number.
+    """
+    try:
+        return float(axis), None, None
+    except ValueError:
+        pass
+    hdr = fits.getheader(axis)
+    if is_constant_image(hdr):
+        value = hdr["CVALUE"]
+        hdr, shape = constant_image_header(hdr)
+        return value, hdr, shape
+    return None, hdr, (hdr["NAXIS2"], hdr["NAXIS1"])
+
+
+def make_psf(bmaj_image, bmin_image, bpa_image, outname, rows=None):
+    """Make the PSF map from the individual BMAJ, BMIN, BPA maps.
+
+    Each may also be a constant. The output is written straight to disk a
+    block of rows at a time, and constant axes are filled in without reading
+    anything.
+    """
 
-    fits.writeto(outname, psf_map.astype(np.float32), bmaj[0].header, overwrite=True)
+    names = [bmaj_image, bmin_image, bpa_image]
+    axes = [read_axis(axis) for axis in names]
+    images = [(axis, hdr, shape) for axis, (value, hdr, shape) in zip(names, axes) if hdr is not None]
+    if not images:
+        raise ValueError("At least one of BMAJ, BMIN and BPA must be an image, to give the PSF map its size and WCS")
+    for axis, hdr, shape in images[1:]:
+        if shape != images[0][2]:
+            raise ValueError("{0} is {1} but {2} is {3}".format(axis, shape, images[0][0], images[0][2]))
+
+    # With the header of the first image, normally BMAJ
+    shape = images[0][2]
+    psf_map = preallocate(outname, images[0][1], (3,) + shape)
+
+    if rows is None:
+        rows = max(1, BLOCK_PIXELS//shape[1])
+    for i, (axis, (value, hdr, _)) in enumerate(zip(names, axes)):
+        if value is not None:
+            for start in range(0, shape[0], rows):
+                psf_map[i, start:start+rows] = value
+            continue
+        with fits.open(axis, memmap=True) as hdul:
+            data = hdul[0].data.reshape(shape)
+            for start in range(0, shape[0], rows):
+                psf_map[i, start:start+rows] = data[start:start+rows]
+    psf_map.flush()
+    del psf_map
 
 
 
@@ -30,17 +71,19 @@ def main():
     """
 
     ps = ArgumentParser(description="Combine BMAJ, BMIN, and BPA maps for PSF map.")
-    ps.add_argument("bmaj_image", type=str, help="BMAJ map.")
-    ps.add_argument("bmin_image", type=str, help="BMIN map.")
-    ps.add_argument("bpa_image", type=str, help="BPA map.")
+    ps.add_argument("bmaj_image", type=str, help="BMAJ map, or a constant value.")
+    ps.add_argument("bmin_image", type=str, help="BMIN map, or a constant value.")
+    ps.add_argument("bpa_image", type=str, help="BPA map, or a constant value.")
     ps.add_argument("-o", "--outname", type=str, default="psfmap.fits",
                     help="Outname name for PSF map. [Default psfmap.fits]")
     ps.add_argument("-r", "--remove", action="store_true",
                     help="Switch on to remove BMAJ, BMIN, and BPA maps.")
+    ps.add_argument("--rows", type=int, default=None,
+                    help="Number of rows to copy at once. [Default about {0} pixels' worth]".format(BLOCK_PIXELS))
 
     args = ps.parse_args()
 
-    make_psf(args.bmaj_image, args.bmin_image, args.bpa_image, args.outname)
+    make_psf(args.bmaj_image, args.bmin_image, args.bpa_image, args.outname, rows=args.rows)
 
     if args.remove:
         for image in [args.bmaj_image, args.bmin_image, args.bpa_image]:
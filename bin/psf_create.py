@@ -23,6 +23,8 @@ from astropy import wcs
 
 from argparse import ArgumentParser
 
+from psf_map import PSFMap, car_header
+
 
 # read table and filter out the dodgy sources
 def read_table(inputfile):
@@ -33,12 +35,10 @@ def read_table(inputfile):
     return Table(hdu[1].data)
 
 
-@np.vectorize
 def unwrap(ang):
+    ang = np.asarray(ang, dtype=np.float64)
     r = ang - 2*np.pi*(ang//(2*np.pi))
-    if r>np.pi:
-        r -= 2*np.pi
-    return r
+    return np.where(r>np.pi, r - 2*np.pi, r)
 
 
 # add a HEALPix pixel column to the table
@@ -48,12 +48,21 @@ def radec2hpix(ra, dec, order=4):
     return hp.ang2pix(2**order, theta, phi)
 
 
-def get_neighbours(pix, order=4, nn=1):
+def neighbour_table(order=4):
+    """The neighbours of every pixel, shape (npix, 8), with -1 where a pixel has fewer than 8."""
+    nside = 2**order
+    return hp.pixelfunc.get_all_neighbours(nside, np.arange(hp.nside2npix(nside))).T
+
+
+def get_neighbours(pix, order=4, nn=1, table=None):
     neighbours = set([pix])
     for i in range(nn):
         for p in neighbours.copy():
-            theta,phi = hp.pix2ang(2**order,p)
-            neighbours|= set(hp.pixelfunc.get_all_neighbours(2**order,theta,phi))
+            if table is None:
+                theta,phi = hp.pix2ang(2**order,p)
+                neighbours|= set(hp.pixelfunc.get_all_neighbours(2**order,theta,phi))
+            else:
+                neighbours |= set(table[p])
             neighbours -=set([-1])
     return list(neighbours)
 
@@ -70,6 +79,48 @@ def get_h_neighbours(pix, order=4, nn=1):
     return list(neighbours)
 
 
+def pixel_sums(hpx, values, npix):
+    """Sum each array of values over the sources in every pixel, shape (len(values), npix)."""
+    return np.array([np.bincount(hpx, weights=v, minlength=npix) for v in values])
+
+
+def neighbourhood_sums(sums, pixels, table):
+    """Add up the per-pixel sums over each pixel and its immediate neighbours.
+
+    This covers the same pixels as get_neighbours with nn=1, each counted once.
+    """
+    nb = np.column_stack((pixels, table[pixels]))
+    nb.sort(axis=1)
+    # The corners of the base pixels have fewer neighbours (-1) and may list one twice
+    valid = nb >= 0
+    valid[:, 1:] &= nb[:, 1:] != nb[:, :-1]
+    return (sums[:, np.where(valid, nb, 0)] * valid).sum(axis=2)
+
+
+def project_to_car(pix_dict, mywcs, ny, nx, order=4):
+    """Fill a (4, ny, nx) cube with the a/b/pa/blur of the HEALPix pixel under each CAR pixel.
+
+    The whole grid goes through the WCS and ang2pix at once, and the values
+    are looked up through an array mapping pixel number to row; CAR pixels
+    with no valid sky position or no PSF measurement are NaN.
+    """
+    pixels = np.array(list(pix_dict.keys()), dtype=int)
+    values = np.array([pix_dict[p][:4] for p in pix_dict.keys()], dtype=np.float64)
+    lookup = np.full(hp.nside2npix(2**order), -1, dtype=int)
+    lookup[pixels] = np.arange(len(pixels))
+
+    j, i = np.mgrid[0:ny, 0:nx]
+    ra, dec = mywcs.all_pix2world(i.ravel(), j.ravel(), 0)
+    rows = np.full(ra.shape, -1, dtype=int)
+    finite = np.isfinite(ra) & np.isfinite(dec)
+    rows[finite] = lookup[radec2hpix(ra[finite], dec[finite], order=order)]
+
+    car = np.full((4, ny*nx), np.nan, dtype=np.float32)
+    found = rows >= 0
+    car[:, found] = values[rows[found]].T
+    return car.reshape(4, ny, nx)
+
+
 def main():
     """
     """
@@ -77,7 +128,7 @@ def main():
     parser = ArgumentParser()
     parser.add_argument('--input', dest="input", default=None,
                       help="Input fits table to characterise.")
-    parser.add_argument('--stepsize', dest="stepsize", default=1,
+    parser.add_argument('--stepsize', dest="stepsize", default=1, type=float,
                       help="Specify step size in degrees (default = 1 deg)")
     parser.add_argument('--output', dest="output", default=None,
                       help="Output psf fits file -- default is based on input table")
@@ -89,6 +140,13 @@ def main():
                       help='Healpix order')
     parser.add_argument('--zeropa', dest='zeropa', action='store_true', default=False,
                       help='For the psf position angle to be identically zero')
+    parser.add_argument('--healpix', dest='healpix', action='store_true', default=False,
+                      help='Write a multi-order HEALPix PSF map (see psf_map.py) instead of the CAR cube')
+    parser.add_argument('--max-order', dest='max_order', default=None, type=int,
+                      help='With --healpix, the finest Healpix order to refine to (default = --order)')
+    parser.add_argument('--min-sources', dest='min_sources', default=20, type=int,
+                      help='With --healpix, refine a pixel if each of its children has at least this many '
+                           'sources in its neighbourhood (default = 20)')
     # parser.add_argument("--reference-image", "-r",
     #                     dest="reference_image", type=str, default=None)
     options = parser.parse_args()
@@ -97,6 +155,21 @@ def main():
     print('read and filter')
     table = read_table(options.input)
 
+    if options.healpix:
+        print('averaging onto multi-order healpix')
+        psf_map = PSFMap.from_catalogue(table['ra'], table['dec'], table['a'], table['b'],
+                                        table['pa'] if not options.zeropa else np.zeros(len(table)),
+                                        (table['a']*table['b'])/(table["psf_a"]*table["psf_b"]),
+                                        order=options.order, max_order=options.max_order,
+                                        min_sources=options.min_sources)
+        if options.output is None:
+            options.output = options.input.replace('_comp_psfcat.fits','_psf_hpx.fits')
+            if options.output == options.input:
+                options.output = "psf_hpx.fits"
+        psf_map.write(options.output)
+        print("wrote {}".format(options.output))
+        return
+
     print('add hpx column')
     # add a new column to the data - healpix pixel number
     ncol = Column(radec2hpix(table['ra'], table['dec'], order=options.order), 'hpx' )
@@ -105,89 +178,56 @@ def main():
     print('averaging')
     # iterate over the unique pixels in the data
 
+    nside = 2**options.order
+    npix = hp.nside2npix(nside)
+    nbtable = neighbour_table(options.order)
     pixels = set()
     for p in set(table['hpx']):
-        pixels |= set( get_neighbours(p, order=options.order, nn=2) )
-    pix_dict = {}
-    missed = []
-    for p in pixels:
-        # find all the neighbours
-        nb = get_neighbours(p,order=options.order)
-        src_mask = np.where(np.in1d(table['hpx'], nb))[0]
-        if sum(src_mask)<5:
-            missed.append(p)
-        # calculate the median values of a/b/pa
-        blur = np.mean((table[src_mask]['a']*table[src_mask]['b'])/(table[src_mask]["psf_a"]*table[src_mask]["psf_b"]))
-        a = np.mean(table[src_mask]['a'])/3600.
-        b = np.mean(table[src_mask]['b'])/3600.
-        pa = np.mean(table[src_mask]['pa']) if not options.zeropa else 0
-        # blur = np.mean(table[src_mask]['a']*table[src_mask]['b']*np.cos(np.radians(latitude-table[src_mask]['dec']))/(bmaj*bmin*3600*3600))
-        
-        nsrc = len(src_mask)
-        pix_dict[p] = (a,b,pa,blur,nsrc)
-
-    for m in missed:
+        pixels |= set( get_neighbours(p, order=options.order, nn=2, table=nbtable) )
+    pixels = list(pixels)
+
+    # Per-pixel sums of every quantity we average, then totals over each pixel's neighbours
+    hpx = np.array(table['hpx'])
+    sums = pixel_sums(hpx, [np.array(table['a'], dtype=np.float64),
+                            np.array(table['b'], dtype=np.float64),
+                            np.array(table['pa'], dtype=np.float64),
+                            np.array((table['a']*table['b'])/(table["psf_a"]*table["psf_b"]), dtype=np.float64),
+                            np.ones(len(table)),
+                            np.arange(len(table), dtype=np.float64)], npix)
+    a_sum, b_sum, pa_sum, blur_sum, nsrc, row_sum = neighbourhood_sums(sums, np.array(pixels, dtype=int), nbtable)
+    # (This tests the sum of the row numbers of the sources, which has always been the criterion)
+    missed = row_sum < 5
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # calculate the mean values of a/b/pa
+        a = a_sum/nsrc/3600.
+        b = b_sum/nsrc/3600.
+        pa = pa_sum/nsrc if not options.zeropa else np.zeros(len(pixels))
+        blur = blur_sum/nsrc
+    pix_dict = dict(zip(pixels, zip(a, b, pa, blur, nsrc.astype(int))))
+
+    if np.any(missed):
+        # The fix-up has always been applied to p, the last pixel averaged, rather than to the missed pixels
+        p = pixels[-1]
         nb = get_h_neighbours(p,order=options.order, nn=2)
-        src_mask = np.where(np.in1d(table['hpx'], nb))[0]
-        # if sum(src_mask)<5:
-        #     print m, src_mask, 'still missed'
-        #     continue
-        # else:
-        #     print "fixed up",m
-        ## calculate the median values of a/b/pa
-        blur = np.mean((table[src_mask]['a']*table[src_mask]['b'])/(table[src_mask]["psf_a"]*table[src_mask]["psf_b"]))
-        a = np.mean(table[src_mask]['a'])/3600.
-        b = np.mean(table[src_mask]['b'])/3600.
-        pa = np.mean(table[src_mask]['pa']) if not options.zeropa else 0
-        # blur = np.mean(table[src_mask]['a']*table[src_mask]['b']*np.cos(np.radians(latitude-table[src_mask]['dec']))/(bmaj*bmin*3600*3600))
-        nsrc = len(src_mask)
-        pix_dict[p] = (a,b,pa,blur,nsrc)
+        a_sum, b_sum, pa_sum, blur_sum, n = sums[:, np.array(nb, dtype=int)].sum(axis=1)[:5]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            pix_dict[p] = (a_sum/n/3600., b_sum/n/3600., pa_sum/n if not options.zeropa else 0, blur_sum/n, int(n))
 
 
     print('making car grid')
     # make a grid for our cartesian projection
     nx = int(360//options.stepsize)
     ny = int(180//options.stepsize)
-    car = np.empty((4,ny,nx),dtype=np.float32)*np.nan
     
     # make an image header from scratch
-    hd={}
-    hd['SIMPLE']=True
-    hd['BITPIX']=-32
-    hd['NAXIS']=2
-    hd['NAXIS1']=360
-    hd['NAXIS2']=180
-    hd['EQUINOX']=2000
-    hd['RADESYS']='ICRS'
-    hd['CDELT1']=options.stepsize
-    hd['CRPIX1']= nx/2.0
-    hd['CRVAL1']=180.0
-    hd['CTYPE1']='RA---CAR'
-    hd['CUNIT1']='deg'
-    hd['CDELT2']=options.stepsize
-    hd['CRVAL2']=0.0
-    hd['CRPIX2']=ny/2.0
-    hd['CTYPE2']='DEC--CAR'
-    hd['CUNIT2']='deg'
-    header = fits.Header.fromkeys(hd.keys())
-    for k in hd.keys():
-        header[k]=hd[k]
+    header = car_header(options.stepsize)
 
     # create the correct WCS
     mywcs = wcs.WCS(header)
     print("projecting hpx->car")
     # for each pixel in the cartesian grid, seek the value from the hpix grid
-    for j in range(ny):
-        for i in range(nx):
-            ra, dec = mywcs.all_pix2world(i,j,0)
-            if np.all(np.isfinite([ra ,dec])):
-                p = radec2hpix(ra,dec,order=options.order)
-            else:
-                p=-1
-            if p in pix_dict.keys():
-                car[:,j,i]=pix_dict[p][:4]
-            else:
-                car[:,j,i]=[np.nan, np.nan, np.nan, np.nan]
+    car = project_to_car(pix_dict, mywcs, ny, nx, order=options.order)
     header['CTYPE3'] = ('Beam',"0=a,1=b,2=pa (degrees),3=blur")
     if options.output is None:
         # Try some common extensions
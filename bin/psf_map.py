@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division
+
+import numpy as np
+import healpy as hp
+
+from astropy.io import fits
+from astropy import wcs
+
+from argparse import ArgumentParser
+
+# The quantities stored for every pixel, in the order of the planes of the CAR cube
+QUANTITIES = ["a", "b", "pa", "blur"]
+
+
+def car_header(stepsize=1):
+    """Header of the all-sky CAR grid that psf_create.py has always written."""
+    nx = int(360//stepsize)
+    ny = int(180//stepsize)
+    hd={}
+    hd['SIMPLE']=True
+    hd['BITPIX']=-32
+    hd['NAXIS']=2
+    hd['NAXIS1']=360
+    hd['NAXIS2']=180
+    hd['EQUINOX']=2000
+    hd['RADESYS']='ICRS'
+    hd['CDELT1']=stepsize
+    hd['CRPIX1']= nx/2.0
+    hd['CRVAL1']=180.0
+    hd['CTYPE1']='RA---CAR'
+    hd['CUNIT1']='deg'
+    hd['CDELT2']=stepsize
+    hd['CRVAL2']=0.0
+    hd['CRPIX2']=ny/2.0
+    hd['CTYPE2']='DEC--CAR'
+    hd['CUNIT2']='deg'
+    header = fits.Header.fromkeys(hd.keys())
+    for k in hd.keys():
+        header[k]=hd[k]
+    return header
+
+
+def uniq_to_pixels(uniq):
+    """Split NUNIQ pixel numbers into (order, nested pixel number)."""
+    uniq = np.asarray(uniq, dtype=np.int64)
+    order = (np.floor(np.log2(uniq)).astype(np.int64) - 2)//2
+    return order, uniq - 4*4**order
+
+
+def pixels_to_uniq(order, ipix):
+    """NUNIQ pixel numbers of nested pixels at the given order(s)."""
+    return 4*4**np.asarray(order, dtype=np.int64) + np.asarray(ipix, dtype=np.int64)
+
+
+def occupied_sums(hpx, values):
+    """Sum the values over the sources in each occupied pixel.
+
+    Returns the sorted occupied pixel numbers and the sums, shape
+    (len(values), number of occupied pixels).
+    """
+    order = np.argsort(hpx, kind="mergesort")
+    pixels, start = np.unique(hpx[order], return_index=True)
+    return pixels, np.add.reduceat(values[:, order], start, axis=1)
+
+
+def neighbourhood_sums(pixels, sums, order, query):
+    """Add up the occupied-pixel sums over each query pixel and its immediate neighbours (nested)."""
+    nb = np.column_stack((query, hp.get_all_neighbours(2**order, query, nest=True).T))
+    nb.sort(axis=1)
+    # The corners of the base pixels have fewer neighbours (-1) and may list one twice
+    valid = nb >= 0
+    valid[:, 1:] &= nb[:, 1:] != nb[:, :-1]
+    idx = np.clip(np.searchsorted(pixels, nb), 0, len(pixels)-1)
+    valid &= pixels[idx] == nb
+    return (sums[:, idx] * valid).sum(axis=2)
+
+
+class PSFMap(object):
+    """A PSF map on HEALPix pixels of mixed order.
+
+    Only pixels with measurements are stored, each at the finest order that
+    the local source density supports, numbered with the NUNIQ scheme used
+    by multi-order coverage maps. Values are the a, b (deg), pa (deg) and
+    blur of the CAR cube, averaged over the sources in each pixel and its
+    immediate neighbours, as psf_create.py does.
+    """
+    def __init__(self, uniq, values, nsrc):
+        order = np.argsort(uniq)
+        self.uniq = np.asarray(uniq, dtype=np.int64)[order]
+        self.values = np.asarray(values, dtype=np.float64)[:, order]
+        self.nsrc = np.asarray(nsrc, dtype=np.int64)[order]
+        self.orders, self.ipix = uniq_to_pixels(self.uniq)
+        self._layers = {}
+
+    def __len__(self):
+        return len(self.uniq)
+
+    @classmethod
+    def from_catalogue(cls, ra, dec, a, b, pa, blur, order=4, max_order=None, min_sources=20):
+        """Average the PSF measurements of a catalogue onto adaptively-refined pixels.
+
+        a and b are in arcsec, as in the catalogue. Every pixel at the base
+        order with sources in its neighbourhood is kept, and a pixel is split
+        into its four children, down to max_order, if each child has at least
+        min_sources sources in its own neighbourhood.
+        """
+        if max_order is None:
+            max_order = order
+        ra = np.asarray(ra, dtype=np.float64)
+        dec = np.asarray(dec, dtype=np.float64)
+        quantities = np.array([np.asarray(a, dtype=np.float64)/3600.,
+                               np.asarray(b, dtype=np.float64)/3600.,
+                               np.asarray(pa, dtype=np.float64),
+                               np.asarray(blur, dtype=np.float64),
+                               np.ones(len(ra))])
+
+        levels = [occupied_sums(hp.ang2pix(2**o, ra, dec, nest=True, lonlat=True), quantities)
+                  for o in range(order, max_order+1)]
+
+        uniq = []
+        values = []
+        nsrc = []
+        # Start from every pixel that has sources in its neighbourhood
+        pixels = levels[0][0]
+        nb = hp.get_all_neighbours(2**order, pixels, nest=True).ravel()
+        candidates = np.union1d(pixels, nb[nb >= 0])
+        for o in range(order, max_order+1):
+            pixels, sums = levels[o-order]
+            totals = neighbourhood_sums(pixels, sums, o, candidates)
+            if o < max_order:
+                children = (candidates[:, np.newaxis]*4 + np.arange(4)).ravel()
+                child_pixels, child_sums = levels[o+1-order]
+                counts = neighbourhood_sums(child_pixels, child_sums[-1:], o+1, children)[0]
+                split = np.all(counts.reshape(-1, 4) >= min_sources, axis=1)
+            else:
+                split = np.zeros(len(candidates), dtype=bool)
+            keep = ~split
+            uniq.append(pixels_to_uniq(o, candidates[keep]))
+            values.append(totals[:4, keep]/totals[4, keep])
+            nsrc.append(totals[4, keep])
+            candidates = (candidates[split, np.newaxis]*4 + np.arange(4)).ravel()
+            if len(candidates) == 0:
+                break
+        return cls(np.concatenate(uniq), np.hstack(values), np.concatenate(nsrc))
+
+    @classmethod
+    def read(cls, filename):
+        with fits.open(filename) as hdulist:
+            data = hdulist[1].data
+            return cls(data["UNIQ"], [data[q.upper()] for q in QUANTITIES], data["NSRC"])
+
+    def write(self, filename):
+        cols = [fits.Column(name="UNIQ", format="K", array=self.uniq)]
+        for q, v in zip(QUANTITIES, self.values):
+            cols.append(fits.Column(name=q.upper(), format="E", array=v, unit="deg" if q != "blur" else None))
+        cols.append(fits.Column(name="NSRC", format="J", array=self.nsrc))
+        hdu = fits.BinTableHDU.from_columns(cols)
+        hdu.header["PIXTYPE"] = "HEALPIX"
+        hdu.header["ORDERING"] = "NUNIQ"
+        hdu.header["COORDSYS"] = "C"
+        hdu.header["MOCORDER"] = (int(self.orders.max()), "Finest order of the pixels")
+        fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(filename, overwrite=True)
+
+    def layer(self, order):
+        """All the pixels of a single order, shape (4, npix), NaN where there is no measurement.
+
+        Stored pixels that are coarser fill all of their descendants; finer
+        ones are averaged into their ancestor.
+        """
+        if order not in self._layers:
+            npix = hp.nside2npix(2**order)
+            dense = np.full((len(QUANTITIES), npix), np.nan)
+            for o in np.unique(self.orders):
+                at_order = self.orders == o
+                if o <= order:
+                    n = 4**(order-o)
+                    idx = (self.ipix[at_order, np.newaxis]*n + np.arange(n)).ravel()
+                    dense[:, idx] = np.repeat(self.values[:, at_order], n, axis=1)
+                else:
+                    parent = self.ipix[at_order] >> 2*(o-order)
+                    parents, inverse = np.unique(parent, return_inverse=True)
+                    counts = np.bincount(inverse)
+                    dense[:, parents] = [np.bincount(inverse, weights=v)/counts for v in self.values[:, at_order]]
+            self._layers[order] = dense
+        return self._layers[order]
+
+    def psf_at(self, ra, dec, interpolate=True):
+        """The a, b, pa and blur at each position, shape (4, n).
+
+        The value comes from the stored pixel containing the position or,
+        with interpolate, from bilinear interpolation between the four
+        nearest pixels at that pixel's order, ignoring pixels that have no
+        measurement. Positions outside the map are NaN.
+        """
+        ra = np.atleast_1d(np.asarray(ra, dtype=np.float64))
+        dec = np.atleast_1d(np.asarray(dec, dtype=np.float64))
+        result = np.full((len(QUANTITIES), len(ra)), np.nan)
+        todo = np.isfinite(ra) & np.isfinite(dec)
+        # Finest first, so each position is assigned to the pixel that contains it
+        for o in np.unique(self.orders)[::-1]:
+            rows = np.where(todo)[0]
+            if len(rows) == 0:
+                break
+            uniq = pixels_to_uniq(o, hp.ang2pix(2**o, ra[rows], dec[rows], nest=True, lonlat=True))
+            idx = np.clip(np.searchsorted(self.uniq, uniq), 0, len(self.uniq)-1)
+            found = self.uniq[idx] == uniq
+            rows = rows[found]
+            todo[rows] = False
+            if interpolate is not True:
+                result[:, rows] = self.values[:, idx[found]]
+                continue
+            pix, weights = hp.get_interp_weights(2**o, ra[rows], dec[rows], nest=True, lonlat=True)
+            values = self.layer(o)[:, pix]
+            weights = np.where(np.isfinite(values[0]), weights, 0.)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result[:, rows] = np.nansum(values*weights, axis=1)/weights.sum(axis=0)
+        return result
+
+    def to_car(self, stepsize=1, interpolate=True):
+        """Sample the map onto the legacy all-sky CAR cube; returns (data, header)."""
+        header = car_header(stepsize)
+        nx = int(360//stepsize)
+        ny = int(180//stepsize)
+        j, i = np.mgrid[0:ny, 0:nx]
+        ra, dec = wcs.WCS(header).all_pix2world(i.ravel(), j.ravel(), 0)
+        car = np.array(self.psf_at(ra, dec, interpolate=interpolate), dtype=np.float32).reshape(4, ny, nx)
+        header['CTYPE3'] = ('Beam',"0=a,1=b,2=pa (degrees),3=blur")
+        return car, header
+
+
+def main():
+    """
+    """
+
+    ps = ArgumentParser(description="Export a HEALPix PSF map (psf_create.py --healpix) "
+                                    "to the all-sky CAR cube.")
+    ps.add_argument("input", type=str, help="HEALPix PSF map.")
+    ps.add_argument("output", type=str, help="Output CAR cube.")
+    ps.add_argument("--stepsize", type=float, default=1, help="Step size in degrees (default = 1 deg)")
+    ps.add_argument("--nearest", action="store_true", default=False,
+                    help="Take the value of the pixel containing each point instead of "
+                         "interpolating (default = False)")
+    args = ps.parse_args()
+
+    car, header = PSFMap.read(args.input).to_car(args.stepsize, interpolate=not args.nearest)
+    fits.HDUList(fits.PrimaryHDU(header=header, data=car)).writeto(args.output, overwrite=True)
+    print("wrote {0}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@
 
 from __future__ import print_function, division
 
+import re
 from argparse import ArgumentParser
 
 import numpy as np
@@ -69,86 +70,178 @@ def check_projection(hdr, projections=["SIN", "ZEA"]):
         return projection
 
 
-def make_sinfactor_map(fitsimage, stride=16000000, ra0=None, dec0=None,
+# Number of image pixels to convert at once; each needs about 100 bytes of workspace
+BLOCK_PIXELS = 1000000
+
+
+def image_shape(hdr):
+    """The (ny, nx) of the celestial axes, from the header alone."""
+    return hdr["NAXIS2"], hdr["NAXIS1"]
+
+
+# Keywords that the closed-form pixel to RA,DEC below doesn't handle: any
+# linear transformation matrix, projection parameters or LATPOLE
+GENERAL_WCS_KEYS = re.compile(r"^(CD|PC|PV)\d+_\d+$|^LATPOLE$")
+
+
+def is_plain_zenithal(hdr):
+    """Whether the celestial axes are described by CRVAL, CRPIX and CDELT (in degrees) alone."""
+    if any(GENERAL_WCS_KEYS.match(key) for key in hdr.keys()):
+        return False
+    return all(hdr.get("CUNIT"+axis, "deg").strip().lower() == "deg" for axis in ["1", "2"])
+
+
+def pix2world_zenithal(hdr, x, y):
+    """RA,DEC (degrees) of 0-based pixels x,y of a SIN or ZEA image, from
+    CRVAL, CRPIX and CDELT alone (Calabretta & Greisen 2002).
+
+    Pixels outside the projection's boundary come out as NaN.
+    """
+    projection = check_projection(hdr)
+    xi = np.radians(hdr["CDELT1"]*(x + 1 - hdr["CRPIX1"]))
+    eta = np.radians(hdr["CDELT2"]*(y + 1 - hdr["CRPIX2"]))
+    r = np.hypot(xi, eta)
+    phi = np.arctan2(xi, -eta)
+    with np.errstate(invalid="ignore"):
+        if projection == "ZEA":
+            theta = np.pi/2 - 2*np.arcsin(r/2)
+        else:
+            theta = np.arccos(r)
+
+    ra_p = np.radians(hdr["CRVAL1"])
+    dec_p = np.radians(hdr["CRVAL2"])
+    phi_p = np.radians(hdr.get("LONPOLE", 0. if hdr["CRVAL2"] >= 90. else 180.))
+    dphi = phi - phi_p
+    dec = np.arcsin(np.sin(theta)*np.sin(dec_p) + np.cos(theta)*np.cos(dec_p)*np.cos(dphi))
+    ra = ra_p + np.arctan2(-np.cos(theta)*np.sin(dphi),
+                           np.sin(theta)*np.cos(dec_p) - np.cos(theta)*np.sin(dec_p)*np.cos(dphi))
+    return np.degrees(ra), np.degrees(dec)
+
+
+def dOmega_blocks(hdr, ra0, dec0, rows=None):
+    """Calculate dOmega for an image a block of rows at a time.
+
+    Yields (start row, stop row, dOmega) with dOmega of shape
+    (stop - start, nx), so that the whole image is never in memory at once.
+    """
+    ny, nx = image_shape(hdr)
+    if is_plain_zenithal(hdr):
+        pix2world = lambda x, y, origin: pix2world_zenithal(hdr, x, y)
+    else:
+        pix2world = WCS(hdr).celestial.all_pix2world
+    if rows is None:
+        rows = max(1, BLOCK_PIXELS//nx)
+    x = np.arange(nx)
+    for start in range(0, ny, rows):
+        stop = min(start + rows, ny)
+        y, xx = np.meshgrid(np.arange(start, stop), x, indexing="ij")
+        r, d = pix2world(xx, y, 0)
+        yield start, stop, dOmega(r, d, ra0, dec0)
+
+
+def dOmega_map(hdr, ra0, dec0, invert=False, rows=None):
+    """dOmega (or with invert, 1/dOmega) over a whole image, as float32."""
+    arr = np.empty(image_shape(hdr), dtype=np.float32)
+    for start, stop, factors in dOmega_blocks(hdr, ra0, dec0, rows=rows):
+        if invert:
+            factors = 1. / factors
+        arr[start:stop] = factors
+    return arr
+
+
+def make_sinfactor_map(fitsimage, stride=None, ra0=None, dec0=None,
                        outname=None):
     """Make a map of dOmega for a given image and reference coordinates."""
 
-    hdu = fits.open(fitsimage)
+    hdr = fits.getheader(fitsimage)
     try:
-        projection = check_projection(hdu[0].header)
+        projection = check_projection(hdr)
     except ValueError:
         logger.warning("dOmega factors only valid for SIN projection.")
         raise
     else:
 
-        shape = np.squeeze(hdu[0].data).shape
-        arr = np.full(shape, np.nan)
-
-        w = WCS(hdu[0].header).celestial
-
         if ra0 is None:
-            ra0 = hdu[0].header["CRVAL1"]
+            ra0 = hdr["CRVAL1"]
         if dec0 is None:
-            dec0 = hdu[0].header["CRVAL2"]
+            dec0 = hdr["CRVAL2"]
 
-        indices=  np.indices(shape)
-        y = indices[0].flatten()
-        x = indices[1].flatten()
-        n = len(x) 
-
-        for i in range(0, n, stride):
-
-            r, d = w.all_pix2world(x[i:i+stride], y[i:i+stride], 0)
-            factors = dOmega(r, d, ra0, dec0)
-
-            arr[y[i:i+stride], x[i:i+stride]] = factors
+        rows = None if stride is None else max(1, stride//hdr["NAXIS1"])
+        arr = dOmega_map(hdr, ra0, dec0, rows=rows)
 
     if outname is None:
         outname = fitsimage.replace(".fits", "_dOmega.fits")
 
-    fits.writeto(outname, arr.astype(np.float32), strip_wcsaxes(hdu[0].header), overwrite=True)
+    fits.writeto(outname, arr, strip_wcsaxes(hdr), overwrite=True)
 
 
 
-def make_ratio_map(fitsimage, ra0, dec0, stride=16000000, outname=None):
+def make_ratio_map(fitsimage, ra0, dec0, stride=None, outname=None):
     """Make a map of ratio of dOmega."""
 
-    hdu = fits.open(fitsimage)
+    hdr = fits.getheader(fitsimage)
     try:
-        projection = check_projection(hdu[0].header)
+        projection = check_projection(hdr)
     except ValueError:
         logger.warning("dOmega ratios only valid for SIN and ZEA projections.")
         raise
     else:
 
-        shape = np.squeeze(hdu[0].data).shape
-        arr = np.full(shape, np.nan)
+        rows = None if stride is None else max(1, stride//hdr["NAXIS1"])
+        arr = dOmega_map(hdr, ra0, dec0, invert=True, rows=rows)
+
+    if outname is None:
+        # return hdu instead of writing file - avoid unnecessary file creation
+        return fits.HDUList([fits.PrimaryHDU(data=arr, header=hdr)])
+    else:
+        fits.writeto(outname, arr, strip_wcsaxes(hdr), overwrite=True)
+
 
-        w = WCS(hdu[0].header).celestial
+def write_constant_image(outname, value, hdr):
+    """Write an image whose every pixel is value as a header alone.
 
-        indices=  np.indices(shape)
-        y = indices[0].flatten()
-        x = indices[1].flatten()
-        n = len(x) 
+    The header keeps the WCS of the image it stands for, with its size in
+    CNAXIS1/CNAXIS2 and the value in CVALUE; read_image() expands it again.
+    """
+    out = fits.PrimaryHDU(header=strip_wcsaxes(hdr.copy())).header
+    out["CONSTANT"] = (True, "Every pixel has the value CVALUE")
+    out["CVALUE"] = value
+    out["CNAXIS1"] = (hdr["NAXIS1"], "Size of the image along axis 1")
+    out["CNAXIS2"] = (hdr["NAXIS2"], "Size of the image along axis 2")
+    fits.PrimaryHDU(header=out).writeto(outname, overwrite=True)
 
-        for i in range(0, n, stride):
 
-            r, d = w.all_pix2world(x[i:i+stride], y[i:i+stride], 0)
-            factors = dOmega(r, d, ra0, dec0)
+def is_constant_image(hdr):
+    return hdr.get("CONSTANT", False) is True
 
-            arr[y[i:i+stride], x[i:i+stride]] = 1. / factors
 
-    if outname is None:
-        # return hdu instead of writing file - avoid unnecessary file creation
-        hdu[0].data = arr
-        return hdu
-    else:
-        fits.writeto(outname, arr, strip_wcsaxes(hdu[0].header), overwrite=True)
+def constant_image_header(hdr):
+    """The header and (ny, nx) shape of the image that a header from write_constant_image stands for."""
+    hdr = hdr.copy()
+    shape = (hdr["CNAXIS2"], hdr["CNAXIS1"])
+    for key in ["CONSTANT", "CVALUE", "CNAXIS1", "CNAXIS2"]:
+        del hdr[key]
+    return hdr, shape
+
 
+def read_image(filename):
+    """Read an image, or expand one written by write_constant_image; returns (data, header)."""
+    with fits.open(filename) as hdul:
+        hdr = hdul[0].header.copy()
+        if not is_constant_image(hdr):
+            return hdul[0].data, hdr
+    value = hdr["CVALUE"]
+    hdr, shape = constant_image_header(hdr)
+    data = np.full(shape, value, dtype=np.float32)
+    return data, fits.PrimaryHDU(data, header=hdr).header
 
 
-def make_effective_psf(dOmega_map, outname, bmaj, bmin=None, bpa=0.):
-    """Create each of the PSF axes."""
+def make_effective_psf(dOmega_map, outname, bmaj, bmin=None, bpa=0., compact=False):
+    """Create each of the PSF axes.
+
+    With compact, the BMIN and BPA maps, which are the same everywhere, are
+    written as headers alone (see write_constant_image).
+    """
 
     if bmin is None:
         bmin = bmaj
@@ -158,20 +251,35 @@ def make_effective_psf(dOmega_map, outname, bmaj, bmin=None, bpa=0.):
     else:
         hdu = dOmega_map
 
-    shape = hdu[0].data.shape
-
-
-    psf = {}
     #  Swarp cannot cope with cubes, so we have to output each aspect of the PSF individually
-    psf["bmaj"] = bmaj / hdu[0].data
-    psf["bmin"] = bmin * np.ones(hdu[0].data.shape)
-    psf["bpa"] = bpa * np.ones(hdu[0].data.shape)
+    fits.writeto(outname+"_bmaj.fits", (bmaj / hdu[0].data).astype(np.float32), hdu[0].header, overwrite=True)
 
-    for aspect in ["bmaj", "bmin", "bpa"]:
+    for aspect, value in [("bmin", bmin), ("bpa", bpa)]:
         outname_aspect = outname+"_"+aspect+".fits"
-        fits.writeto(outname_aspect, psf[aspect].astype(np.float32), hdu[0].header, overwrite=True)
+        if compact:
+            write_constant_image(outname_aspect, value, hdu[0].header)
+        else:
+            fits.writeto(outname_aspect, np.full(hdu[0].data.shape, value, dtype=np.float32),
+                         hdu[0].header, overwrite=True)
+
 
 
+def snapshot_beam(original_image):
+    """The pointing centre and restoring beam (ra0, dec0, bmaj, bmin, bpa) of an original snapshot."""
+
+    hdr = fits.getheader(original_image)
+    bmaj = hdr["BMAJ"]
+    try:
+        bmin = hdr["BMIN"]
+    except KeyError:
+        bmin = bmaj
+    try:
+        bpa = hdr["BPA"]
+    except KeyError:
+        bpa = 0.
+
+    return hdr["CRVAL1"], hdr["CRVAL2"], bmaj, bmin, bpa
+
 
 def main():
     """
@@ -188,29 +296,17 @@ def main():
     ps.add_argument("original_image", type=str,
                     help="Original FITS image in SIN projection. Used to get "
                          "original CRVAL1/CRVAL2 values.")
-
+    ps.add_argument("--compact", action="store_true",
+                    help="Write the BMIN and BPA maps, which are constant, as headers "
+                         "alone rather than full images.")
 
     args = ps.parse_args()
 
-    hdr = fits.getheader(args.original_image)
-    bmaj = hdr["BMAJ"]
-    try:
-        bmin = hdr["BMIN"]
-    except KeyError:
-        bmin = bmaj
-    try:
-        bpa = hdr["BPA"]
-    except KeyError:
-        bpa = 0.
-
-    original_projection = "SIN"
-    with fits.open(args.original_image) as f:
-        ra0 = f[0].header["CRVAL1"]
-        dec0 = f[0].header["CRVAL2"]
+    ra0, dec0, bmaj, bmin, bpa = snapshot_beam(args.original_image)
 
     outname = args.new_image.replace(".fits", "")
     hdu = make_ratio_map(args.new_image, ra0, dec0, outname=None)
-    make_effective_psf(hdu, outname, bmaj, bmin, bpa)
+    make_effective_psf(hdu, outname, bmaj, bmin, bpa, compact=args.compact)
 
 
 if __name__ == "__main__":
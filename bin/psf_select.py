@@ -14,6 +14,12 @@ from astropy.io.votable import parse_single_table
 # optparse is being deprecated and argparse is now available on Zeus. 
 from argparse import ArgumentParser
 
+from sky_match import isolated, cached_index
+
+# Columns of the source-finding catalogue that are kept after matching with NVSS/SUMSS
+KEEP_COLUMNS = ["ra", "dec", "peak_flux", "err_peak_flux", "int_flux", "err_int_flux", "local_rms",
+                "a", "err_a", "b", "err_b", "pa", "err_pa", "psf_a", "psf_b", "psf_pa", "residual_std", "flags"]
+
 def main():
     """
     """
@@ -55,46 +61,35 @@ def main():
         outputfile = inputfile.replace("."+ext,"_psfcat.fits")
 
     # Read the VO table and start processing
+    data = Table.read(inputfile)
+
     if options.isolate is True:
-        sparse=re.sub("."+ext, "_isolated.fits", inputfile)
-        os.system('stilts tmatch1 matcher=sky values="ra dec" params=600 \
-                  action=keep0 in='+inputfile+' out='+sparse)
-    else:
-        sparse = inputfile
+        # Keep only sources with no other source within 10 arcmin
+        data = data[isolated(data['ra'], data['dec'], 600.)]
 
     if options.usefilter is True:
-        nscat = options.nscat
+        # The model directory is given with $pipeuser in it, which the shell used to expand
+        nscat = os.path.expandvars(options.nscat)
         # Snapshot: Get rid of crazy-bright sources, really super-extended sources, and sources with high residuals after fit
-        os.system('stilts tpipe in='+sparse+' cmd=\'select ((local_rms<1.0)&&((int_flux/peak_flux)<3)&&((residual_std/peak_flux)<0.1))\' out=temp_crop.fits')
-        # Match GLEAM with NVSS/SUMSS
-        os.system('stilts tmatch2 matcher=sky params=30 in1='+nscat+' in2=temp_crop.fits out=temp_ns_match.fits values1="RAJ2000 DEJ2000" values2="ra dec" fixcols="dups" suffix1="_ns" suffix2=""')
+        data = data[(data['local_rms']<1.0) & ((data['int_flux']/data['peak_flux'])<3) & ((data['residual_std']/data['peak_flux'])<0.1)]
+        # Match GLEAM with NVSS/SUMSS, in the order of the NVSS/SUMSS catalogue
+        i, j, sep = cached_index(nscat).match(data['ra'], data['dec'], 30.)
+        data = data[j[np.argsort(i, kind="mergesort")]]
         # Keep only basic aegean headings
-        os.system('stilts tpipe in=temp_ns_match.fits cmd=\'keepcols "ra dec peak_flux err_peak_flux int_flux err_int_flux local_rms a err_a b err_b pa err_pa psf_a psf_b psf_pa residual_std flags"\' out='+outputfile)
-
-        os.remove('temp_crop.fits')
-        os.remove('temp_ns_match.fits')
-
-        hdu = fits.open(outputfile)
-        data = hdu[1].data
-    else:
-        hdu = fits.open(sparse)
-        data = hdu[1].data
+        data = data[KEEP_COLUMNS]
 
     x = data['ra']
     if max(x) > 360.:
         # raise ValueError("RA goes higher than 360 degrees ({}: {})! Panic!".format(np.where(x == max(x)), 
         #                                                                            max(x)))
-        print "RA goes higher than 360 degrees! Panic!"
+        print("RA goes higher than 360 degrees! Panic!")
         sys.exit(1)
     y = data['dec']
       
     # Downselect to unresolved sources
 
-    mask=[]
     # Filter out any sources where Aegean's flags weren't zero
-    indices = np.where((data['flags']==0) & ((data['peak_flux']/data['local_rms']) >= options.minsnr))
-    mask.extend(indices[0])
-    mask = np.array(mask)
+    mask = (data['flags']==0) & ((data['peak_flux']/data['local_rms']) >= options.minsnr)
 
     tab = Table(data[mask])
     tab.description = "Sources selected for PSF calculation."
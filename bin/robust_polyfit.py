@@ -0,0 +1,153 @@
+from __future__ import print_function, division
+
+import numpy as np
+
+
+def sigma_clip_mask(values, n=3, mask=None):
+    """Boolean mask of the values within n standard deviations of the median.
+
+    If mask is given, the median and standard deviation are calculated from
+    the masked values only, but every value is tested against them.
+    """
+    sample = values if mask is None else values[mask]
+    median = np.median(sample)
+    std = np.nanstd(sample)
+    return (values > median - n*std) & (values < median + n*std)
+
+
+def top_n_threshold(values, n):
+    """The n'th largest value (counting from zero), as in sorted(values, reverse=True)[n].
+
+    If there are not more than n values then every value is above the
+    returned threshold.
+    """
+    values = np.asarray(values)
+    if n >= len(values):
+        return -np.inf
+    k = len(values) - 1 - n
+    return np.partition(values, k)[k]
+
+
+def design_matrix(xs, order):
+    """Columns x1^order ... x1^0, then x2^order ... x2^1 for each further coordinate.
+
+    The polynomials of the extra coordinates share the constant term of the first.
+    """
+    columns = [np.vander(xs[0], order+1)]
+    for x in xs[1:]:
+        columns.append(np.vander(x, order+1)[:, :-1])
+    return np.hstack(columns)
+
+
+def weighted_lstsq(A, y, w):
+    """Solve A.c = y, weighting each row by w, in the same way as np.polyfit."""
+    lhs = A * w[:, np.newaxis]
+    rhs = y * w
+    scale = np.sqrt((lhs*lhs).sum(axis=0))
+    lhs /= scale
+    c, resids, rank, s = np.linalg.lstsq(lhs, rhs, len(y)*np.finfo(y.dtype).eps)
+    return (c.T/scale).T
+
+
+def split_coefficients(c, ncoords, order):
+    """Split a joint solution into one np.poly1d coefficient array per coordinate."""
+    coefficients = [c[:order+1]]
+    for i in range(1, ncoords):
+        start = order+1 + (i-1)*order
+        coefficients.append(np.append(c[start:start+order], 0.))
+    return coefficients
+
+
+def evaluate(coefficients, xs):
+    """Evaluate the sum of the polynomials for each coordinate."""
+    model = np.polyval(coefficients[0], xs[0])
+    for P, x in zip(coefficients[1:], xs[1:]):
+        model += np.polyval(P, x)
+    return model
+
+
+def robust_polyfit(xs, y, w, order=5, nsigma=3., maxiter=1):
+    """Weighted polynomial fit with iterative sigma-clipping of the residuals.
+
+    xs is a list of coordinate arrays. With one coordinate this is the same as
+    np.polyfit; with several, the sum of one polynomial per coordinate is
+    fitted in a single least-squares solve (e.g. Dec and RA offset jointly).
+
+    After each fit, points whose residuals are more than nsigma standard
+    deviations from the median residual (of the points still in use) are
+    rejected and the model re-fitted, until no more points change or maxiter
+    clipping passes have been made.
+
+    Returns a list of coefficient arrays, highest power first as for
+    np.poly1d, one for each coordinate (only the first has a constant term),
+    and the boolean mask of the points used in the final fit.
+    """
+    xs = [np.asarray(x, dtype=np.float64) for x in xs]
+    y = np.asarray(y, dtype=np.float64)
+    w = np.asarray(w, dtype=np.float64)
+    A = design_matrix(xs, order)
+    mask = np.ones(len(y), dtype=bool)
+    for i in range(maxiter+1):
+        c = weighted_lstsq(A[mask], y[mask], w[mask])
+        if i == maxiter:
+            break
+        new_mask = sigma_clip_mask(y - evaluate(split_coefficients(c, len(xs), order), xs),
+                                   nsigma, mask=None if i == 0 else mask)
+        if np.array_equal(new_mask, mask):
+            break
+        mask = new_mask
+    return split_coefficients(c, len(xs), order), mask
+
+
+def normal_equations(xs, y, w, order):
+    """Weighted normal equations for fitting y with one polynomial per coordinate.
+
+    Returns B^T.B where the columns of B are x^order ... x^0 for each
+    coordinate in turn and finally y, each row weighted by w as for
+    np.polyfit. These are sufficient statistics: the matrices for separate
+    sets of points can be added together and solved with
+    solve_normal_equations as if all the points had been fitted at once.
+    """
+    columns = [np.vander(np.asarray(x, dtype=np.float64), order+1) for x in xs]
+    columns.append(np.asarray(y, dtype=np.float64)[:, np.newaxis])
+    B = np.hstack(columns) * np.asarray(w, dtype=np.float64)[:, np.newaxis]
+    return B.T.dot(B)
+
+
+def solve_normal_equations(M, columns, known=None):
+    """Least-squares solution for a subset of the columns of augmented normal equations.
+
+    M is from normal_equations (the last row/column is y). known is an
+    optional list of (columns, coefficients) for models that have already
+    been fitted and are subtracted from y first, e.g. the Dec polynomial
+    before fitting the RA offsets.
+    """
+    columns = np.asarray(columns)
+    rhs = M[columns, -1].copy()
+    if known is not None:
+        for cols, coefficients in known:
+            rhs -= M[np.ix_(columns, np.asarray(cols))].dot(coefficients)
+    lhs = M[np.ix_(columns, columns)]
+    # Scale the columns to unit length to keep the high powers well-conditioned
+    scale = np.sqrt(np.diag(lhs))
+    scale[scale == 0] = 1.
+    c = np.linalg.lstsq(lhs/np.outer(scale, scale), rhs/scale, rcond=None)[0]
+    return c/scale
+
+
+def solve_snapshot_fit(M, order, joint=False):
+    """Dec and RA-offset coefficients from normal equations of (Dec, RA offset, log ratio).
+
+    Either the Dec polynomial is fitted and then the RA-offset polynomial
+    is fitted to what remains, as polyfit_snapshots.py does, or both are
+    fitted together. The RA polynomial has no constant term when fitted
+    jointly.
+    """
+    dec_cols = list(range(order+1))
+    ra_cols = list(range(order+1, 2*(order+1)))
+    if joint is True:
+        c = solve_normal_equations(M, dec_cols + ra_cols[:-1])
+        return split_coefficients(c, 2, order)
+    P_dec = solve_normal_equations(M, dec_cols)
+    P_ra = solve_normal_equations(M, ra_cols, known=[(dec_cols, P_dec)])
+    return [P_dec, P_ra]
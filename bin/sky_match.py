@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division
+
+import os
+import tempfile
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from astropy.table import Table, hstack, Column
+
+from argparse import ArgumentParser
+
+
+def radec_to_xyz(ra, dec):
+    """Convert RA and Dec (degrees) to unit vectors, shape (n, 3)."""
+    ra = np.radians(np.asarray(ra, dtype=np.float64))
+    dec = np.radians(np.asarray(dec, dtype=np.float64))
+    cosdec = np.cos(dec)
+    return np.column_stack((cosdec*np.cos(ra), cosdec*np.sin(ra), np.sin(dec)))
+
+
+def arcsec_to_chord(radius):
+    """Convert an angular separation (arcsec) to a chord length on the unit sphere."""
+    return 2*np.sin(np.radians(radius/3600.)/2)
+
+
+def chord_to_arcsec(chord):
+    """Convert a chord length on the unit sphere to an angular separation (arcsec)."""
+    return np.degrees(2*np.arcsin(np.clip(chord/2, 0, 1)))*3600.
+
+
+def best_pairs(i, j, sep):
+    """Select the best symmetric matches from a list of candidate pairs.
+
+    Pairs are accepted in order of increasing separation, so that no row of
+    either table appears in more than one pair (as in stilts find=best).
+    """
+    order = np.argsort(sep, kind="mergesort")
+    i, j, sep = i[order], j[order], sep[order]
+    # Most candidates are unique already: a pair whose rows appear in no other
+    # pair is always kept, so only the contested ones are resolved by hand
+    _, i_inverse, i_counts = np.unique(i, return_inverse=True, return_counts=True)
+    _, j_inverse, j_counts = np.unique(j, return_inverse=True, return_counts=True)
+    keep = (i_counts[i_inverse] == 1) & (j_counts[j_inverse] == 1)
+    used_i = set()
+    used_j = set()
+    for k in np.where(~keep)[0]:
+        if i[k] not in used_i and j[k] not in used_j:
+            keep[k] = True
+            used_i.add(i[k])
+            used_j.add(j[k])
+    return i[keep], j[keep], sep[keep]
+
+
+class SkyIndex(object):
+    """A KD-tree over the unit vectors of a set of sky positions.
+
+    Build this once for a catalogue (e.g. a sky model) and match any number
+    of other catalogues against it.
+    """
+    def __init__(self, ra, dec):
+        ra = np.asarray(ra, dtype=np.float64)
+        dec = np.asarray(dec, dtype=np.float64)
+        self.nrows = len(ra)
+        # Positions that are not finite can't be matched and would break the tree
+        self.rows = np.where(np.isfinite(ra) & np.isfinite(dec))[0]
+        self.xyz = radec_to_xyz(ra[self.rows], dec[self.rows])
+        self.tree = cKDTree(self.xyz)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def save(self, filename):
+        """Save the indexed positions, so that the index can be rebuilt without the catalogue."""
+        with open(filename, "wb") as f:
+            np.savez(f, nrows=self.nrows, rows=self.rows, xyz=self.xyz)
+
+    @classmethod
+    def load(cls, filename):
+        """Rebuild an index saved with save()."""
+        index = cls.__new__(cls)
+        with np.load(filename) as f:
+            index.nrows = int(f["nrows"])
+            index.rows = f["rows"]
+            index.xyz = f["xyz"]
+        index.tree = cKDTree(index.xyz)
+        return index
+
+    def isolated(self, radius):
+        """Boolean mask of the indexed rows with no other row within radius (arcsec).
+
+        Rows without a valid position count as isolated, as in stilts
+        tmatch1 action=keep0.
+        """
+        pairs = self.tree.query_pairs(arcsec_to_chord(radius), output_type="ndarray")
+        mask = np.ones(self.nrows, dtype=bool)
+        mask[self.rows[pairs.ravel()]] = False
+        return mask
+
+    def candidates(self, ra, dec, radius):
+        """Find every pair within radius (arcsec).
+
+        Returns the row indices into the indexed catalogue, the row indices
+        into the (ra, dec) arrays, and the separations in arcsec.
+        """
+        ra = np.asarray(ra, dtype=np.float64)
+        dec = np.asarray(dec, dtype=np.float64)
+        rows = np.where(np.isfinite(ra) & np.isfinite(dec))[0]
+        other = cKDTree(radec_to_xyz(ra[rows], dec[rows]))
+        pairs = self.tree.sparse_distance_matrix(other, arcsec_to_chord(radius), output_type="ndarray")
+        i = self.rows[pairs["i"]]
+        j = rows[pairs["j"]]
+        return i, j, chord_to_arcsec(pairs["v"])
+
+    def match(self, ra, dec, radius):
+        """Best symmetric match of the (ra, dec) positions within radius (arcsec).
+
+        Returns matched row indices into the indexed catalogue and into the
+        (ra, dec) arrays, and the separations in arcsec.
+        """
+        return best_pairs(*self.candidates(ra, dec, radius))
+
+
+def isolated(ra, dec, radius):
+    """Boolean mask of the sources with no other source within radius (arcsec).
+
+    Works on unit vectors, so there is nothing special about RA wrapping or
+    the poles. Sources without a valid position count as isolated.
+    """
+    return SkyIndex(ra, dec).isolated(radius)
+
+
+def cached_index(catalogue, racol="RAJ2000", deccol="DEJ2000", index_file=None):
+    """A SkyIndex of a reference catalogue, saved alongside it for next time.
+
+    The saved index (by default <catalogue>_skyindex.npz) is used while it is
+    newer than the catalogue, so a large catalogue that is matched against
+    over and over is only read once. If the index can't be written, e.g. in
+    a read-only directory, it is just rebuilt every time.
+    """
+    if index_file is None:
+        index_file = os.path.splitext(catalogue)[0] + "_skyindex.npz"
+    if os.path.exists(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(catalogue):
+        return SkyIndex.load(index_file)
+    table = Table.read(catalogue)
+    index = SkyIndex(table[racol], table[deccol])
+    # Write under a unique name and move it into place, in case several jobs get here at once
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(suffix=".npz", dir=os.path.dirname(os.path.abspath(index_file)))
+        os.close(fd)
+        index.save(tmp)
+        os.rename(tmp, index_file)
+    except (IOError, OSError) as e:
+        print("Could not save sky index {0}: {1}".format(index_file, e))
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+    return index
+
+
+def join_matches(table1, table2, i, j, sep):
+    """Join matched rows of two tables side by side.
+
+    Like stilts tmatch2, columns present in both tables get suffixes _1 and
+    _2, and the separation is added as a final Separation column (arcsec).
+    """
+    joined = hstack([table1[i], table2[j]], join_type="exact")
+    joined.add_column(Column(sep, name="Separation", unit="arcsec"))
+    return joined
+
+
+def match_catalogues(index, table1, table2, radius, racol2="ra", deccol2="dec", outfile=None):
+    """Match table2 against an index built from table1 and join the matched rows.
+
+    If outfile is given the joined table is also written there as FITS.
+    """
+    i, j, sep = index.match(table2[racol2], table2[deccol2], radius)
+    joined = join_matches(table1, table2, i, j, sep)
+    if outfile is not None:
+        joined.write(outfile, overwrite=True)
+    return joined
+
+
+def main():
+    """
+    """
+
+    ps = ArgumentParser(description="Cross-match two catalogues on the sky, keeping the best "
+                                    "symmetric matches (equivalent to stilts tmatch2 matcher=sky).")
+    ps.add_argument("in1", type=str, help="First catalogue, e.g. the sky model.")
+    ps.add_argument("in2", type=str, help="Second catalogue, e.g. source-finding results.")
+    ps.add_argument("out", type=str, help="Output matched catalogue.")
+    ps.add_argument("--radius", type=float, default=45.,
+                    help="Maximum separation in arcsec (default = 45)")
+    ps.add_argument("--values1", type=str, nargs=2, default=["RAJ2000", "DEJ2000"],
+                    help="RA and Dec columns of the first catalogue (default = RAJ2000 DEJ2000)")
+    ps.add_argument("--values2", type=str, nargs=2, default=["ra", "dec"],
+                    help="RA and Dec columns of the second catalogue (default = ra dec)")
+
+    args = ps.parse_args()
+
+    table1 = Table.read(args.in1)
+    table2 = Table.read(args.in2)
+    index = SkyIndex(table1[args.values1[0]], table1[args.values1[1]])
+    joined = match_catalogues(index, table1, table2, args.radius,
+                              racol2=args.values2[0], deccol2=args.values2[1], outfile=args.out)
+    print("Matched {0} of {1} rows".format(len(joined), len(table2)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import os
+import re
+import sqlite3
+
+import numpy as np
+
+from argparse import ArgumentParser
+
+schema = """
+CREATE TABLE IF NOT EXISTS snapshot
+(
+obs_id INT,
+subband TEXT,
+catalogue TEXT,
+mtime FLOAT,
+size INT,
+poly_order INT,
+threshold FLOAT,
+nsrc INT,
+normal BLOB,
+PRIMARY KEY (obs_id, subband)
+);
+"""
+
+
+def snapshot_key(fitsimage):
+    """Return the (obsid, sub-band) of a snapshot image, e.g. (1200000000, "MFS") for
+    1200000000_deep-MFS-image-pb_warp.fits.
+    """
+    fl = os.path.basename(fitsimage)
+    m = re.search(r"-(MFS|\d{4})-", fl)
+    if m is not None:
+        subband = m.group(1)
+    else:
+        subband = fl[10:].replace(".fits", "")
+    return int(fl[0:10]), subband
+
+
+class SnapshotStatsStore(object):
+    """Per-snapshot normal equations of the flux-scale polynomial fit.
+
+    Each snapshot's matrix (see robust_polyfit.normal_equations) is stored
+    with the modification time and size of the cross-matched catalogue it was
+    calculated from, and the fit settings; it is only used while all of these
+    are unchanged.
+    """
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.conn = sqlite3.connect(dbfile, timeout=60)
+        self.conn.execute(schema)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def get(self, obsid, subband, catalogue, poly_order, threshold):
+        """Return the stored matrix for a snapshot, or None if it is missing or out of date."""
+        st = os.stat(catalogue)
+        row = self.conn.execute("SELECT catalogue, mtime, size, poly_order, threshold, normal FROM snapshot "
+                                "WHERE obs_id=? AND subband=?", (obsid, subband)).fetchone()
+        if row is None or row[:5] != (os.path.abspath(catalogue), st.st_mtime, st.st_size, poly_order, threshold):
+            return None
+        n = 2*(poly_order+1)+1
+        return np.frombuffer(row[5], dtype="<f8").reshape(n, n)
+
+    def put(self, obsid, subband, catalogue, poly_order, threshold, nsrc, M):
+        """Store the matrix for a snapshot, replacing any previous one."""
+        st = os.stat(catalogue)
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO snapshot "
+                              "(obs_id, subband, catalogue, mtime, size, poly_order, threshold, nsrc, normal) "
+                              "VALUES (?,?,?,?,?,?,?,?,?)",
+                              (obsid, subband, os.path.abspath(catalogue), st.st_mtime, st.st_size,
+                               poly_order, threshold, nsrc,
+                               sqlite3.Binary(np.ascontiguousarray(M, dtype="<f8").tobytes())))
+
+    def remove(self, obsid, subband):
+        """Forget a snapshot, e.g. one that has been flagged."""
+        with self.conn:
+            self.conn.execute("DELETE FROM snapshot WHERE obs_id=? AND subband=?", (obsid, subband))
+
+    def snapshots(self):
+        """List the (obsid, sub-band, number of sources) of every stored snapshot."""
+        return self.conn.execute("SELECT obs_id, subband, nsrc FROM snapshot ORDER BY subband, obs_id").fetchall()
+
+
+def main():
+    """
+    """
+
+    ps = ArgumentParser(description="List or remove the snapshots whose normal equations are stored "
+                                    "for incremental fitting by polyfit_snapshots.py.")
+    ps.add_argument("store", type=str, help="Store file (as given to polyfit_snapshots.py --incremental).")
+    ps.add_argument("--remove", type=str, nargs=2, action="append", default=[], metavar=("OBSID", "SUBBAND"),
+                    help="Remove a snapshot; can be repeated.")
+    args = ps.parse_args()
+
+    store = SnapshotStatsStore(args.store)
+    for obsid, subband in args.remove:
+        store.remove(int(obsid), subband)
+    for obsid, subband, nsrc in store.snapshots():
+        print("{0} {1} {2}".format(obsid, subband, nsrc))
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,44 +4,152 @@ from __future__ import print_function
 __author__ = "PaulHancock & Natasha Hurley-Walker"
 
 import os
-import sqlite3
 import sys
+import json
+import time
+import socket
+import sqlite3
+import tempfile
 
 db='/group/mwasci/nhurleywalker/GLEAM-X-pipeline/db/GLEAM-X.sqlite'
 
-def queue_job(job_id, task_id, submission_time, obs_id, user, batch_file, stderr, stdout, task):
-    conn = sqlite3.connect(db)
-    cur = conn.cursor()
-    cur.execute("""INSERT INTO processing
+# If GXTRACKSPOOL is set (GLEAM-X-pipeline.profile sets it), start/finish/fail
+# events are written as small files in that directory instead of going
+# straight to the database, and `track_task.py collect` merges them in later
+# from the login node; queueing a job also collects. This keeps the array
+# tasks from contending for the database lock.
+spool = os.environ.get('GXTRACKSPOOL', None)
+
+# How long (seconds) to wait for another process to release the database
+BUSY_TIMEOUT = 60
+
+# How many times to try again if the database is still locked after that
+RETRIES = 5
+
+
+def connect(dbfile=None):
+    """Open the database with a long busy timeout.
+
+    The database lives on the shared filesystem, so it keeps the default
+    rollback journal: WAL's shared-memory index doesn't work across nodes.
+    """
+    if dbfile is None:
+        dbfile = db
+    conn = sqlite3.connect(dbfile, timeout=BUSY_TIMEOUT)
+    return conn
+
+
+def execute(sql, rows, dbfile=None):
+    """Run a statement for each of rows in one transaction, retrying while the database is locked.
+
+    Returns the number of rows changed.
+    """
+    for attempt in range(RETRIES+1):
+        conn = connect(dbfile)
+        try:
+            with conn:
+                cur = conn.executemany(sql, rows)
+            return cur.rowcount
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e) or attempt == RETRIES:
+                raise
+            time.sleep(2**attempt)
+        finally:
+            conn.close()
+
+
+def queue_jobs(job_id, task_ids, submission_time, obs_ids, user, batch_file, stderr, stdout, task):
+    """Record a whole array submission (one task per obs_id) in one transaction."""
+    execute("""INSERT INTO processing
     ( job_id, task_id, submission_time, obs_id, user, batch_file, stderr, stdout, task, status)
     VALUES ( ?,?,?,?,?,?,?,?,?, 'queued')
-    """, (job_id, task_id, submission_time, obs_id, user, batch_file, stderr, stdout, task))
-    conn.commit()
-    conn.close()
+    """, [(job_id, task_id, submission_time, obs_id, user, batch_file, stderr, stdout, task)
+          for task_id, obs_id in zip(task_ids, obs_ids)])
+
+
+def queue_job(job_id, task_id, submission_time, obs_id, user, batch_file, stderr, stdout, task):
+    queue_jobs(job_id, [task_id], submission_time, [obs_id], user, batch_file, stderr, stdout, task)
+
+
+# The statement for each of the directives that update a job
+updates = {'start': """UPDATE processing SET status='started', start_time=? WHERE job_id =? AND task_id=?""",
+           'finish': """UPDATE processing SET status='finished', end_time=? WHERE job_id =? AND task_id=?""",
+           'fail': """UPDATE processing SET status='failed', end_time=? WHERE job_id =? AND task_id=?"""}
+
+
+def update_job(directive, job_id, task_id, time):
+    if spool is not None:
+        spool_event(spool, directive, job_id, task_id, time)
+    else:
+        execute(updates[directive], [(time, job_id, task_id)])
 
 
 def start_job(job_id, task_id, start_time):
-    conn = sqlite3.connect(db)
-    cur = conn.cursor()
-    cur.execute("""UPDATE processing SET status='started', start_time=? WHERE job_id =? AND task_id=?""", (start_time, job_id, task_id))
-    conn.commit()
-    conn.close()
+    update_job('start', job_id, task_id, start_time)
 
 
 def finish_job(job_id, task_id, end_time):
-    conn = sqlite3.connect(db)
-    cur = conn.cursor()
-    cur.execute("""UPDATE processing SET status='finished', end_time=? WHERE job_id =? AND task_id=?""", (end_time, job_id, task_id))
-    conn.commit()
-    conn.close()
+    update_job('finish', job_id, task_id, end_time)
 
 
 def fail_job(job_id, task_id, time):
-    conn = sqlite3.connect(db)
-    cur = conn.cursor()
-    cur.execute("""UPDATE processing SET status='failed', end_time=? WHERE job_id =? AND task_id=?""", (time, job_id, task_id))
-    conn.commit()
-    conn.close()
+    update_job('fail', job_id, task_id, time)
+
+
+def spool_event(spooldir, directive, job_id, task_id, time):
+    """Write an event to the spool directory, without touching the database."""
+    event = {'directive': directive, 'job_id': job_id, 'task_id': task_id, 'time': time}
+    # Written under a temporary name and then renamed, so the collector never sees half a file
+    prefix = "{0}_{1}_{2}_".format(job_id, task_id, directive)
+    fd, tmp = tempfile.mkstemp(prefix='.' + prefix, dir=spooldir)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(event, f)
+    os.rename(tmp, os.path.join(spooldir, "{0}{1}_{2}.json".format(prefix, socket.gethostname(), os.getpid())))
+
+
+def collect(spooldir, dbfile=None):
+    """Merge the spooled events into the processing table in one transaction.
+
+    Events are applied in time order and their files removed. Events for jobs
+    that haven't been queued in the database yet are left for next time.
+    Returns the numbers of events applied and left.
+    """
+    events = []
+    for fl in os.listdir(spooldir):
+        if fl.startswith('.') or not fl.endswith('.json'):
+            continue
+        path = os.path.join(spooldir, fl)
+        try:
+            with open(path) as f:
+                events.append((json.load(f), path))
+        except ValueError:
+            print("Ignoring unreadable event file {0}".format(path))
+    # A task's start must be applied before its finish, even if they happen in the same second
+    order = {'start': 0, 'finish': 1, 'fail': 1}
+    events.sort(key=lambda e: (e[0]['time'], order[e[0]['directive']]))
+
+    applied = []
+    for attempt in range(RETRIES+1):
+        conn = connect(dbfile)
+        try:
+            with conn:
+                applied = []
+                for event, path in events:
+                    cur = conn.execute(updates[event['directive']], (event['time'], event['job_id'], event['task_id']))
+                    if cur.rowcount > 0:
+                        applied.append(path)
+            # Earlier versions of collect switched the database to WAL, which sticks to the file
+            conn.execute("PRAGMA journal_mode=DELETE")
+            break
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e) or attempt == RETRIES:
+                raise
+            time.sleep(2**attempt)
+        finally:
+            conn.close()
+    for path in applied:
+        os.remove(path)
+    return len(applied), len(events) - len(applied)
 
 
 def require(args, reqlist):
@@ -59,25 +167,33 @@ if __name__ == "__main__":
 
     import argparse
     ps = argparse.ArgumentParser(description='track tasks')
-    ps.add_argument('directive', type=str, help='Directive', default=None)
+    ps.add_argument('directive', type=str, help='Directive: queue/start/finish/fail, or collect to merge the spooled events', default=None)
     ps.add_argument('--jobid', type=int, help='Job id from slurm', default=None)
-    ps.add_argument('--taskid', type=int, help='Task id from slurm', default=None)
+    ps.add_argument('--taskid', type=int, help='Task id from slurm (for queue with several obs_ids, the first task id)', default=None)
     ps.add_argument('--task', type=str, help='task being run', default=None)
     ps.add_argument('--submission_time', type=int, help="submission time", default=None)
     ps.add_argument('--start_time', type=int, help='job start time', default=None)
     ps.add_argument('--finish_time', type=int, help='job finish time', default=None)
     ps.add_argument('--batch_file', type=str, help='batch file name', default=None)
-    ps.add_argument('--obs_id', type=int, help='observation id', default=None)
+    ps.add_argument('--obs_id', type=int, nargs='+', help='observation id; give several to queue a whole job array, one task per obs_id', default=None)
     ps.add_argument('--stderr', type=str, help='standard error log', default=None)
     ps.add_argument('--stdout', type=str, help='standard out log', default=None)
+    ps.add_argument('--spool', type=str, help='spool directory (default = $GXTRACKSPOOL)', default=spool)
+    ps.add_argument('--db', type=str, help='database file (default = {0})'.format(db), default=db)
 
     args = ps.parse_args()
 
     args.user = os.environ['USER']
+    spool = args.spool
+    db = args.db
 
     if args.directive.lower() == 'queue':
         require(args, ['jobid', 'taskid', 'submission_time', 'obs_id', 'user', 'batch_file', 'stderr', 'stdout', 'task'])
-        queue_job(args.jobid, args.taskid, args.submission_time, args.obs_id, args.user, args.batch_file, args.stderr, args.stdout, args.task)
+        task_ids = range(args.taskid, args.taskid + len(args.obs_id))
+        queue_jobs(args.jobid, task_ids, args.submission_time, args.obs_id, args.user, args.batch_file, args.stderr, args.stdout, args.task)
+        # Submission happens on the login node, so merge in the events of the earlier jobs
+        if spool is not None:
+            collect(spool)
     elif args.directive.lower() == 'start':
         require(args, ['jobid', 'taskid', 'start_time'])
         start_job(args.jobid, args.taskid, args.start_time)
@@ -87,5 +203,9 @@ if __name__ == "__main__":
     elif args.directive.lower() == 'fail':
         require(args, ['jobid', 'taskid', 'finish_time'])
         fail_job(args.jobid, args.taskid, args.finish_time)
+    elif args.directive.lower() == 'collect':
+        require(args, ['spool'])
+        applied, left = collect(args.spool)
+        print("Applied {0} events; {1} left for jobs not queued yet".format(applied, left))
     else:
-        print("I don't know what you are asking; please include a queue/start/finish/fail directive")
+        print("I don't know what you are asking; please include a queue/start/finish/fail/collect directive")
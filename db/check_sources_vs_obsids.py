@@ -1,3 +1,4 @@
+import os
 import sys
 from astropy.coordinates import SkyCoord
 from astropy import wcs
@@ -5,11 +6,15 @@ from astropy.io import fits
 from astropy.time import Time
 import astropy.units as u
 import json
+import hashlib
 import sqlite3
 import numpy as np
+from multiprocessing import Pool
+from optparse import OptionParser
 from populate_sources_table import Source
-from check_src_fov import check_coords
+from check_src_fov import check_radec
 from beam_value_at_radec import beam_value
+from make_db import migrate
 
 __author__ = "Natasha Hurley-Walker"
 
@@ -22,19 +27,50 @@ def insert_app(obs_id, source, appflux, infov, cur):
                 (obs_id, source, appflux, infov))
     return
 
+def insert_apps(rows, cur):
+    """Write many (obs_id, source, appflux, infov, srcversion) rows in one statement."""
+    cur.executemany(""" INSERT OR REPLACE INTO calapparent
+                (obs_id, source, appflux, infov, srcversion)
+                VALUES (?, ?, ?, ?, ?); """,
+                rows)
+    return
+
+def source_version(ra, dec, flux, alpha, beta):
+    """Short hash of a source's parameters, to tell when its apparent fluxes are out of date."""
+    return hashlib.md5(repr((ra, dec, flux, alpha, beta)).encode('utf-8')).hexdigest()[:16]
+
 def get_srcs(cur):
     srciter = cur.execute("""
     SELECT source, ra, dec, flux, alpha, beta
     FROM sources""")
     return srciter
 
-# NB: Currently selects all observations; may want to finesse this later
-def get_obs(cur):
-    obsiter = cur.execute("""
+def get_obs(cur, obsids=None, start=None, end=None):
+    """Select observations, optionally from a list of obs_ids and/or a range of
+    start times (GPS seconds, which is also how obs_ids are numbered)."""
+    query = """
     SELECT obs_id, ra_pointing, dec_pointing, cenchan, starttime, delays
-    FROM observation """)
+    FROM observation """
+    conditions = []
+    params = []
+    if obsids is not None:
+        conditions.append("obs_id IN ({0})".format(",".join("?"*len(obsids))))
+        params.extend(obsids)
+    if start is not None:
+        conditions.append("obs_id >= ?")
+        params.append(start)
+    if end is not None:
+        conditions.append("obs_id <= ?")
+        params.append(end)
+    if conditions:
+        query += "WHERE " + " AND ".join(conditions)
+    obsiter = cur.execute(query, params)
     return obsiter
 
+def get_versions(cur, obs_id):
+    """The source versions that an observation's apparent fluxes were computed with."""
+    return dict(cur.execute("SELECT source, srcversion FROM calapparent WHERE obs_id = ?", (obs_id,)))
+
 def create_wcs(ra, dec, cenchan):
     pixscale = 0.5 / float(cenchan)
     w = wcs.WCS(naxis=2)
@@ -47,26 +83,119 @@ def create_wcs(ra, dec, cenchan):
     w._naxis2 = 8000
     return w
 
+def apparent_fluxes(obs, srcs):
+    """Apparent flux and field-of-view flag of every source in one observation.
+
+    obs is a row from get_obs; srcs is a tuple of (names, ra, dec, flux, alpha,
+    versions) arrays. All the sources are transformed to Alt/Az and put through
+    the beam model in a single call. Returns the rows to insert into calapparent.
+    """
+    obs_id, ra_pointing, dec_pointing, cenchan, starttime, delays = obs
+    names, ra, dec, flux, alpha, versions = srcs
+    w = create_wcs(ra_pointing, dec_pointing, cenchan)
+    t = Time(int(starttime), format='gps')
+    freq = 1.28 * cenchan
+    # Delays are stored as a string by json
+    xx, yy = beam_value(ra, dec, t, json.loads(delays), freq*1.e6)
+    # Ignoring spectral curvature parameter for now
+    appflux = flux * ( (freq / 150.)**(alpha) ) * (np.atleast_1d(xx)+np.atleast_1d(yy))/2.
+    appflux[np.isnan(appflux)] = 0.0
+    infov = check_radec(w, ra, dec)
+    return [(obs_id, name, float(a), bool(f), v) for name, a, f, v in zip(names, appflux, infov, versions)]
+
+def _apparent_fluxes(args):
+    # Pool.imap only passes a single argument
+    return apparent_fluxes(*args)
+
+def subset(srcs, idx):
+    """The sources at the given indices, in the form apparent_fluxes takes."""
+    names, ra, dec, flux, alpha, versions = srcs
+    return ([names[i] for i in idx], ra[idx], dec[idx], flux[idx], alpha[idx], [versions[i] for i in idx])
+
 if __name__ == "__main__":
-    conn = sqlite3.connect(dbfile)
+    usage="Usage: %prog [options]\n"
+    parser = OptionParser(usage=usage)
+    parser.add_option('--db',dest="db",default=dbfile,
+                      help="Database file (default = %default)")
+    parser.add_option('-j','--processes',dest="processes",default=1,type="int",
+                      help="Number of processes to spread the observations over (default = %default)")
+    parser.add_option('-q','--quiet',dest="quiet",default=False,action="store_true",
+                      help="Don't print every observation and source")
+    parser.add_option('-i','--incremental',dest="incremental",default=False,action="store_true",
+                      help="Only compute observation/source pairs that are missing, or whose source has changed since")
+    parser.add_option('--obsids',dest="obsids",default=None,
+                      help="Only these observations: a comma-separated list, or a file with one obs_id per line")
+    parser.add_option('--start',dest="start",default=None,type="int",
+                      help="Only observations starting at or after this GPS time")
+    parser.add_option('--end',dest="end",default=None,type="int",
+                      help="Only observations starting at or before this GPS time")
+    (options, args) = parser.parse_args()
+
+    obsids = None
+    if options.obsids is not None:
+        if os.path.exists(options.obsids):
+            obsids = [int(l.split()[0]) for l in open(options.obsids) if l.strip()]
+        else:
+            obsids = [int(o) for o in options.obsids.split(',')]
+
+    conn = sqlite3.connect(options.db)
+    # e.g. calapparent.srcversion, for databases made before it existed
+    migrate(conn)
     cur = conn.cursor()
 
     srclist = []
+    versions = []
     for row in get_srcs(cur):
         srclist.append(Source(row[0],SkyCoord(row[1],row[2],unit=u.deg),row[3],row[4],row[5]))
+        versions.append(source_version(*row[1:]))
+    srcs = ([src.name for src in srclist],
+            np.array([src.pos.ra.deg for src in srclist]),
+            np.array([src.pos.dec.deg for src in srclist]),
+            np.array([src.flux for src in srclist]),
+            np.array([src.alpha for src in srclist]),
+            versions)
 
-    for row in get_obs(cur):
-        w = create_wcs(row[1],row[2],row[3])
-        t = Time(int(row[4]), format='gps')
-        freq = 1.28 * row[3]
-        for src in srclist:
-            # Delays are stored as a string by json
-            xx, yy = beam_value(src.pos.ra.deg, src.pos.dec.deg, t, json.loads(row[5]), freq*1.e6)
-            # Ignoring spectral curvature parameter for now
-            appflux = src.flux * ( (freq / 150.)**(src.alpha) ) * (xx+yy)/2.
-            if np.isnan(appflux):
-                appflux = 0.0
-            print row[0], src.name, appflux, check_coords(w, src.pos)
-            insert_app(row[0], src.name, appflux, check_coords(w, src.pos), cur)
+    jobs = []
+    ncomputed = 0
+    nchanged = 0
+    nskipped = 0
+    for obs in get_obs(cur, obsids, options.start, options.end).fetchall():
+        if options.incremental:
+            done = get_versions(cur, obs[0])
+            idx = [i for i, src in enumerate(srclist) if done.get(src.name) != versions[i]]
+            nchanged += sum(1 for i in idx if srclist[i].name in done)
+        else:
+            idx = range(len(srclist))
+        ncomputed += len(idx)
+        nskipped += len(srclist) - len(idx)
+        if len(idx) > 0:
+            jobs.append((obs, subset(srcs, np.array(idx, dtype=int))))
+
+    if options.processes > 1 and len(jobs) > 1:
+        pool = Pool(options.processes)
+        results = pool.imap(_apparent_fluxes, jobs)
+    else:
+        pool = None
+        results = (_apparent_fluxes(job) for job in jobs)
+
+    # Only this process writes to the database, in a single transaction;
+    # each observation is written as it arrives rather than held in memory
+    for obsrows in results:
+        if not options.quiet:
+            for obs_id, name, appflux, infov, version in obsrows:
+                print obs_id, name, appflux, infov
+        insert_apps(obsrows, cur)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    nremoved = 0
+    if options.incremental:
+        # Sources that have been taken out of the sources table would otherwise keep their old rows
+        nremoved = cur.execute("DELETE FROM calapparent WHERE source NOT IN (SELECT source FROM sources)").rowcount
     conn.commit()
     conn.close()
+
+    print "Computed {0} observation/source pairs ({1} for changed sources) over {2} observations; skipped {3} up to date".format(
+          ncomputed, nchanged, len(jobs), nskipped)
+    if nremoved > 0:
+        print "Removed {0} observation/source pairs for sources no longer in the sources table".format(nremoved)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import os,sys
+import numpy as np
 from astropy import wcs
 from astropy.io import fits
 from astropy.coordinates import SkyCoord
@@ -15,6 +16,13 @@ def check_coords(w, coords):
     else:
         return False
 
+def check_radec(w, ra, dec):
+    """Vectorised check_coords: boolean array, True where (ra, dec) fall inside the image."""
+    x, y = w.all_world2pix(np.atleast_1d(ra), np.atleast_1d(dec), 0)
+    # Positions on the far side of a SIN projection come back as NaN, which compares False
+    with np.errstate(invalid='ignore'):
+        return (0 < x) & (x < w._naxis1) & (0 < y) & (y < w._naxis2)
+
 if __name__ == "__main__":
     usage="Usage: %prog [options] <file>\n"
     parser = OptionParser(usage=usage)
@@ -3,9 +3,15 @@ import urllib2
 import json
 import sys
 import os
+import time
 import numpy as np
 import argparse
 import sqlite3
+from multiprocessing.pool import ThreadPool
+
+# The metadata cache is shared with the pipeline scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+from metadata_cache import MetadataCache, OfflineError
 
 __author__ = "PaulHancock & Natasha Hurley-Walker"
 
@@ -14,11 +20,17 @@ BASEURL = 'http://ws.mwatelescope.org/metadata/'
 dbfile = '/group/mwasci/nhurleywalker/GLEAM-X-pipeline/db/GLEAM-X.sqlite'
 
 # Function to call a JSON web service and return a dictionary: This function by Andrew Williams
-def getmeta(service='obs', params=None):
+def getmeta(service='obs', params=None, baseurl=BASEURL, retries=0, backoff=1., cache=None):
     """
     Given a JSON web service ('obs', find, or 'con') and a set of parameters as
     a Python dictionary, return a Python dictionary containing the result.
+
+    Responses come through a MetadataCache (by default one for baseurl).
+    Network errors and server errors (5xx) are tried again up to retries
+    times, waiting backoff seconds and doubling the wait each time.
     """
+    if cache is None:
+        cache = MetadataCache(baseurl=baseurl)
     if params:
         data = urllib.urlencode(params)  # Turn the dictionary into a string with encoded 'name=value' pairs
     else:
@@ -30,17 +42,51 @@ def getmeta(service='obs', params=None):
         print "invalid service name: %s" % service
         return
     # Get the data
-    try:
-        print BASEURL + service + '?' + data
-        result = json.load(urllib2.urlopen(BASEURL + service + '?' + data))
-    except urllib2.HTTPError as error:
-        print "HTTP error from server: code=%d, response:\n %s" % (error.code, error.read())
-        return
-    except urllib2.URLError as error:
-        print "URL or network error: %s" % error.reason
-        return
-    # Return the result dictionary
-    return result
+    for attempt in range(retries+1):
+        try:
+            print cache.baseurl + service + '?' + data
+            result = cache.getmeta(service, params)
+        except OfflineError as error:
+            print error
+            return
+        except urllib2.HTTPError as error:
+            print "HTTP error from server: code=%d, response:\n %s" % (error.code, error.read())
+            if error.code < 500:
+                return
+        except urllib2.URLError as error:
+            print "URL or network error: %s" % error.reason
+        else:
+            # Return the result dictionary
+            return result
+        if attempt < retries:
+            time.sleep(backoff * 2**attempt)
+    return
+
+
+class WebMetadata(object):
+    """Observation metadata from the MWA web service (or anything serving the same API, e.g. a test
+    server), through the local metadata cache."""
+    def __init__(self, baseurl=BASEURL, retries=3, backoff=1., offline=False):
+        self.cache = MetadataCache(baseurl=baseurl, offline=offline)
+        self.retries = retries
+        self.backoff = backoff
+
+    def obs(self, obsid):
+        return getmeta(service='obs', params={'obs_id':obsid}, retries=self.retries,
+                       backoff=self.backoff, cache=self.cache)
+
+
+class JSONMetadata(object):
+    """Observation metadata from a directory of <obsid>.json files, as returned by the 'obs' service."""
+    def __init__(self, directory):
+        self.directory = directory
+
+    def obs(self, obsid):
+        filename = os.path.join(self.directory, "{0}.json".format(obsid))
+        if not os.path.exists(filename):
+            return
+        with open(filename) as f:
+            return json.load(f)
 
 
 #def update_observation(obsid, obsname, cur):
@@ -61,18 +107,7 @@ def getmeta(service='obs', params=None):
 #    return
 
 
-def copy_obs_info(obsid, cur):
-    cur.execute("SELECT count(*) FROM observation WHERE obs_id =?",(obsid,))
-    if cur.fetchone()[0] > 0:
-        print "already imported", obsid
-        return
-    meta = getmeta(service='obs', params={'obs_id':obsid})
-    if meta is None:
-        print obsid, "has no metadata!"
-        return
-    metadata = meta['metadata']
-    
-    cur.execute("""
+insert_obs = """
     INSERT OR REPLACE INTO observation
     (obs_id, projectid,  lst_deg, starttime, duration_sec, obsname, creator,
     azimuth_pointing, elevation_pointing, ra_pointing, dec_pointing,
@@ -82,16 +117,86 @@ def copy_obs_info(obsid, cur):
     nfiles, archived
     )
     VALUES (?,?,?,?,?,?,?,  ?,?,?,?,  ?,?,?,?,   ?,?,?,  ?,?,?,?,?,?,  ?,?);
-    """, (
+    """
+
+def observation_row(obsid, meta):
+    """The observation table row for an obsid, from its 'obs' service metadata."""
+    metadata = meta['metadata']
+    return (
     obsid, meta['projectid'], metadata['local_sidereal_time_deg'], meta['starttime'], meta['stoptime']-meta['starttime'], meta['obsname'], meta['creator'],
     metadata['azimuth_pointing'], metadata['elevation_pointing'], metadata['ra_pointing'], metadata['dec_pointing'],
     meta["rfstreams"]["0"]['frequencies'][12], meta['freq_res'], meta['int_time'], json.dumps(meta["rfstreams"]["0"]["xdelays"]),
     metadata['calibration'], None, metadata['calibrators'],
     None, None, None, None, None, None,
-    len(meta['files']), False))
+    len(meta['files']), False)
+
+def copy_obs_info(obsid, cur, source=None):
+    cur.execute("SELECT count(*) FROM observation WHERE obs_id =?",(obsid,))
+    if cur.fetchone()[0] > 0:
+        print "already imported", obsid
+        return
+    if source is None:
+        source = WebMetadata(retries=0)
+    meta = source.obs(obsid)
+    if meta is None:
+        print obsid, "has no metadata!"
+        return
+    cur.execute(insert_obs, observation_row(obsid, meta))
     #update_observation(obsid, meta['obsname'], cur)
     return
 
+def existing_obsids(cur, ids):
+    """The subset of ids that are already in the observation table, from a single query."""
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS import_ids (obs_id INT PRIMARY KEY)")
+    cur.execute("DELETE FROM import_ids")
+    cur.executemany("INSERT OR IGNORE INTO import_ids VALUES (?)", [(int(i),) for i in ids])
+    cur.execute("SELECT obs_id FROM observation JOIN import_ids USING (obs_id)")
+    existing = set(row[0] for row in cur.fetchall())
+    cur.execute("DELETE FROM import_ids")
+    return existing
+
+def bulk_import(ids, conn, source, threads=8, batch=500):
+    """Import many observations at once.
+
+    Observations already in the database are skipped, the metadata of the
+    rest is fetched by up to threads concurrent requests, and the new rows
+    are inserted batch at a time in a single transaction.
+    Returns the lists of imported obsids and of obsids without metadata.
+    """
+    cur = conn.cursor()
+    existing = existing_obsids(cur, ids)
+    print "{0} of {1} observations already imported".format(len(existing), len(ids))
+    todo = sorted(set(int(i) for i in ids) - existing)
+
+    def fetch(obsid):
+        return obsid, source.obs(obsid)
+
+    pool = ThreadPool(max(1, min(threads, len(todo))))
+    imported = []
+    missing = []
+    rows = []
+    try:
+        for obsid, meta in pool.imap_unordered(fetch, todo):
+            if meta is None:
+                print obsid, "has no metadata!"
+                missing.append(obsid)
+                continue
+            rows.append(observation_row(obsid, meta))
+            imported.append(obsid)
+            if len(rows) >= batch:
+                cur.executemany(insert_obs, rows)
+                rows = []
+        if rows:
+            cur.executemany(insert_obs, rows)
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        pool.close()
+        pool.join()
+    return imported, missing
+
 #def update_grb_links(cur):
 #    # associate each observation with the corresponding grb
 #    cur.execute("SELECT obs_id, obsname FROM observation WHERE grb IS NULL")
@@ -119,30 +224,41 @@ if __name__ == "__main__":
 
     ps = argparse.ArgumentParser(description='add observations to database')
     ps.add_argument('--obsids', type=str, help='List of obsids to import; format of file ("txt": single-column text file of obsids; "csv": (optionally multi-column) comma-separated file with a header starting with # and a column labelled obsid; "meta": download from the online MWA metadatabase.', default=None)
+    ps.add_argument('--db', type=str, help='Database file (default = {0})'.format(dbfile), default=dbfile)
+    ps.add_argument('--threads', type=int, help='Number of metadata requests to make at once (default = 8)', default=8)
+    ps.add_argument('--batch', type=int, help='Number of observations to insert per statement (default = 500)', default=500)
+    ps.add_argument('--retries', type=int, help='Number of times to retry a failed metadata request (default = 3)', default=3)
+    ps.add_argument('--baseurl', type=str, help='Metadata web service to use (default = {0})'.format(BASEURL), default=BASEURL)
+    ps.add_argument('--offline', action='store_true', help='Only use metadata already in the local metadata cache', default=False)
+    ps.add_argument('--fixtures', type=str, help='Read metadata from <obsid>.json files in this directory instead of the web service', default=None)
 
     args = ps.parse_args()
 
-    if os.path.exists(args.obsids):
+    if args.obsids is not None and os.path.exists(args.obsids):
         filename, file_extension = os.path.splitext(args.obsids)
         if file_extension == ".txt":
-            ids = np.loadtxt(args.obsids, comments="#", dtype=int)
-# Makes it work for single-line files
-#            if len(ids.shape)==1:
-#               ids = [ids]
+            # Makes it work for single-line files
+            ids = np.atleast_1d(np.loadtxt(args.obsids, comments="#", dtype=int))
         else:
             print "Other file formats not yet enabled."
             sys.exit(1)
 #        elif file_extension == ".csv":
 #        elif file_extension == ".xml":
+    else:
+        print "No list of obsids given."
+        sys.exit(1)
 
-    conn = sqlite3.connect(dbfile)
-    cur = conn.cursor()
+    if args.fixtures is not None:
+        source = JSONMetadata(args.fixtures)
+    else:
+        source = WebMetadata(args.baseurl, retries=args.retries, offline=args.offline)
+
+    conn = sqlite3.connect(args.db)
     print len(ids)
     if len(ids) > 0:
-        for obs_id in ids:
-            print obs_id
-            copy_obs_info(obs_id,cur)
-            conn.commit()
+        imported, missing = bulk_import(ids, conn, source, threads=args.threads, batch=args.batch)
+        print "Imported {0} observations; {1} had no metadata".format(len(imported), len(missing))
+        conn.close()
         sys.exit()
     #obsdata = getmeta(service='find', params={'projectid':'D0009', 'limit':100000}) #'limit':10
 #    obsdata = getmeta(service='find', params={'projectid':'G0008', 'mintime':'1201549600', 'maxtime': '1201550200', 'limit':10}) #'limit':10
@@ -75,18 +75,95 @@ obs_id INT,
 source TEXT,
 appflux FLOAT,
 infov BOOL,
+srcversion TEXT,
 FOREIGN KEY(obs_id) REFERENCES observation(obs_id),
 FOREIGN KEY(source) REFERENCES sources(source),
 CONSTRAINT obs_src PRIMARY KEY(obs_id,source)
 );
 """
 
-def main():
-    conn = sqlite3.connect(dbfile)
-    cur = conn.cursor()
+def create_tables(cur):
     for cmd in schema.split(';'):
-        print cmd + ';'
+        print(cmd + ';')
+        cur.execute(cmd)
+
+def add_srcversion(cur):
+    # Databases made before calapparent recorded the source version
+    columns = [row[1] for row in cur.execute("PRAGMA table_info(calapparent)")]
+    if 'srcversion' not in columns:
+        cur.execute("ALTER TABLE calapparent ADD COLUMN srcversion TEXT")
+
+indexes = """
+CREATE UNIQUE INDEX IF NOT EXISTS sources_source ON sources(source);
+CREATE INDEX IF NOT EXISTS observation_status ON observation(status);
+CREATE INDEX IF NOT EXISTS observation_no_iono ON observation(obs_id) WHERE ion_phs_med IS NULL;
+CREATE INDEX IF NOT EXISTS processing_status_time ON processing(status, end_time);
+CREATE INDEX IF NOT EXISTS processing_obs_id ON processing(obs_id, task);
+CREATE INDEX IF NOT EXISTS calapparent_source ON calapparent(source, infov);
+"""
+
+def add_indexes(cur):
+    # sources(source) is referenced by calapparent, so it must be unique.
+    # Which copy of a duplicate is right isn't ours to guess, so stop and list them.
+    duplicates = cur.execute("""SELECT source, ra, dec, flux, alpha, beta FROM sources
+    WHERE source IN (SELECT source FROM sources GROUP BY source HAVING count(*) > 1)
+    ORDER BY source, rowid""").fetchall()
+    if len(duplicates) > 0:
+        print("sources has more than one row for these sources; remove the wrong ones and run again:")
+        print("source ra dec flux alpha beta")
+        for row in duplicates:
+            print(" ".join(str(x) for x in row))
+        raise sqlite3.IntegrityError("{0} duplicate rows in sources".format(len(duplicates)))
+    for cmd in indexes.split(';'):
         cur.execute(cmd)
+
+# Each migration brings the database up to its version number, which is kept
+# in PRAGMA user_version. Add new ones to the end; never change old ones.
+migrations = [(1, "create tables", create_tables),
+              (2, "add calapparent.srcversion", add_srcversion),
+              (3, "add indexes", add_indexes)]
+
+def schema_version(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version == 0 and conn.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='observation'").fetchone()[0] > 0:
+        # Made by make_db.py before there were migrations
+        version = 1
+    return version
+
+def migrate(conn):
+    """Apply any migrations the database doesn't have yet, each in its own transaction.
+
+    Returns the new schema version.
+    """
+    version = start = schema_version(conn)
+    # Manage the transactions here, and give the connection back as it was
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    cur = conn.cursor()
+    try:
+        for number, description, migration in migrations:
+            if number <= version:
+                continue
+            cur.execute("BEGIN")
+            try:
+                migration(cur)
+                cur.execute("PRAGMA user_version = {0:d}".format(number))
+                cur.execute("COMMIT")
+            except:
+                cur.execute("ROLLBACK")
+                raise
+            print("Applied migration {0}: {1}".format(number, description))
+            version = number
+        if version > start:
+            # Let the query planner know about the new indexes
+            cur.execute("ANALYZE")
+    finally:
+        conn.isolation_level = isolation_level
+    return version
+
+def main():
+    conn = sqlite3.connect(dbfile)
+    migrate(conn)
     conn.close()
 
 if __name__ == '__main__':
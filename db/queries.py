@@ -0,0 +1,96 @@
+import time
+import sqlite3
+
+__author__ = "Paul Hancock & Natasha Hurley-Walker"
+
+dbfile = 'GLEAM-X.sqlite'
+
+# The common lookups on the database. Each statement is a constant with ?
+# parameters, so sqlite compiles it once per connection and reuses it from
+# the connection's statement cache. The indexes they rely on are added by
+# make_db.py (migration 3).
+
+FAILED_SINCE = """
+SELECT job_id, task_id, obs_id, task, end_time, stderr
+FROM processing
+WHERE status = 'failed' AND end_time >= ?
+ORDER BY end_time"""
+
+JOBS_WITH_STATUS = """
+SELECT job_id, task_id, obs_id, task
+FROM processing
+WHERE status = ?"""
+
+JOB = """
+SELECT job_id, task_id, submission_time, task, user, start_time, end_time, obs_id, status, batch_file, stderr, stdout
+FROM processing
+WHERE job_id = ? AND task_id = ?"""
+
+OBS_JOBS = """
+SELECT job_id, task_id, task, status, submission_time, end_time
+FROM processing
+WHERE obs_id = ?
+ORDER BY submission_time"""
+
+MISSING_IONO = """
+SELECT obs_id
+FROM observation
+WHERE ion_phs_med IS NULL
+ORDER BY obs_id"""
+
+OBSERVATION = """
+SELECT obs_id, ra_pointing, dec_pointing, cenchan, starttime, delays, status
+FROM observation
+WHERE obs_id = ?"""
+
+CALIBRATORS_IN_FOV = """
+SELECT source, appflux
+FROM calapparent
+WHERE obs_id = ? AND infov
+ORDER BY appflux DESC"""
+
+SOURCE_OBSERVATIONS = """
+SELECT obs_id, appflux
+FROM calapparent
+WHERE source = ? AND infov
+ORDER BY obs_id"""
+
+
+def connect(db=dbfile):
+    """Open the database for queries, waiting for writers instead of failing."""
+    conn = sqlite3.connect(db, timeout=60)
+    return conn
+
+def failed_jobs(conn, since=None):
+    """Jobs that failed since the given unix time (by default, in the last day)."""
+    if since is None:
+        since = int(time.time()) - 86400
+    return conn.execute(FAILED_SINCE, (since,)).fetchall()
+
+def jobs_with_status(conn, status):
+    """All the (job_id, task_id, obs_id, task) of jobs with a status, e.g. 'queued' or 'started'."""
+    return conn.execute(JOBS_WITH_STATUS, (status,)).fetchall()
+
+def job(conn, job_id, task_id):
+    """The processing row of one task, or None."""
+    return conn.execute(JOB, (job_id, task_id)).fetchone()
+
+def obs_jobs(conn, obs_id):
+    """Every job run on an observation, oldest first."""
+    return conn.execute(OBS_JOBS, (obs_id,)).fetchall()
+
+def missing_ionosphere(conn):
+    """The obs_ids of observations without ionospheric statistics."""
+    return [row[0] for row in conn.execute(MISSING_IONO)]
+
+def observation(conn, obs_id):
+    """Pointing, frequency, start time and delays of an observation, or None."""
+    return conn.execute(OBSERVATION, (obs_id,)).fetchone()
+
+def calibrators_in_fov(conn, obs_id):
+    """The (source, apparent flux) of the calibrators in the field of an observation, brightest first."""
+    return conn.execute(CALIBRATORS_IN_FOV, (obs_id,)).fetchall()
+
+def source_observations(conn, source):
+    """The (obs_id, apparent flux) of every observation with a calibrator in its field."""
+    return conn.execute(SOURCE_OBSERVATIONS, (source,)).fetchall()